@@ -0,0 +1,176 @@
+import heapq
+import itertools
+import math
+import threading
+
+from metrics import REQUESTS_SHED
+
+# Weight of the newest request in the running service-time average
+SERVICE_TIME_SMOOTHING = 0.2
+
+
+class Overloaded(Exception):
+    """A request was shed; retry_after is the suggested back-off in whole seconds"""
+
+    def __init__(self, request_class, reason, retry_after):
+        super().__init__(f"{request_class} request shed ({reason}), retry after {retry_after}s")
+        self.request_class = request_class
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ('priority', 'seq', 'request_class', 'slots', 'notify', 'state')
+
+    def __init__(self, priority, seq, request_class, slots, notify):
+        self.priority = priority
+        self.seq = seq
+        self.request_class = request_class
+        self.slots = slots
+        self.notify = notify
+        self.state = 'waiting'  # then 'granted' (holds its slots) or 'shed'
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AdmissionController:
+    """
+    Bounded, prioritized admission in front of the ML stages. At most `slots` slots are in use at once;
+    a request takes one, or as many as it runs pipelines in parallel (a bulk verification). The rest
+    wait in a queue of at most queue_size, served by priority (lower first) and FIFO within a class.
+    A request is shed up front when its projected wait exceeds max_wait, or when the queue is full of
+    requests at least as important; a queued request is pushed out by a more important one.
+    Waits are projected from the observed service time of each request class.
+    """
+
+    def __init__(self, slots, queue_size, max_wait, priorities, initial_service_time):
+        self.slots = slots
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.priorities = priorities
+        # Per class, so long bulk requests do not inflate the estimate for single verifications
+        self.service_time = dict.fromkeys(priorities, initial_service_time)
+        self._heap = []
+        self._queued = dict.fromkeys(priorities, 0)
+        self._running = dict.fromkeys(priorities, 0)  # slots in use per class
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self.admitted = dict.fromkeys(priorities, 0)
+        self.shed = {}
+
+    def _in_use(self):
+        return sum(self._running.values())
+
+    def _projected_wait(self, request_class, slots):
+        priority = self.priorities[request_class]
+        ahead = sum(self.service_time[w.request_class] * w.slots for w in self._heap if w.priority <= priority)
+        return (ahead + self.service_time[request_class] * slots) / self.slots
+
+    def _retry_after(self):
+        backlog = sum(self.service_time[request_class] * slots for request_class, slots in self._running.items()) \
+            + sum(self.service_time[w.request_class] * w.slots for w in self._heap)
+        return max(1, math.ceil(backlog / self.slots))
+
+    def _overloaded(self, request_class, reason):
+        self.shed[(request_class, reason)] = self.shed.get((request_class, reason), 0) + 1
+        REQUESTS_SHED.labels(request_class, reason).inc()
+        return Overloaded(request_class, reason, self._retry_after())
+
+    def _remove(self, waiter):
+        self._heap.remove(waiter)
+        heapq.heapify(self._heap)
+        self._queued[waiter.request_class] -= 1
+        self._dispatch()  # the waiter behind it may fit in the slots it was waiting for
+
+    def _dispatch(self):
+        """Grant free slots to the most important waiters, in order, for as long as the next one fits"""
+        while self._heap and self._in_use() + self._heap[0].slots <= self.slots:
+            waiter = heapq.heappop(self._heap)
+            self._queued[waiter.request_class] -= 1
+            self._running[waiter.request_class] += waiter.slots
+            self.admitted[waiter.request_class] += 1
+            waiter.state = 'granted'
+            waiter.notify()
+
+    def enter(self, request_class, notify, slots=1):
+        """
+        Admit at once (returns None) or queue the request (returns its waiter; notify() is called
+        from another thread once it is granted its slots or pushed out). Raises Overloaded when shed.
+        """
+        priority = self.priorities[request_class]
+        slots = max(1, min(slots, self.slots))
+        with self._lock:
+            if not self._heap and self._in_use() + slots <= self.slots:
+                self._running[request_class] += slots
+                self.admitted[request_class] += 1
+                return None
+            if self._projected_wait(request_class, slots) > self.max_wait:
+                raise self._overloaded(request_class, 'deadline')
+            if len(self._heap) >= self.queue_size:
+                victim = max(self._heap, key=lambda w: (w.priority, w.seq))
+                if victim.priority <= priority:
+                    raise self._overloaded(request_class, 'queue_full')
+                victim.state = 'shed'
+                self._overloaded(victim.request_class, 'preempted')
+                victim.notify()
+                self._remove(victim)
+            waiter = _Waiter(priority, next(self._seq), request_class, slots, notify)
+            heapq.heappush(self._heap, waiter)
+            self._queued[request_class] += 1
+            self._dispatch()
+            return waiter
+
+    def settle(self, waiter):
+        """After notify() or max_wait: return if the waiter holds its slots, raise Overloaded otherwise"""
+        with self._lock:
+            if waiter.state == 'granted':
+                return
+            if waiter.state == 'waiting':
+                waiter.state = 'shed'
+                self._remove(waiter)
+                raise self._overloaded(waiter.request_class, 'timeout')
+            raise Overloaded(waiter.request_class, 'preempted', self._retry_after())
+
+    def abandon(self, waiter):
+        """The client went away while queued: drop the waiter, or free the slots it was just granted"""
+        with self._lock:
+            if waiter.state == 'waiting':
+                waiter.state = 'shed'
+                self._remove(waiter)
+            elif waiter.state == 'granted':
+                waiter.state = 'shed'
+                self._running[waiter.request_class] -= waiter.slots
+                self._dispatch()
+
+    def acquire(self, request_class, slots=1):
+        """Block until the request is admitted with its slots; raises Overloaded when it is shed"""
+        granted = threading.Event()
+        waiter = self.enter(request_class, granted.set, slots)
+        if waiter is not None:
+            granted.wait(self.max_wait)
+            self.settle(waiter)
+
+    def release(self, request_class, service_time, slots=1):
+        """An admitted request holding slots finished after service_time seconds"""
+        with self._lock:
+            self.service_time[request_class] += SERVICE_TIME_SMOOTHING * (service_time - self.service_time[request_class])
+            self._running[request_class] -= max(1, min(slots, self.slots))
+            self._dispatch()
+
+    def queue_depth(self, request_class=None):
+        if request_class is None:
+            return len(self._heap)
+        return self._queued[request_class]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'slots': self.slots,
+                'running': dict(self._running),
+                'queued': dict(self._queued),
+                'admitted': dict(self.admitted),
+                'shed': {f"{request_class}:{reason}": count for (request_class, reason), count in self.shed.items()},
+                'service_time': dict(self.service_time),
+                'retry_after': self._retry_after()
+            }
@@ -1,32 +1,48 @@
+import json
 import os
-import uuid
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from functools import wraps
 import flask_cors
-# Image processing & ML
-from deepface import DeepFace
 # Web framework
-from flask import Flask, request, jsonify
-from config import allowed_file, token_required, secure_save_file, cleanup_files, read_image, detect_faces, \
-    extract_face_features, verify_location, generate_attendance_id
-
-# Global variable for detector
-detector_backend = "retinaface"  # Changed from dlib to retinaface
+from flask import Flask, Response, g, request, jsonify
+from config import allowed_file, token_required, read_upload, read_clip_upload, decode_image, verify_location, \
+    firebase_credentials, generate_attendance_id, idempotent_attendance_id, upload_digest, request_fingerprint
 
 # Storage
 import firebase_admin
-from firebase_admin import credentials, firestore, storage
+from firebase_admin import firestore, storage
+from google.cloud.firestore_v1.base_query import FieldFilter
 # Authentication & security
 import jwt
 from cryptography.fernet import Fernet
 import bcrypt
-from livenesschech import Config, check_liveness, logger
+from livenesschech import Config, logger
+from embeddings import compute_embedding, build_reference_template, select_template, template_fields, \
+    decode_template, cosine_distance
+from cache import TTLCache
+from model_registry import prefetch_model_files, start_warm_up, readiness
+from reference_faces import prepare_reference_face, store_reference_face
+from face_pipeline import run_face_pipeline, analyze_group, analyze_face_without_liveness
+from liveness_burst import check_burst_liveness, iter_burst_frames, iter_clip_frames
+from embedding_index import FirestoreEmbeddingIndex, assign_matches
+from geofence_index import GeofenceRegistry
+from inference_scheduler import ProcessLocal
+from write_behind import WriteBehindQueue, commit_writes, new_document_path
+from replay_guard import HASHES, ReplayIndex
+from admission import AdmissionController, Overloaded
+from idempotency import CONFLICT, LEAD, REPLAY, WAIT, IdempotencyCache, retry_key
+from metrics import span, traced, IN_FLIGHT, REQUEST_LATENCY, REPLAYS_REJECTED, start_request_timings, \
+    request_timings, end_request_timings, server_timing_header, track_queue, render_metrics
+from embeddings import embedding_batcher
+from livenesschech import attribute_batcher, cascade_stats
 
 # Initialize application
 app = Flask(__name__)
 # Add CORS support for production
 flask_cors.CORS(app)
 logger.info("Checking start")
-os.makedirs(Config.TEMP_FOLDER, exist_ok=True)
 
 # Initialize security
 encryption_key = os.getenv('ENCRYPTION_KEY', Fernet.generate_key())
@@ -34,27 +50,8 @@ cipher_suite = Fernet(encryption_key)
 
 # Initialize Firebase
 try:
-    # Check if credentials are provided as JSON string in environment variable
-    cred_json = os.getenv('FIREBASE_CREDENTIALS_JSON')
-    if cred_json:
-        import json
-
-        try:
-            # Try to parse as JSON string
-            cred_dict = json.loads(cred_json)
-            cred = credentials.Certificate(cred_dict)
-            logger.info("Using Firebase credentials from environment variable")
-        except json.JSONDecodeError:
-            # If it's not valid JSON, try as a file path
-            logger.warning("Failed to parse FIREBASE_CREDENTIALS_JSON as JSON, trying as file")
-            cred = credentials.Certificate(cred_json)
-    else:
-        # Fall back to file-based credentials
-        logger.info("Using Firebase credentials from file")
-        cred = credentials.Certificate(Config.FIREBASE_CRED_PATH)
-
-    firebase_admin.initialize_app(cred, {
-        'storageBucket': "powerub-795a1.appspot.com"
+    firebase_admin.initialize_app(firebase_credentials(), {
+        'storageBucket': Config.FIREBASE_STORAGE_BUCKET
     })
 
     # Initialize Firestore and Storage
@@ -65,6 +62,781 @@ except Exception as e:
     logger.error(f"Failed to initialize Firebase: {e}")
     raise
 
+# When preloading this runs in the gunicorn master, which only reads the weight files: the graphs
+# are not fork-safe, so each worker builds its own after fork (see gunicorn.conf.py).
+# Otherwise warm up in this process now.
+if Config.PRELOAD_MODELS:
+    prefetch_model_files()
+else:
+    start_warm_up()
+
+# In-process caches: user profile fields by user_id, decoded reference embeddings by
+# (user_id, reference_face_updated) so a re-registration never serves a stale template
+user_cache = TTLCache(Config.USER_CACHE_SIZE, Config.USER_CACHE_TTL)
+template_cache = TTLCache(Config.USER_CACHE_SIZE, Config.TEMPLATE_CACHE_TTL)
+# Session documents and enrolled student ids by session_id
+session_cache = TTLCache(Config.USER_CACHE_SIZE, Config.ROSTER_CACHE_TTL)
+roster_cache = TTLCache(Config.USER_CACHE_SIZE, Config.ROSTER_CACHE_TTL)
+# Every current reference template in one matrix, loaded on the first identification
+embedding_index = FirestoreEmbeddingIndex(db, Config.EMBEDDING_INDEX_SYNC_INTERVAL)
+# Active geofences, indexed on a grid and kept current by a Firestore listener
+geofence_registry = GeofenceRegistry(db, Config.GEOFENCE_CELL_DEGREES)
+# Spooled, batched writes for attendance records, history and security events (one queue per process)
+write_behind = ProcessLocal(lambda: WriteBehindQueue(
+    db, Config.WRITE_SPOOL_FOLDER,
+    max_batch_writes=Config.WRITE_BEHIND_MAX_BATCH,
+    max_wait_ms=Config.WRITE_BEHIND_MAX_WAIT_MS,
+    fsync=Config.WRITE_BEHIND_FSYNC
+))
+# Perceptual hashes of recent register/verify images per user and device (per process)
+replay_index = ReplayIndex(Config.REPLAY_WINDOW, Config.REPLAY_HASHES_PER_KEY, Config.REPLAY_MAX_KEYS)
+# Responses of completed verifications by idempotency key, and the ones still in flight
+idempotency_cache = IdempotencyCache(Config.IDEMPOTENCY_CACHE_SIZE, Config.IDEMPOTENCY_TTL)
+# Bounded, prioritized admission queue in front of the ML endpoints (login is never queued)
+admission = ProcessLocal(lambda: AdmissionController(
+    Config.ADMISSION_SLOTS, Config.ADMISSION_QUEUE_SIZE, Config.ADMISSION_MAX_WAIT,
+    Config.ADMISSION_PRIORITIES, Config.ADMISSION_INITIAL_SERVICE_TIME
+))
+# Runs the items of a bulk verification through the face pipeline concurrently
+batch_executor = ProcessLocal(lambda: ThreadPoolExecutor(
+    max_workers=Config.VERIFY_BATCH_WORKERS,
+    thread_name_prefix="verify-batch"
+))
+
+# Queue depths exported on /metrics
+track_queue('embedding_batcher', lambda: embedding_batcher.stats()['queue_depth'])
+track_queue('attribute_batcher', lambda: attribute_batcher.stats()['queue_depth'])
+for request_class in Config.ADMISSION_PRIORITIES:
+    track_queue(f'admission_{request_class}', lambda request_class=request_class: admission.get().queue_depth(request_class))
+if Config.WRITE_BEHIND:
+    track_queue('write_behind', lambda: write_behind.get().stats()['pending_groups'])
+
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.metrics_start = time.perf_counter()
+    start_request_timings()
+    IN_FLIGHT.labels(g.metrics_endpoint).inc()
+
+
+@app.after_request
+def record_request_metrics(response):
+    if 'metrics_start' in g:
+        elapsed = time.perf_counter() - g.metrics_start
+        REQUEST_LATENCY.labels(g.metrics_endpoint, str(response.status_code)).observe(elapsed)
+        if Config.SERVER_TIMING:
+            response.headers['Server-Timing'] = server_timing_header(request_timings() + [('total', elapsed)])
+    return response
+
+
+@app.teardown_request
+def end_request_metrics(exc):
+    if 'metrics_start' in g:
+        end_request_timings()
+        IN_FLIGHT.labels(g.metrics_endpoint).dec()
+
+
+def shed(request_class, e):
+    """Log a shed request; returns the body and headers of its 503"""
+    logger.warning(f"Shedding {request_class} request: {e}")
+    return {'error': 'Server is busy, please retry shortly', 'retry_after': e.retry_after}, \
+        {'Retry-After': str(e.retry_after)}
+
+
+def overloaded_response(request_class, e):
+    """503 for a shed request, with the back-off the client should wait before retrying"""
+    body, headers = shed(request_class, e)
+    response = jsonify(body)
+    response.status_code = 503
+    response.headers.update(headers)
+    return response
+
+
+def admitted(request_class, slots=None):
+    """
+    Run the endpoint once the admission controller grants it an ML slot, or slots() of them for an
+    endpoint running several pipelines in parallel; shed requests get a 503.
+    A streamed response holds its slots until the stream is closed.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not Config.ADMISSION_CONTROL:
+                return fn(*args, **kwargs)
+            controller = admission.get()
+            count = slots() if slots else 1
+            try:
+                with span('admission'):
+                    controller.acquire(request_class, count)
+            except Overloaded as e:
+                return overloaded_response(request_class, e)
+
+            start = time.monotonic()
+            release = lambda: controller.release(request_class, time.monotonic() - start, count)
+            try:
+                response = fn(*args, **kwargs)
+            except BaseException:
+                release()
+                raise
+            if isinstance(response, Response) and response.is_streamed:
+                response.call_on_close(release)
+            else:
+                release()
+            return response
+        return wrapper
+    return decorator
+
+
+def replayed_response(body, status):
+    response = jsonify(body)
+    response.status_code = status
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+class Rejected(Exception):
+    """A request step refused the request; body and status make up the error response"""
+
+    def __init__(self, message, status=400, **fields):
+        super().__init__(message)
+        self.body = {'error': message, **fields}
+        self.status = status
+
+
+def idempotency_key(user_id, header, session_id, image_file):
+    """
+    (key, fingerprint) of a verification: the key is the Idempotency-Key header or, without one, the
+    (session_id, image digest) fingerprint. Raises Rejected for a malformed header.
+    """
+    if header is not None and not 0 < len(header) <= Config.IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise Rejected(f'Idempotency-Key must be 1 to {Config.IDEMPOTENCY_KEY_MAX_LENGTH} characters')
+    with span('idempotency'):
+        fingerprint = request_fingerprint(session_id, upload_digest(image_file))
+    return f"{user_id}:{header or fingerprint}", fingerprint
+
+
+def claim_idempotency(key, fingerprint):
+    """IdempotencyCache.claim, raising Rejected when the key was already used for a different request"""
+    state, value = idempotency_cache.claim(key, fingerprint)
+    if state == CONFLICT:
+        raise Rejected('Idempotency-Key was already used for a different request', 422)
+    return state, value
+
+
+def complete_idempotency(key, future, body, status):
+    """Hand the leader's response to its duplicates; only completed verifications are kept for retries"""
+    idempotency_cache.complete(key, future, (body, status), store=status == 200)
+
+
+def idempotent(fn):
+    """
+    Return the original response to a retried verification instead of running it again. Requests are
+    identified by the Idempotency-Key header or, without one, by (user, session_id, image digest);
+    a duplicate arriving while the original is still running waits for its result.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not Config.IDEMPOTENCY or 'image' not in request.files:
+            return fn(*args, **kwargs)
+        try:
+            key, fingerprint = idempotency_key(request.user['id'], request.headers.get('Idempotency-Key'),
+                                               request.form.get('session_id'), request.files['image'])
+            state, value = claim_idempotency(key, fingerprint)
+        except Rejected as e:
+            return jsonify(e.body), e.status
+        if state == REPLAY:
+            return replayed_response(*value)
+        if state != LEAD:
+            try:
+                return replayed_response(*value.result(timeout=Config.IDEMPOTENCY_WAIT))
+            except TimeoutError:
+                return jsonify({'error': 'The original request is still being processed, retry later'}), 409
+
+        g.attendance_id = idempotent_attendance_id(key)
+        g.retry_key = retry_key(key, fingerprint)
+        try:
+            response = app.make_response(fn(*args, **kwargs))
+        except BaseException as e:
+            idempotency_cache.fail(key, value, e)
+            raise
+        # Errors and shed requests are recomputed on retry
+        complete_idempotency(key, value, response.get_json(), response.status_code)
+        return response
+    return wrapper
+
+
+@traced('profile')
+def get_user_profile(user_id):
+    """Fetch a user's profile fields, served from the in-process cache when fresh"""
+    user_data = user_cache.get(user_id)
+    if user_data is None:
+        user_doc = db.collection('users').document(user_id).get()
+        if not user_doc.exists:
+            return None
+        user_data = user_doc.to_dict()
+        user_cache.put(user_id, user_data)
+    return dict(user_data)
+
+
+@traced('reference')
+def get_reference_embedding(user_id, user_data):
+    """
+    The user's reference embedding: from the template cache, the stored template, or (for legacy
+    profiles) computed from the reference image and backfilled. Raises ValueError if it cannot be built.
+    """
+    template_key = (user_id, user_data.get('reference_face_updated'), Config.FACE_MODEL_NAME)
+    reference_embedding = template_cache.get(template_key)
+    if reference_embedding is not None:
+        return reference_embedding
+
+    template = select_template(user_data)
+    if template is not None:
+        reference_embedding = decode_template(template)
+    else:
+        reference_blob = bucket.blob(user_data['reference_face'])
+        with span('storage.download'):
+            reference_bytes = reference_blob.download_as_bytes()
+        reference_image = decode_image(reference_bytes)
+        if reference_image is None:
+            raise ValueError('Failed to read reference image')
+
+        reference_embedding = compute_embedding(reference_image)
+        if reference_embedding is None:
+            raise ValueError('Failed to compute reference embedding')
+
+        # Backfill the template so later verifications skip the download
+        db.collection('users').document(user_id).set(template_fields(build_reference_template(
+            reference_embedding, datetime.utcnow(), reference_face=user_data['reference_face']
+        )), merge=True)
+        embedding_index.add(user_id, reference_embedding)
+        logger.info(f"Backfilled reference embedding for user {user_id}")
+
+    template_cache.put(template_key, reference_embedding)
+    return reference_embedding
+
+
+@traced('writes')
+def queue_writes(writes):
+    """
+    Commit a group of (document_path, data) sets together: durably spooled and batched with
+    other requests' writes when write-behind is enabled, otherwise in one synchronous batch
+    """
+    if Config.WRITE_BEHIND:
+        write_behind.get().enqueue(writes)
+    else:
+        commit_writes(db, writes)
+
+
+def replay_keys(user_id, device_id):
+    return [('user', user_id)] + ([('device', device_id)] if device_id else [])
+
+
+def check_replay(user_id, device_id, image, endpoint, retry_key=None):
+    """
+    Match a decoded upload against the recent submissions of the same user and device, except the
+    earlier attempts of this request (same retry_key). Returns (security event to record for a
+    replayed image or None, the image's hash for remember_submission).
+    """
+    if not Config.REPLAY_GUARD:
+        return None, None
+    with span('replay_check'):
+        image_hash = HASHES[Config.REPLAY_HASH](image)
+        match = replay_index.check(replay_keys(user_id, device_id), image_hash, Config.REPLAY_MAX_DISTANCE,
+                                   retry_key)
+    if match is None:
+        return None, image_hash
+
+    REPLAYS_REJECTED.labels(endpoint, match['key']).inc()
+    logger.warning(f"Replayed image from user {user_id} on {endpoint}: {match['distance']} bits from a "
+                   f"{match['endpoint']} submission by the same {match['key']} {match['age']:.0f}s ago")
+    return {
+        'user_id': user_id,
+        'event_type': 'replayed_image',
+        'timestamp': datetime.utcnow(),
+        'endpoint': endpoint,
+        'device_id': device_id,
+        'image_hash': f"{Config.REPLAY_HASH}:{image_hash:016x}",
+        'matched_by': match['key'],
+        'matched_user_id': match['user_id'],
+        'matched_endpoint': match['endpoint'],
+        'hamming_distance': match['distance'],
+        'seconds_since_match': round(match['age'], 1)
+    }, image_hash
+
+
+def remember_submission(user_id, device_id, image_hash, endpoint, retry_key=None):
+    """Add a processed submission to the replay index (image_hash as returned by check_replay)"""
+    if image_hash is not None:
+        replay_index.add(replay_keys(user_id, device_id), image_hash, user_id, endpoint, retry_key)
+
+
+@traced('location')
+def check_location(latitude, longitude, session_id, authorized_locations):
+    """
+    Verify a location against the server-side geofences: the session's own geofence when
+    it has one, otherwise any active geofence. Client-supplied authorized_locations are only
+    used while no geofences are configured in Firestore.
+    """
+    geofences = geofence_registry.get_index()
+    if not len(geofences):
+        return verify_location(latitude, longitude, authorized_locations)
+
+    session = get_session(session_id) if session_id else None
+    geofence_id = session.get('geofenceId') if session else None
+    location_verified, location_message, _ = geofences.check(latitude, longitude, geofence_id)
+    return location_verified, location_message
+
+
+@traced('location')
+def check_locations(points, session_ids, authorized_locations):
+    """Batch form of check_location: one vectorized geofence check for every (latitude, longitude)"""
+    geofences = geofence_registry.get_index()
+    if not len(geofences):
+        return [verify_location(lat, lng, locations)
+                for (lat, lng), locations in zip(points, authorized_locations)]
+
+    geofence_ids = []
+    for session_id in session_ids:
+        session = get_session(session_id) if session_id else None
+        geofence_ids.append(session.get('geofenceId') if session else None)
+    return [(verified, message) for verified, message, _ in geofences.check_many(points, geofence_ids)]
+
+
+def invalidate_user_cache(user_id):
+    """Drop cached profile and templates after the user's face template changes"""
+    user_cache.invalidate(user_id)
+    template_cache.invalidate_where(lambda key: key[0] == user_id)
+
+
+def get_session(session_id):
+    """Fetch a session document, served from the in-process cache when fresh"""
+    session = session_cache.get(session_id)
+    if session is None:
+        session_doc = db.collection('sessions').document(session_id).get()
+        if not session_doc.exists:
+            return None
+        session = session_doc.to_dict()
+        session_cache.put(session_id, session)
+    return session
+
+
+def can_identify(user_id):
+    """Whether a user may run 1:N identification: kiosk accounts, instructors and admins"""
+    user_data = get_user_profile(user_id)
+    return bool(user_data) and user_data.get('role') in Config.IDENTIFY_ROLES
+
+
+def can_record_for_session(user_id, session):
+    """Whether a user may record attendance on others' behalf: the course's instructor, or an admin"""
+    course_id = session.get('courseId')
+    if course_id:
+        course_doc = db.collection('courses').document(course_id).get()
+        if course_doc.exists and (course_doc.to_dict() or {}).get('instructorId') == user_id:
+            return True
+    user_data = get_user_profile(user_id)
+    return bool(user_data) and user_data.get('role') == 'admin'
+
+
+def get_session_roster(session_id):
+    """
+    Student ids enrolled in the course a session belongs to.
+    Returns None if the session does not exist.
+    """
+    roster = roster_cache.get(session_id)
+    if roster is None:
+        session = get_session(session_id)
+        if session is None:
+            return None
+        course_id = session.get('courseId')
+        enrollments = db.collection('enrollments').where(filter=FieldFilter('courseId', '==', course_id)).stream()
+        roster = frozenset(doc.to_dict().get('studentId') for doc in enrollments)
+        roster_cache.put(session_id, roster)
+    return roster
+
+
+def issue_token(user_id, user_data):
+    """Sign a JWT for an authenticated user; returns the login response body"""
+    token_expiry = datetime.utcnow() + timedelta(seconds=Config.JWT_EXPIRATION)
+    token = jwt.encode(
+        {
+            'id': user_id,
+            'name': user_data.get('fullName', ''),
+            'exp': token_expiry
+        },
+        Config.JWT_SECRET,
+        algorithm="HS256"
+    )
+    return {
+        'token': token,
+        'expires_at': token_expiry.isoformat(),
+        'user': {
+            'id': user_id,
+            'name': user_data.get('fullName', '')
+        }
+    }
+
+
+def check_pin(pin_code, user_data):
+    """Whether pin_code matches the user's stored PIN hash; False without either"""
+    stored_pin_hash = user_data.get('pin_hash')
+    if not pin_code or not stored_pin_hash:
+        return False
+    with span('pin'):
+        return bool(bcrypt.checkpw(pin_code.encode(), stored_pin_hash.encode()))
+
+
+def record_verification(user_id, session_id, face_match, face_match_confidence, face_distance, is_live,
+                        liveness_score, liveness_details, location_verified, location_message, pin_code,
+                        pin_verified, device_id, latitude, longitude, location_id, attendance_id=None,
+                        extra_fields=None, writes=None):
+    """
+    Compile the factors of a verification, queue the attendance record and history entry, return the response body.
+    With a given attendance_id (idempotent requests) a repeated call overwrites both documents instead of adding new ones.
+    extra_fields are merged into the attendance record. is_live None means liveness was not checked (group photos).
+    Given a writes list, the two documents are appended to it for the caller to commit instead of queued.
+    """
+    timestamp = datetime.utcnow()
+    history_path = f'users/{user_id}/attendance_history/{attendance_id}' if attendance_id \
+        else new_document_path(f'users/{user_id}/attendance_history')
+    attendance_id = attendance_id or generate_attendance_id(user_id, timestamp)
+
+    # Determine overall verification status with native Python types
+    verification_factors = [
+        {
+            "factor": "face_recognition",
+            "verified": bool(face_match),
+            "confidence": float(face_match_confidence)
+        }
+    ]
+
+    if is_live is not None:
+        verification_factors.append({
+            "factor": "liveness",
+            "verified": bool(is_live),
+            "confidence": float(liveness_score * 100)
+        })
+        if liveness_details is not None:
+            verification_factors[-1]['details'] = liveness_details
+
+    verification_factors.append({
+        "factor": "location",
+        "verified": bool(location_verified),
+        "message": location_message
+    })
+
+    if pin_code:
+        verification_factors.append({
+            "factor": "pin_code",
+            "verified": bool(pin_verified)
+        })
+
+    # Calculate overall verification status
+    verified = bool(face_match and is_live is not False and location_verified)
+    if pin_code:
+        verified = bool(verified and pin_verified)
+
+    # 10. Store attendance record with new structure
+    attendance_record = {
+        'id': attendance_id,
+        'studentId': user_id,
+        'sessionId': session_id,
+        'status': 'present' if verified else 'absent',
+        'checkInTimestamp': timestamp if verified else None,
+        'overrideJustification': None,
+        'overrideBy': None,
+        'isOverridden': False,
+        'createdAt': timestamp,
+        'updatedAt': timestamp,
+        # Keep legacy fields for backward compatibility
+        'verification_factors': verification_factors,
+        'face_distance': float(face_distance),
+        'device_id': device_id,
+        'location': {
+            'latitude': float(latitude) if latitude else None,
+            'longitude': float(longitude) if longitude else None,
+            'location_id': location_id,
+            'verified': bool(location_verified),
+            'message': location_message
+        }
+    }
+    attendance_record.update(extra_fields or {})
+
+    # Store record in Firestore and 11. update user's attendance history, committed together
+    record_writes = [
+        (f'attendance_record/{attendance_id}', attendance_record),
+        (history_path, {
+            'attendance_id': attendance_id,
+            'timestamp': timestamp,
+            'verified': bool(verified),
+            'location_verified': bool(location_verified)
+        })
+    ]
+    if writes is None:
+        queue_writes(record_writes)
+    else:
+        writes.extend(record_writes)
+
+    # 12. Create appropriate response
+    return {
+        'attendance_id': attendance_id,
+        'timestamp': timestamp.isoformat(),
+        'verified': bool(verified),
+        'verification_details': verification_factors
+    }
+
+
+def form_float(form, key, default=None):
+    """Float field of a Flask or Starlette form, or default when missing or malformed"""
+    try:
+        return float(form[key])
+    except (KeyError, TypeError, ValueError):
+        return default
+
+
+def verification_fields(form):
+    """The location, session and extra factors of a verification form (Flask or Starlette)"""
+    authorized_locations = []
+    # Option 1: a JSON list of authorized locations
+    if 'authorized_locations' in form:
+        try:
+            authorized_locations = json.loads(form['authorized_locations'])
+        except Exception as e:
+            logger.warning(f"Failed to parse authorized_locations JSON: {e}")
+    # Option 2: a single location, for backward compatibility
+    elif 'auth_latitude' in form and 'auth_longitude' in form:
+        authorized_locations.append({
+            'latitude': form_float(form, 'auth_latitude'),
+            'longitude': form_float(form, 'auth_longitude'),
+            'radius': form_float(form, 'auth_radius', Config.ALLOWED_LOCATION_RADIUS),
+            'name': form.get('auth_name', 'Verification point')
+        })
+    return {
+        'latitude': form_float(form, 'latitude'),
+        'longitude': form_float(form, 'longitude'),
+        'location_id': form.get('location_id'),
+        'session_id': form.get('session_id'),
+        'pin_code': form.get('pin_code'),
+        'device_id': form.get('device_id'),
+        'authorized_locations': authorized_locations
+    }
+
+
+def load_upload(file):
+    """Read and decode an image upload in memory; returns (image_bytes, image_format, image)"""
+    image_bytes, image_format, error = read_upload(file)
+    if error:
+        raise Rejected(error)
+    image = decode_image(image_bytes)
+    if image is None:
+        raise Rejected('Failed to read image')
+    return image_bytes, image_format, image
+
+
+def reject_replay(user_id, device_id, image, endpoint, retry_key=None, **fields):
+    """
+    Record a security event and raise Rejected when the image replays a recent submission. Otherwise
+    returns its hash, for remember_submission once the request has completed.
+    """
+    replay_event, image_hash = check_replay(user_id, device_id, image, endpoint, retry_key)
+    if replay_event:
+        queue_writes([(new_document_path('security_events'), replay_event)])
+        raise Rejected('This image was already submitted recently, please take a new photo', **fields)
+    return image_hash
+
+
+def read_burst(clip, frames):
+    """Frames of an optional 'clip' video or list of 'frames' stills, or None when there are neither"""
+    if clip is not None:
+        clip_bytes, error = read_clip_upload(clip)
+        if error:
+            raise Rejected(error)
+        return iter_clip_frames(clip_bytes, Config.BURST_CLIP_STRIDE)
+    if frames:
+        if len(frames) > Config.BURST_MAX_FRAMES:
+            raise Rejected(f'Too many frames (max {Config.BURST_MAX_FRAMES})')
+        frame_bytes = []
+        for file in frames:
+            data, _, error = read_upload(file)
+            if error:
+                raise Rejected(error)
+            frame_bytes.append(data)
+        return iter_burst_frames(frame_bytes)
+    return None
+
+
+def analyze_registration(user_id, image):
+    """Face, liveness and embedding of a registration image; raises Rejected unless it is one live face"""
+    face_result = run_face_pipeline(image)
+    if face_result['face_count'] == 0:
+        raise Rejected('No face detected in image')
+    if face_result['face_count'] > 1:
+        raise Rejected('Multiple faces detected, please provide an image with only your face')
+    if not face_result['is_live']:
+        logger.warning(f"Liveness check failed for user {user_id}: score {face_result['liveness_score']:.4f}")
+        raise Rejected('Liveness check failed. Please ensure you are using a real face.')
+    if face_result['embedding'] is None:
+        raise Rejected('Failed to compute face embedding')
+    return face_result
+
+
+def store_registration_face(user_id, image_bytes, image_format, crop_bytes, timestamp):
+    """Upload the reference image of a registration; returns its profile fields"""
+    with span('storage.upload'):
+        return store_reference_face(bucket, f"{user_id}/{timestamp.strftime('%Y%m%d_%H%M%S')}",
+                                    image_bytes, image_format, crop_bytes)
+
+
+def registration_profile(face_result, reference_fields, timestamp):
+    """Profile fields a registration merges into the user document"""
+    return {
+        **reference_fields,
+        'reference_face_updated': timestamp,
+        # Merged into the per-model map; other models' templates of the old face no longer match it
+        **template_fields(build_reference_template(face_result['embedding'], timestamp,
+                                                   reference_face=reference_fields['reference_face'])),
+        'liveness_score': face_result['liveness_score'],
+        'hasFacialTemplate': True,
+        'updatedAt': timestamp
+    }
+
+
+def complete_registration(user_id, embedding, timestamp):
+    """Make a stored registration visible to verification and identification; returns the response body"""
+    invalidate_user_cache(user_id)
+    embedding_index.add(user_id, embedding)
+    return {
+        'status': 'success',
+        'message': 'Face registered successfully',
+        'timestamp': timestamp.isoformat()
+    }
+
+
+def abandon_registration(user_id):
+    """After a profile write that failed (it may still have committed): drop what is cached of the old face"""
+    invalidate_user_cache(user_id)
+    embedding_index.invalidate(user_id)
+
+
+def burst_shows_probe(probe_embedding, face_frames):
+    """Whether every face frame the burst liveness was scored on shows the person in the still probe"""
+    if not face_frames:
+        return False
+    for frame in face_frames:
+        result = run_face_pipeline(frame, analyze=analyze_face_without_liveness)
+        if result['face_count'] != 1 or result['embedding'] is None:
+            return False
+        if cosine_distance(result['embedding'], probe_embedding) > Config.FACE_MATCH_THRESHOLD:
+            return False
+    return True
+
+
+def analyze_verification(user_id, image, burst_frames, fields):
+    """
+    Liveness, across the burst when there is one and on the still otherwise, and the probe embedding
+    of a verification. A burst only counts when its faces match the still, so a live burst cannot vouch
+    for someone else's photo. Returns (face_result, liveness_score, liveness_details); raises Rejected,
+    with a security event recorded when liveness fails.
+    """
+    liveness_details = None
+    if burst_frames is not None:
+        # Liveness across the frames first; the costly still-image pipeline only runs if it passes
+        with span('liveness.burst'):
+            is_live, liveness_score, liveness_details, face_frames = check_burst_liveness(burst_frames)
+        face_result = run_face_pipeline(image, analyze=analyze_face_without_liveness) if is_live else None
+        if face_result is not None and face_result['face_count'] == 1 and face_result['embedding'] is not None:
+            with span('liveness.burst_identity'):
+                liveness_details['matches_probe'] = burst_shows_probe(face_result['embedding'], face_frames)
+            is_live = liveness_details['matches_probe']
+    else:
+        # Face detection, liveness detection (anti-spoofing) and probe embedding
+        face_result = run_face_pipeline(image)
+        is_live, liveness_score = face_result['is_live'], face_result['liveness_score']
+
+    if face_result is not None:
+        if face_result['face_count'] == 0:
+            raise Rejected('No face detected in verification image')
+        if face_result['face_count'] > 1:
+            raise Rejected('Multiple faces detected, please provide a clear image with only your face')
+
+    if not is_live:
+        logger.warning(f"Liveness check failed during verification for user {user_id}: score {liveness_score:.4f}")
+        # Log the attempt as potentially fraudulent
+        queue_writes([(new_document_path('security_events'), {
+            'user_id': user_id,
+            'event_type': 'liveness_check_failed',
+            'timestamp': datetime.utcnow(),
+            'liveness_score': liveness_score,
+            'liveness_details': liveness_details,
+            'device_id': fields['device_id'],
+            'latitude': fields['latitude'],
+            'longitude': fields['longitude']
+        })])
+        raise Rejected('Liveness check failed. Please ensure you are using a real face.', verified=False)
+    return face_result, liveness_score, liveness_details
+
+
+def load_reference(user_id, user_data):
+    """The reference embedding to match a verification against; raises Rejected when there is none"""
+    if user_data is None:
+        raise Rejected('User profile not found', 404)
+    if 'reference_face' not in user_data:
+        raise Rejected('No reference face registered for this user')
+    # Cheap for stored templates; legacy profiles download and embed the reference image
+    try:
+        return get_reference_embedding(user_id, user_data)
+    except ValueError as e:
+        raise Rejected(str(e), 500)
+    except Exception as e:
+        logger.error(f"Reference embedding error: {e}")
+        raise Rejected(f'Face verification failed: {str(e)}', 500)
+
+
+def match_probe(face_result, reference_embedding):
+    """(face_distance, face_match, face_match_confidence) of the probe against the reference"""
+    probe_embedding = face_result['embedding']
+    if probe_embedding is None:
+        raise Rejected('Failed to compute face embedding')
+    try:
+        with span('match'):
+            face_distance = float(cosine_distance(probe_embedding, reference_embedding))
+    except Exception as e:
+        logger.error(f"Face verification error: {e}")
+        raise Rejected(f'Face verification failed: {str(e)}', 500)
+    face_match = bool(face_distance <= Config.FACE_MATCH_THRESHOLD)
+    return face_distance, face_match, float(max(0, min(100, 100 * (1 - face_distance / 2))))
+
+
+def complete_verification(user_id, user_data, fields, face_result, liveness_score, liveness_details,
+                          reference_embedding, attendance_id=None):
+    """Match, location and PIN factors of a live verification; records it and returns the response body"""
+    face_distance, face_match, face_match_confidence = match_probe(face_result, reference_embedding)
+    location_verified, location_message = check_location(fields['latitude'], fields['longitude'],
+                                                         fields['session_id'], fields['authorized_locations'])
+    pin_verified = check_pin(fields['pin_code'], user_data)
+    if not fields['session_id']:
+        raise Rejected('session_id is required for attendance verification')
+
+    return record_verification(
+        user_id, fields['session_id'], face_match, face_match_confidence, face_distance, True, liveness_score,
+        liveness_details, bool(location_verified), location_message, fields['pin_code'], pin_verified,
+        fields['device_id'], fields['latitude'], fields['longitude'], fields['location_id'],
+        attendance_id=attendance_id
+    )
+
+
+@app.route('/health/live', methods=['GET'])
+def liveness_probe():
+    """Process is up and serving requests"""
+    return jsonify({'status': 'alive'}), 200
+
+
+@app.route('/health/ready', methods=['GET'])
+def readiness_probe():
+    """Only ready once this worker's models are loaded and warmed up"""
+    status = readiness()
+    return jsonify(status), 200 if status['ready'] else 503
+
 
 @app.route('/login', methods=['POST'])
 def login():
@@ -91,31 +863,14 @@ def login():
                 logger.warning(f"Failed login attempt for user: {auth.username}")
                 return jsonify({'error': 'Invalid credentials'}), 401
 
-        # Generate token
-        token_expiry = datetime.utcnow() + timedelta(seconds=Config.JWT_EXPIRATION)  # Corrected datetime usage
-        token = jwt.encode(
-            {
-                'id': auth.username,
-                'name': user_data.get('fullName', ''),
-                'exp': token_expiry
-            },
-            Config.JWT_SECRET,
-            algorithm="HS256"
-        )
-        return jsonify({
-            'token': token,
-            'expires_at': token_expiry.isoformat(),
-            'user': {
-                'id': auth.username,
-                'name': user_data.get('fullName', '')
-            }
-        })
+        return jsonify(issue_token(auth.username, user_data))
     except Exception as e:
         logger.error(f"Login error: {e}")
         return jsonify({'error': 'Authentication failed'}), 500
 
 @app.route('/attendance/register', methods=['POST'])
 @token_required
+@admitted('register')
 def register_face():
     """Register a user's face for future attendance verification"""
     if 'image' not in request.files:
@@ -127,63 +882,41 @@ def register_face():
         return jsonify({'error': 'Invalid file type'}), 400
 
     try:
-        # Save and process the image
-        file_path = secure_save_file(file)
-        if not file_path:
-            return jsonify({'error': 'Failed to save image'}), 500
+        # Read and decode the image in memory, rejecting a re-submitted image before any model runs
+        image_bytes, image_format, image = load_upload(file)
+        image_hash = reject_replay(user_id, request.form.get('device_id'), image, 'register')
 
-        image = read_image(file_path)
-        if image is None:
-            return jsonify({'error': 'Failed to read image'}), 400
+        # Detect face, check liveness and compute the reference embedding once,
+        # so verification only has to embed the probe
+        face_result = analyze_registration(user_id, image)
 
-        # Detect face
-        faces, _ = detect_faces(image)
-        if len(faces) == 0:
-            return jsonify({'error': 'No face detected in image'}), 400
-        if len(faces) > 1:
-            return jsonify({'error': 'Multiple faces detected, please provide an image with only your face'}), 400
-
-        # Check liveness
-        face_img = extract_face_features(image, faces[0])
-        is_live, liveness_score = check_liveness(face_img)
-
-        if not is_live:
-            logger.warning(f"Liveness check failed for user {user_id}: score {liveness_score:.4f}")
-            return jsonify({'error': 'Liveness check failed. Please ensure you are using a real face.'}), 400
-
-        # Store the reference image in Firebase Storage
+        # Store a compact aligned crop of the face as the reference image in Firebase Storage
+        with span('reference_crop'):
+            crop_bytes = prepare_reference_face(image)
         timestamp = datetime.utcnow()
-        image_path = f"reference_faces/{user_id}/{timestamp.strftime('%Y%m%d_%H%M%S')}.jpg"
-        blob = bucket.blob(image_path)
-
-        # Upload the image
-        with open(file_path, 'rb') as img_file:
-            blob.upload_from_file(img_file)
+        reference_fields = store_registration_face(user_id, image_bytes, image_format, crop_bytes, timestamp)
 
         # Create/update user face profile in Firestore
-        db.collection('users').document(user_id).set({
-            'reference_face': image_path,
-            'reference_face_updated': timestamp,
-            'liveness_score': liveness_score,
-            'hasFacialTemplate': True,
-            'updatedAt': timestamp
-        }, merge=True)
-
-        # Cleanup
-        cleanup_files([file_path])
-
-        return jsonify({
-            'status': 'success',
-            'message': 'Face registered successfully',
-            'timestamp': timestamp.isoformat()
-        }), 200
+        try:
+            db.collection('users').document(user_id).set(
+                registration_profile(face_result, reference_fields, timestamp), merge=True)
+        except Exception:
+            abandon_registration(user_id)
+            raise
+        # Only a stored registration counts as a submission; a failed one can be retried with the same image
+        remember_submission(user_id, request.form.get('device_id'), image_hash, 'register')
+        return jsonify(complete_registration(user_id, face_result['embedding'], timestamp)), 200
 
+    except Rejected as e:
+        return jsonify(e.body), e.status
     except Exception as e:
         logger.error(f"Error in face registration: {e}")
         return jsonify({'error': f'Registration failed: {str(e)}'}), 500
 
 @app.route('/attendance/verify', methods=['POST'])
 @token_required
+@idempotent
+@admitted('verify')
 def verify_attendance():
     """Complete attendance verification with multi-factor authentication"""
     user_id = request.user['id']
@@ -192,225 +925,447 @@ def verify_attendance():
     if 'image' not in request.files:
         return jsonify({'error': 'No image file provided'}), 400
 
-    # Get location information
-    latitude = request.form.get('latitude', type=float)
-    longitude = request.form.get('longitude', type=float)
-    location_id = request.form.get('location_id')
-    # Get authorized locations from request
-    authorized_locations = []
-    # Get additional validation factors
-    pin_code = request.form.get('pin_code')
-    device_id = request.form.get('device_id')
+    # Location, session and additional validation factors
+    fields = verification_fields(request.form)
 
-    # Option 1: Parse from JSON field
-    if 'authorized_locations' in request.form:
-        try:
-            import json
-            authorized_locations = json.loads(request.form.get('authorized_locations'))
-        except Exception as e:
-            logger.warning(f"Failed to parse authorized_locations JSON: {e}")
-
-    # Option 2: Support single location for backward compatibility
-    elif 'auth_latitude' in request.form and 'auth_longitude' in request.form:
-        authorized_locations.append({
-            'latitude': request.form.get('auth_latitude', type=float),
-            'longitude': request.form.get('auth_longitude', type=float),
-            'radius': request.form.get('auth_radius', type=float, default=Config.ALLOWED_LOCATION_RADIUS),
-            'name': request.form.get('auth_name', 'Verification point')
-        })
     # Processing starts
-    temp_files = []
     try:
-        # 1. Process and validate the verification image
-        file = request.files['image']
-        file_path = secure_save_file(file)
-        temp_files.append(file_path)
+        # 1. Process and validate the verification image in memory, rejecting a replayed image before any model runs
+        _, _, verification_image = load_upload(request.files['image'])
+        image_hash = reject_replay(user_id, fields['device_id'], verification_image, 'verify',
+                                   retry_key=g.get('retry_key'), verified=False)
+
+        # Optional multi-frame liveness: a burst of 'frames' stills or a short 'clip' video
+        burst_frames = read_burst(request.files.get('clip'), request.files.getlist('frames'))
+
+        # 2. Face detection, 3. liveness detection (anti-spoofing) and probe embedding
+        face_result, liveness_score, liveness_details = analyze_verification(user_id, verification_image,
+                                                                             burst_frames, fields)
+
+        # 4. Get the user's reference face from Firestore (cached) and 5. its stored reference embedding
+        user_data = get_user_profile(user_id)
+        reference_embedding = load_reference(user_id, user_data)
+
+        # 6. Face comparison, 7. location and 8. optional PIN verification, then 9. the record
+        response = complete_verification(user_id, user_data, fields, face_result, liveness_score, liveness_details,
+                                         reference_embedding, attendance_id=g.get('attendance_id'))
+        # Only a recorded verification counts as a submission; a failed one can be retried with the same image
+        remember_submission(user_id, fields['device_id'], image_hash, 'verify', g.get('retry_key'))
+        return jsonify(response), 200
+
+    except Rejected as e:
+        return jsonify(e.body), e.status
+    except Exception as e:
+        logger.error(f"Attendance verification error: {e}")
+        return jsonify({'error': f'Attendance verification failed: {str(e)}'}), 500
+
+
+@app.route('/attendance/identify', methods=['POST'])
+@token_required
+@admitted('identify')
+def identify_attendee():
+    """Kiosk check-in: identify who is in the image among a session's enrolled students (1:N)"""
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image file provided'}), 400
+
+    session_id = request.form.get('session_id')
+    if not session_id:
+        return jsonify({'error': 'session_id is required for identification'}), 400
+    # 'session' searches the students enrolled in the session, 'institution' every registered face
+    scope = request.form.get('scope', 'session')
+    if scope not in ('session', 'institution'):
+        return jsonify({'error': "scope must be 'session' or 'institution'"}), 400
+
+    try:
+        # Identification names whoever is in the photo: never open to student tokens
+        if not can_identify(request.user['id']):
+            logger.warning(f"User {request.user['id']} is not allowed to identify attendees")
+            return jsonify({'error': 'Only kiosks, instructors and admins can identify attendees'}), 403
 
-        if not file_path:
-            return jsonify({'error': 'Failed to save image'}), 500
+        image_bytes, _, error = read_upload(request.files['image'])
+        if error:
+            return jsonify({'error': error}), 400
 
-        verification_image = read_image(file_path)
-        if verification_image is None:
+        image = decode_image(image_bytes)
+        if image is None:
             return jsonify({'error': 'Failed to read image'}), 400
 
-        # 2. Face detection
-        faces, _ = detect_faces(verification_image)
-        if len(faces) == 0:
-            return jsonify({'error': 'No face detected in verification image'}), 400
-        if len(faces) > 1:
-            return jsonify({'error': 'Multiple faces detected, please provide a clear image with only your face'}), 400
-
-        # 3. Liveness detection (anti-spoofing)
-        face_img = extract_face_features(verification_image, faces[0])
-        is_live, liveness_score = check_liveness(face_img)
-        # Convert to native Python types
-        is_live = bool(is_live)
-        liveness_score = float(liveness_score)
-
-        if not is_live:
-            logger.warning(f"Liveness check failed during verification for user {user_id}: score {liveness_score:.4f}")
-            # Log the attempt as potentially fraudulent
-            db.collection('security_events').add({
-                'user_id': user_id,
+        face_result = run_face_pipeline(image)
+        if face_result['face_count'] == 0:
+            return jsonify({'error': 'No face detected in image'}), 400
+        if face_result['face_count'] > 1:
+            return jsonify({'error': 'Multiple faces detected, please provide an image with only one face'}), 400
+
+        liveness_score = face_result['liveness_score']
+        if not face_result['is_live']:
+            logger.warning(f"Liveness check failed during identification for session {session_id}: "
+                           f"score {liveness_score:.4f}")
+            queue_writes([(new_document_path('security_events'), {
+                'user_id': None,
+                'session_id': session_id,
                 'event_type': 'liveness_check_failed',
                 'timestamp': datetime.utcnow(),
                 'liveness_score': liveness_score,
-                'device_id': device_id,
-                'latitude': float(latitude) if latitude else None,
-                'longitude': float(longitude) if longitude else None
-            })
+                'device_id': request.form.get('device_id')
+            })])
             return jsonify({
                 'error': 'Liveness check failed. Please ensure you are using a real face.',
-                'verified': False,
+                'matched': False
             }), 400
 
-        # 4. Get the user's reference face from Firestore
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
+        probe_embedding = face_result['embedding']
+        if probe_embedding is None:
+            return jsonify({'error': 'Failed to compute face embedding'}), 400
 
-        if not user_doc.exists:
-            return jsonify({'error': 'User profile not found'}), 404
+        candidates = None
+        if scope == 'session':
+            candidates = get_session_roster(session_id)
+            if candidates is None:
+                return jsonify({'error': 'Session not found'}), 404
 
-        user_data = user_doc.to_dict()
-        if 'reference_face' not in user_data:
-            return jsonify({'error': 'No reference face registered for this user'}), 400
+        with span('identify.search'):
+            embedding_index.sync()
+            matches = embedding_index.search(probe_embedding, candidates)
+        if not matches:
+            return jsonify({'error': 'No registered faces to match against'}), 404
 
-        # 5. Download reference image from Firebase Storage
-        reference_blob = bucket.blob(user_data['reference_face'])
-        reference_path = os.path.join(Config.TEMP_FOLDER, f"ref_{user_id}_{uuid.uuid4().hex}.jpg")
-        reference_blob.download_to_filename(reference_path)
-        temp_files.append(reference_path)
+        best_id, best_distance = matches[0]
+        matched = bool(best_distance <= Config.FACE_MATCH_THRESHOLD)
+        return jsonify({
+            'session_id': session_id,
+            'matched': matched,
+            'user_id': best_id if matched else None,
+            'distance': best_distance,
+            'threshold': Config.FACE_MATCH_THRESHOLD,
+            'confidence': float(max(0, min(100, 100 * (1 - best_distance / 2)))),
+            'liveness_score': liveness_score
+        }), 200
 
-        reference_image = read_image(reference_path)
-        if reference_image is None:
-            return jsonify({'error': 'Failed to read reference image'}), 500
+    except Exception as e:
+        logger.error(f"Identification error: {e}")
+        return jsonify({'error': f'Identification failed: {str(e)}'}), 500
 
-        # 6. Face comparison using DeepFace - UPDATED TO USE RETINAFACE INSTEAD OF DLIB
-        try:
-            result = DeepFace.verify(
-                face_img,
-                reference_image,
-                model_name="VGG-Face",
-                enforce_detection=False,
-                threshold=Config.FACE_MATCH_THRESHOLD,
-                detector_backend=detector_backend  # Using retinaface or mediapipe instead of dlib
-            )
-            # Convert NumPy types to Python native types
-            face_match = bool(result.get("verified", False))
-            face_distance = float(result.get("distance", 1.0))
-            face_match_confidence = float(max(0, min(100, 100 * (1 - face_distance / 2))))
+@app.route('/attendance/verify/group', methods=['POST'])
+@token_required
+@admitted('group')
+def verify_group_attendance():
+    """
+    Lecturer group check-in: match every face in one photo of the room against the session roster.
+    Only the instructor of the session's course (or an admin) may record it, from the session's location.
+    """
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image file provided'}), 400
 
-        except Exception as e:
-            logger.error(f"Face verification error: {e}")
-            return jsonify({'error': f'Face verification failed: {str(e)}'}), 500
+    session_id = request.form.get('session_id')
+    if not session_id:
+        return jsonify({'error': 'session_id is required for attendance verification'}), 400
+    recorded_by = request.user['id']
+    # The lecturer's device location stands in for everyone in the photo
+    latitude = request.form.get('latitude', type=float)
+    longitude = request.form.get('longitude', type=float)
 
+    try:
+        session = get_session(session_id)
+        if session is None:
+            return jsonify({'error': 'Session not found'}), 404
+        if not can_record_for_session(recorded_by, session):
+            logger.warning(f"User {recorded_by} is not allowed to record group attendance for session {session_id}")
+            return jsonify({'error': "Only the course's instructor can record group attendance"}), 403
+
+        # Nobody is marked present from a photo taken away from the session's location
+        location_verified, location_message = check_location(latitude, longitude, session_id, [])
+        if not location_verified:
+            return jsonify({'error': location_message, 'location_verified': False}), 400
+
+        roster = get_session_roster(session_id)
+        if roster is None:
+            return jsonify({'error': 'Session not found'}), 404
+
+        image_bytes, _, error = read_upload(request.files['image'])
+        if error:
+            return jsonify({'error': error}), 400
+
+        image = decode_image(image_bytes, min_side=Config.GROUP_DECODE_MIN_SIDE)
+        if image is None:
+            return jsonify({'error': 'Failed to read image'}), 400
+
+        # Detect and embed every face in one batched pass (faces beyond GROUP_MAX_FACES are not embedded)
+        group_result = run_face_pipeline(image, analyze=analyze_group)
+        if group_result['face_count'] == 0:
+            return jsonify({'error': 'No face detected in image'}), 400
+        if group_result['face_count'] > Config.GROUP_MAX_FACES:
+            return jsonify({'error': f'Too many faces detected (max {Config.GROUP_MAX_FACES})'}), 400
 
-        # 7. Location verification
-        location_verified, location_message = verify_location(latitude, longitude, authorized_locations)
-        location_verified = bool(location_verified)  # Ensure Python native boolean
+        faces = [face for face in group_result['faces'] if face['embedding'] is not None]
 
-        # 8. Optional PIN verification
-        pin_verified = False
-        if pin_code:
-            stored_pin_hash = user_data.get('pin_hash')
-            if stored_pin_hash:
-                pin_verified = bool(bcrypt.checkpw(pin_code.encode(), stored_pin_hash.encode()))
+        # One distance matrix for all faces against the whole roster, then one-to-one assignment
+        matches = {}
+        with span('identify.match'):
+            embedding_index.sync()
+            if faces:
+                roster_ids, distances = embedding_index.distances([face['embedding'] for face in faces], roster)
+                matches = assign_matches(distances, Config.FACE_MATCH_THRESHOLD)
 
-        # 9. Compile verification results
         timestamp = datetime.utcnow()
-        attendance_id = generate_attendance_id(user_id, timestamp)
-
-        # Get sessionId from request (required for new structure)
-        session_id = request.form.get('session_id')
-        if not session_id:
-            return jsonify({'error': 'session_id is required for attendance verification'}), 400
-
-        # Determine overall verification status with native Python types
-        verification_factors = [
-            {
-                "factor": "face_recognition",
-                "verified": bool(face_match),
-                "confidence": float(face_match_confidence)
-            },
-            {
-                "factor": "liveness",
-                "verified": bool(is_live),
-                "confidence": float(liveness_score * 100)
-            },
-            {
-                "factor": "location",
-                "verified": bool(location_verified),
-                "message": location_message
-            }
-        ]
-
-        if pin_code:
-            verification_factors.append({
-                "factor": "pin_code",
-                "verified": bool(pin_verified)
+        writes = []
+        present = []
+        for face_index, (roster_index, face_distance) in matches.items():
+            student_id = roster_ids[roster_index]
+            face_match_confidence = float(max(0, min(100, 100 * (1 - face_distance / 2))))
+            # One record per student and session, so a retried group photo overwrites instead of duplicating
+            response = record_verification(
+                student_id, session_id, True, face_match_confidence, face_distance, None, None, None,
+                True, location_message, None, None, request.form.get('device_id'), latitude, longitude, None,
+                attendance_id=idempotent_attendance_id(f"group:{session_id}:{student_id}"),
+                extra_fields={'verification_method': 'group_photo', 'recordedBy': recorded_by}, writes=writes)
+            present.append({
+                'student_id': student_id,
+                'attendance_id': response['attendance_id'],
+                'distance': face_distance,
+                'confidence': face_match_confidence,
+                'box': faces[face_index]['box']
             })
 
-        # Calculate overall verification status
-        verified = bool(face_match and is_live and location_verified)
-        if pin_code:
-            verified = bool(verified and pin_verified)
-
-        # 10. Store attendance record with new structure
-        attendance_record = {
-            'id': attendance_id,
-            'studentId': user_id,
-            'sessionId': session_id,
-            'status': 'present' if verified else 'absent',
-            'checkInTimestamp': timestamp if verified else None,
-            'overrideJustification': None,
-            'overrideBy': None,
-            'isOverridden': False,
-            'createdAt': timestamp,
-            'updatedAt': timestamp,
-            # Keep legacy fields for backward compatibility
-            'verification_factors': verification_factors,
-            'face_distance': float(face_distance),
+        # All records in a single commit
+        if writes:
+            queue_writes(writes)
+
+        unmatched = [face['box'] for i, face in enumerate(faces) if i not in matches]
+        return jsonify({
+            'session_id': session_id,
+            'timestamp': timestamp.isoformat(),
+            'face_count': group_result['face_count'],
+            'location_verified': True,
+            'present': present,
+            'unmatched_faces': unmatched,
+            'roster_size': len(roster)
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Group attendance verification error: {e}")
+        return jsonify({'error': f'Group attendance verification failed: {str(e)}'}), 500
+
+def claim_batch_item(user_id, file, item):
+    """
+    The steps a single verification of one bulk item takes before any model runs: its idempotency claim
+    (keyed like /attendance/verify, by the item's idempotency_key or its fingerprint), then the replay
+    guard. Returns the claim as a dict of key, fingerprint, state and value, plus image and image_hash
+    when this request leads. Raises Rejected, after releasing a claim it made.
+    """
+    header = item.get('idempotency_key')
+    key, fingerprint = idempotency_key(user_id, None if header is None else str(header), item.get('session_id'), file)
+    state, value = claim_idempotency(key, fingerprint) if Config.IDEMPOTENCY else (LEAD, None)
+    claim = {'key': key, 'fingerprint': fingerprint, 'state': state, 'value': value}
+    if state != LEAD:
+        return claim
+    try:
+        _, _, claim['image'] = load_upload(file)
+        claim['image_hash'] = reject_replay(user_id, item.get('device_id'), claim['image'], 'verify',
+                                            retry_key=retry_key(key, fingerprint), verified=False)
+    except Rejected as e:
+        if value is not None:
+            complete_idempotency(key, value, e.body, e.status)
+        raise
+    except BaseException as e:
+        if value is not None:
+            idempotency_cache.fail(key, value, e)
+        raise
+    return claim
+
+
+def complete_batch_item(user_id, item, claim, result, status):
+    """Remember a verified item's image and hand its result to retries, as /attendance/verify does"""
+    if status == 200:
+        remember_submission(user_id, item.get('device_id'), claim['image_hash'], 'verify',
+                            retry_key(claim['key'], claim['fingerprint']))
+    if claim['value'] is not None:
+        complete_idempotency(claim['key'], claim['value'], result, status)
+
+
+def release_batch_claims(claims, exc):
+    """Free the keys of led items that never completed, so their duplicates and retries are not stuck"""
+    for claim in claims:
+        if claim.get('state') == LEAD and claim['value'] is not None and not claim['value'].done():
+            idempotency_cache.fail(claim['key'], claim['value'], exc)
+
+
+def verify_batch_item(user_id, user_data, item, face_result, reference_embedding, location, attendance_id):
+    """Score one bulk-verification item and queue its attendance record; returns the per-item result"""
+    session_id = item.get('session_id')
+    device_id = item.get('device_id')
+    latitude, longitude = item.get('latitude'), item.get('longitude')
+    if not session_id:
+        return {'error': 'session_id is required for attendance verification'}
+    if face_result['face_count'] == 0:
+        return {'error': 'No face detected in verification image'}
+    if face_result['face_count'] > 1:
+        return {'error': 'Multiple faces detected, please provide a clear image with only your face'}
+
+    liveness_score = face_result['liveness_score']
+    if not face_result['is_live']:
+        logger.warning(f"Liveness check failed during batch verification for user {user_id}: "
+                       f"score {liveness_score:.4f}")
+        queue_writes([(new_document_path('security_events'), {
+            'user_id': user_id,
+            'event_type': 'liveness_check_failed',
+            'timestamp': datetime.utcnow(),
+            'liveness_score': liveness_score,
             'device_id': device_id,
-            'location': {
-                'latitude': float(latitude) if latitude else None,
-                'longitude': float(longitude) if longitude else None,
-                'location_id': location_id,
-                'verified': bool(location_verified),
-                'message': location_message
-            }
-        }
+            'latitude': latitude,
+            'longitude': longitude
+        })])
+        return {'error': 'Liveness check failed. Please ensure you are using a real face.', 'verified': False}
 
-        # Store record in Firestore
-        db.collection('attendance_record').document(attendance_id).set(attendance_record)
+    probe_embedding = face_result['embedding']
+    if probe_embedding is None:
+        return {'error': 'Failed to compute face embedding'}
 
-        # 11. Update user's attendance history
-        user_ref.collection('attendance_history').add({
-            'attendance_id': attendance_id,
-            'timestamp': timestamp,
-            'verified': bool(verified),
-            'location_verified': bool(location_verified)
-        })
+    face_distance = float(cosine_distance(probe_embedding, reference_embedding))
+    face_match = bool(face_distance <= Config.FACE_MATCH_THRESHOLD)
+    face_match_confidence = float(max(0, min(100, 100 * (1 - face_distance / 2))))
+    location_verified, location_message = bool(location[0]), location[1]
+    pin_code = item.get('pin_code')
 
-        # 12. Create appropriate response
-        response = {
-            'attendance_id': attendance_id,
-            'timestamp': timestamp.isoformat(),
-            'verified': bool(verified),
-            'verification_details': verification_factors
-        }
+    response = record_verification(
+        user_id, session_id, face_match, face_match_confidence, face_distance, True, liveness_score,
+        None, location_verified, location_message, pin_code, check_pin(pin_code, user_data), device_id,
+        latitude, longitude, item.get('location_id'), attendance_id=attendance_id,
+        extra_fields={'capturedAt': item.get('captured_at'), 'verification_method': 'batch'}
+    )
+    return {'session_id': session_id, **response}
 
-        # 13. Cleanup temporary files
-        cleanup_files(temp_files)
 
-        return jsonify(response), 200
+def batch_slots():
+    """A bulk verification runs up to VERIFY_BATCH_WORKERS face pipelines at once"""
+    return max(1, min(Config.VERIFY_BATCH_WORKERS, len(request.files.getlist('images'))))
+
+
+@app.route('/attendance/verify/batch', methods=['POST'])
+@token_required
+@admitted('batch', slots=batch_slots)
+def verify_attendance_batch():
+    """
+    Verify several buffered check-ins of the authenticated user in one request.
+    Expects 'images' files plus an 'items' JSON list with one entry per image (session_id,
+    latitude, longitude, device_id, optional captured_at, pin_code and idempotency_key). Results are streamed as
+    newline-delimited JSON, one line per item in completion order. Each item goes through the idempotency
+    cache and replay guard like a single verification; an item that was already verified returns its
+    original result with 'replayed': true.
+    """
+    user_id = request.user['id']
+    images = request.files.getlist('images')
+    if not images:
+        return jsonify({'error': 'No image files provided'}), 400
+    if len(images) > Config.VERIFY_BATCH_MAX_ITEMS:
+        return jsonify({'error': f'Too many images (max {Config.VERIFY_BATCH_MAX_ITEMS})'}), 400
+
+    try:
+        items = json.loads(request.form.get('items', '[]'))
+    except json.JSONDecodeError:
+        return jsonify({'error': 'items must be a JSON list'}), 400
+    if not isinstance(items, list) or len(items) != len(images) or not all(isinstance(i, dict) for i in items):
+        return jsonify({'error': 'items must have one metadata object per image'}), 400
 
+    try:
+        for item in items:
+            for key in ('latitude', 'longitude'):
+                item[key] = float(item[key]) if item.get(key) is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'latitude and longitude must be numbers'}), 400
+
+    claims = []
+    try:
+        # The user lookup and reference template are shared by every item
+        user_data = get_user_profile(user_id)
+        if user_data is None:
+            return jsonify({'error': 'User profile not found'}), 404
+        if 'reference_face' not in user_data:
+            return jsonify({'error': 'No reference face registered for this user'}), 400
+        try:
+            reference_embedding = get_reference_embedding(user_id, user_data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 500
+
+        # Read everything before streaming starts; the request body is not available afterwards.
+        # Each item is claimed and replay-checked like a single verification; only the ones it leads run.
+        for file, item in zip(images, items):
+            try:
+                claims.append(claim_batch_item(user_id, file, item))
+            except Rejected as e:
+                claims.append({'state': None, 'error': e.body})
+
+        locations = check_locations([(item['latitude'], item['longitude']) for item in items],
+                                    [item.get('session_id') for item in items],
+                                    [item.get('authorized_locations') for item in items])
+
+        executor = batch_executor.get()
+        futures = {executor.submit(run_face_pipeline, claim['image']): i
+                   for i, claim in enumerate(claims) if claim['state'] == LEAD}
     except Exception as e:
-        logger.error(f"Attendance verification error: {e}")
-        # Ensure cleanup happens even on error
-        cleanup_files(temp_files)
+        release_batch_claims(claims, e)
+        logger.error(f"Batch attendance verification error: {e}")
         return jsonify({'error': f'Attendance verification failed: {str(e)}'}), 500
 
+    def results():
+        try:
+            for i, claim in enumerate(claims):
+                if claim['state'] is None:
+                    yield json.dumps({'index': i, **claim['error']}) + '\n'
+                elif claim['state'] == REPLAY:
+                    yield json.dumps({'index': i, **claim['value'][0], 'replayed': True}) + '\n'
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    result = verify_batch_item(user_id, user_data, items[i], future.result(), reference_embedding,
+                                               locations[i], idempotent_attendance_id(claims[i]['key']))
+                    status = 400 if 'error' in result else 200
+                except Exception as e:
+                    logger.error(f"Batch attendance verification error on item {i}: {e}")
+                    result, status = {'error': f'Attendance verification failed: {str(e)}'}, 500
+                complete_batch_item(user_id, items[i], claims[i], result, status)
+                yield json.dumps({'index': i, **result}) + '\n'
+            # Duplicates of requests still running elsewhere (or earlier in this batch) wait for their result
+            for i, claim in enumerate(claims):
+                if claim['state'] != WAIT:
+                    continue
+                try:
+                    result = {**claim['value'].result(timeout=Config.IDEMPOTENCY_WAIT)[0], 'replayed': True}
+                except TimeoutError:
+                    result = {'error': 'The original request is still being processed, retry later'}
+                except Exception as e:
+                    result = {'error': f'Attendance verification failed: {str(e)}'}
+                yield json.dumps({'index': i, **result}) + '\n'
+        finally:
+            # The client went away mid-stream: items not completed yet can be retried
+            release_batch_claims(claims, ConnectionError('Batch response stream closed'))
+
+    return Response(results(), mimetype='application/x-ndjson')
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics: stage and request latency histograms, in-flight and queue-depth gauges"""
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+@app.route('/cache/stats', methods=['GET'])
+@token_required
+def cache_stats():
+    """Hit/miss counters for the in-process user profile and template caches"""
+    return jsonify({
+        'users': user_cache.stats(),
+        'templates': template_cache.stats(),
+        'sessions': session_cache.stats(),
+        'rosters': roster_cache.stats(),
+        'embedding_index': embedding_index.stats(),
+        'write_behind': write_behind.get().stats() if Config.WRITE_BEHIND else None,
+        'liveness_cascade': cascade_stats.stats(),
+        'replay_index': replay_index.stats(),
+        'admission': admission.get().stats(),
+        'idempotency': idempotency_cache.stats()
+    }), 200
+
 if __name__ == '__main__':
     # Use PORT environment variable provided by Heroku
     port = int(os.getenv('PORT', 5000))
+    start_warm_up()
     app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
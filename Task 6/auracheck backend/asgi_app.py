@@ -0,0 +1,353 @@
+"""
+ASGI serving mode. Login, register and verify are served by native async handlers: uploads are
+received without holding a thread, Firestore is read through the async client while the face
+pipeline runs, and every CPU/ML stage goes to a bounded thread pool so the event loop only waits.
+The request steps themselves are the Flask app's (application.load_upload, analyze_verification, ...).
+All other endpoints are served by the Flask app through a WSGI bridge, with unchanged contracts.
+
+    gunicorn --config gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi_app:app
+"""
+import asyncio
+import base64
+import functools
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+from a2wsgi import WSGIMiddleware
+from firebase_admin import firestore_async
+from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+import application
+from admission import Overloaded
+from application import admission, idempotency_cache, user_cache, session_cache, issue_token, shed, Rejected, \
+    idempotency_key, claim_idempotency, complete_idempotency, verification_fields, load_upload, \
+    reject_replay, remember_submission, read_burst, analyze_registration, store_registration_face, \
+    registration_profile, complete_registration, abandon_registration, analyze_verification, load_reference, \
+    complete_verification
+from config import decode_token, allowed_file, idempotent_attendance_id
+from idempotency import LEAD, REPLAY, retry_key
+from inference_scheduler import ProcessLocal
+from reference_faces import prepare_reference_face
+from livenesschech import Config, logger
+from metrics import span, submit_in_context, IN_FLIGHT, REQUEST_LATENCY, start_request_timings, \
+    request_timings, end_request_timings, server_timing_header
+
+# Firestore's asyncio client, created in each worker so its channel belongs to that worker's event loop
+async_db = ProcessLocal(lambda: firestore_async.client())
+# Decoding, face pipeline, bcrypt: bounded so in-flight uploads never oversubscribe the CPU
+ml_executor = ProcessLocal(lambda: ThreadPoolExecutor(
+    max_workers=Config.ASYNC_ML_WORKERS,
+    thread_name_prefix="async-ml"
+))
+# Blocking I/O without an asyncio client: Storage, the write-behind spool, reading spooled uploads
+io_executor = ProcessLocal(lambda: ThreadPoolExecutor(
+    max_workers=Config.ASYNC_IO_WORKERS,
+    thread_name_prefix="async-io"
+))
+
+
+def run_on(executor, fn, *args, **kwargs):
+    """Await fn(*args, **kwargs) on a thread pool, carrying the request's stage timings along"""
+    return asyncio.wrap_future(submit_in_context(executor.get(), fn, *args, **kwargs))
+
+
+def error(message, status):
+    return JSONResponse({'error': message}, status_code=status)
+
+
+def rejected_response(e):
+    return JSONResponse(e.body, status_code=e.status)
+
+
+def as_upload(value):
+    """Adapt a Starlette upload to the filename/stream interface read_upload expects"""
+    if not isinstance(value, UploadFile):
+        return None
+    return SimpleNamespace(filename=value.filename or '', stream=value.file)
+
+
+def instrumented(rule):
+    """Request metrics and Server-Timing for a native route (the Flask hooks cover bridged ones)"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            start = time.perf_counter()
+            start_request_timings()
+            IN_FLIGHT.labels(rule).inc()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                if Config.SERVER_TIMING:
+                    elapsed = time.perf_counter() - start
+                    response.headers['Server-Timing'] = server_timing_header(request_timings() + [('total', elapsed)])
+                return response
+            finally:
+                REQUEST_LATENCY.labels(rule, str(status)).observe(time.perf_counter() - start)
+                end_request_timings()
+                IN_FLIGHT.labels(rule).dec()
+        return wrapper
+    return decorator
+
+
+def token_required(handler):
+    """Async counterpart of config.token_required; the decoded token is in request.state.user"""
+    @functools.wraps(handler)
+    async def wrapper(request):
+        data, message = decode_token(request.headers.get('Authorization'))
+        if message:
+            return error(message, 401)
+        request.state.user = data
+        return await handler(request)
+    return wrapper
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def admitted(request_class):
+    """Async counterpart of application.admitted: waits for an ML slot without holding a thread"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            if not Config.ADMISSION_CONTROL:
+                return await handler(request)
+            controller = admission.get()
+            loop = asyncio.get_running_loop()
+            granted = loop.create_future()
+            try:
+                with span('admission'):
+                    waiter = controller.enter(request_class, lambda: loop.call_soon_threadsafe(_wake, granted))
+                    if waiter is not None:
+                        try:
+                            await asyncio.wait_for(granted, Config.ADMISSION_MAX_WAIT)
+                        except asyncio.TimeoutError:
+                            pass
+                        except asyncio.CancelledError:
+                            controller.abandon(waiter)
+                            raise
+                        controller.settle(waiter)
+            except Overloaded as e:
+                body, headers = shed(request_class, e)
+                return JSONResponse(body, status_code=503, headers=headers)
+
+            start = time.monotonic()
+            try:
+                return await handler(request)
+            finally:
+                controller.release(request_class, time.monotonic() - start)
+        return wrapper
+    return decorator
+
+
+def replayed_response(body, status):
+    return JSONResponse(body, status_code=status, headers={'Idempotent-Replayed': 'true'})
+
+
+def idempotent(handler):
+    """Async counterpart of application.idempotent; duplicates wait for the original on the event loop"""
+    @functools.wraps(handler)
+    async def wrapper(request):
+        form = await request.form()  # parsed once, Starlette keeps it for the handler
+        image_file = as_upload(form.get('image'))
+        if not Config.IDEMPOTENCY or image_file is None:
+            return await handler(request)
+        try:
+            # Hashing the upload reads it from Starlette's spool file; the claim itself stays on the event
+            # loop, so a cancelled request can never leave a claimed key unresolved
+            key, fingerprint = await run_on(io_executor, idempotency_key, request.state.user['id'],
+                                            request.headers.get('Idempotency-Key'), form.get('session_id'),
+                                            image_file)
+            state, value = claim_idempotency(key, fingerprint)
+        except Rejected as e:
+            return rejected_response(e)
+        if state == REPLAY:
+            return replayed_response(*value)
+        if state != LEAD:
+            try:
+                # Shielded: giving up must not cancel the original request's future
+                result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(value)), Config.IDEMPOTENCY_WAIT)
+            except asyncio.TimeoutError:
+                return error('The original request is still being processed, retry later', 409)
+            return replayed_response(*result)
+
+        request.state.attendance_id = idempotent_attendance_id(key)
+        request.state.retry_key = retry_key(key, fingerprint)
+        try:
+            response = await handler(request)
+        except BaseException as e:
+            idempotency_cache.fail(key, value, e)
+            raise
+        complete_idempotency(key, value, json.loads(response.body), response.status_code)
+        return response
+    return wrapper
+
+
+async def get_user_profile(user_id):
+    """application.get_user_profile over the async Firestore client"""
+    user_data = user_cache.get(user_id)
+    if user_data is None:
+        with span('profile'):
+            user_doc = await async_db.get().collection('users').document(user_id).get()
+        if not user_doc.exists:
+            return None
+        user_data = user_doc.to_dict()
+        user_cache.put(user_id, user_data)
+    return dict(user_data)
+
+
+async def prefetch_session(session_id):
+    """Warm the session cache check_location reads from, so it never blocks on Firestore"""
+    if not session_id or session_cache.get(session_id) is not None:
+        return
+    session_doc = await async_db.get().collection('sessions').document(session_id).get()
+    if session_doc.exists:
+        session_cache.put(session_id, session_doc.to_dict())
+
+
+def basic_auth(request):
+    """Username and password of an 'Authorization: Basic' header, or (None, None)"""
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Basic '):
+        return None, None
+    try:
+        username, _, password = base64.b64decode(header[len('Basic '):]).decode('utf-8').partition(':')
+    except (ValueError, UnicodeDecodeError):
+        return None, None
+    return username, password
+
+
+@instrumented('/login')
+async def login(request):
+    """User login to get authentication token"""
+    username, password = basic_auth(request)
+    if not username or not password:
+        return error('Missing credentials', 401)
+
+    try:
+        user = await async_db.get().collection('users').document(username).get()
+        if not user.exists:
+            logger.warning(f"Login attempt for non-existent user: {username}")
+            return error('User not found. Please register first.', 404)
+
+        user_data = user.to_dict()
+        if 'password' not in user_data or password != user_data['password']:
+            logger.warning(f"Failed login attempt for user: {username}")
+            return error('Invalid credentials', 401)
+
+        return JSONResponse(issue_token(username, user_data))
+    except Exception as e:
+        logger.error(f"Login error: {e}")
+        return error('Authentication failed', 500)
+
+
+@instrumented('/attendance/register')
+@token_required
+@admitted('register')
+async def register_face(request):
+    """Register a user's face for future attendance verification"""
+    form = await request.form()
+    file = as_upload(form.get('image'))
+    if file is None:
+        return error('No image file provided', 400)
+
+    user_id = request.state.user['id']
+    if not allowed_file(file.filename):
+        return error('Invalid file type', 400)
+
+    try:
+        image_bytes, image_format, image = await run_on(ml_executor, load_upload, file)
+        image_hash = await run_on(io_executor, reject_replay, user_id, form.get('device_id'), image, 'register')
+        face_result = await run_on(ml_executor, analyze_registration, user_id, image)
+
+        with span('reference_crop'):
+            crop_bytes = await run_on(ml_executor, prepare_reference_face, image)
+        timestamp = datetime.utcnow()
+        reference_fields = await run_on(io_executor, store_registration_face, user_id, image_bytes, image_format,
+                                        crop_bytes, timestamp)
+
+        try:
+            await async_db.get().collection('users').document(user_id).set(
+                registration_profile(face_result, reference_fields, timestamp), merge=True)
+        except Exception:
+            abandon_registration(user_id)
+            raise
+        remember_submission(user_id, form.get('device_id'), image_hash, 'register')
+        return JSONResponse(complete_registration(user_id, face_result['embedding'], timestamp))
+
+    except Rejected as e:
+        return rejected_response(e)
+    except Exception as e:
+        logger.error(f"Error in face registration: {e}")
+        return error(f'Registration failed: {str(e)}', 500)
+
+
+@instrumented('/attendance/verify')
+@token_required
+@idempotent
+@admitted('verify')
+async def verify_attendance(request):
+    """Complete attendance verification with multi-factor authentication"""
+    user_id = request.state.user['id']
+    form = await request.form()
+    image_file = as_upload(form.get('image'))
+    if image_file is None:
+        return error('No image file provided', 400)
+    fields = verification_fields(form)
+
+    # Firestore reads only depend on the request, so they run while the image is analyzed
+    profile = asyncio.ensure_future(get_user_profile(user_id))
+    session = asyncio.ensure_future(prefetch_session(fields['session_id']))
+    try:
+        _, _, verification_image = await run_on(ml_executor, load_upload, image_file)
+        image_hash = await run_on(io_executor, reject_replay, user_id, fields['device_id'], verification_image,
+                                  'verify', retry_key=getattr(request.state, 'retry_key', None), verified=False)
+        burst_frames = await run_on(io_executor, read_burst, as_upload(form.get('clip')),
+                                    [as_upload(file) for file in form.getlist('frames')])
+        face_result, liveness_score, liveness_details = await run_on(
+            ml_executor, analyze_verification, user_id, verification_image, burst_frames, fields)
+
+        user_data = await profile
+        reference_embedding = await run_on(ml_executor, load_reference, user_id, user_data)
+        await session
+        # Recording fsyncs the write-behind spool (or commits), and a geofence refresh reads Firestore:
+        # blocking I/O, so it runs on the I/O pool instead of an ML thread. Matching is one dot product
+        response = await run_on(io_executor, complete_verification, user_id, user_data, fields, face_result,
+                                liveness_score, liveness_details, reference_embedding,
+                                getattr(request.state, 'attendance_id', None))
+        remember_submission(user_id, fields['device_id'], image_hash, 'verify',
+                            getattr(request.state, 'retry_key', None))
+        return JSONResponse(response)
+
+    except Rejected as e:
+        return rejected_response(e)
+    except Exception as e:
+        logger.error(f"Attendance verification error: {e}")
+        return error(f'Attendance verification failed: {str(e)}', 500)
+    finally:
+        for task in (profile, session):
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # retrieved, so an early return does not log it as unhandled
+
+
+app = Starlette(middleware=[
+    Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
+], routes=[
+    Route('/login', login, methods=['POST']),
+    Route('/attendance/register', register_face, methods=['POST']),
+    Route('/attendance/verify', verify_attendance, methods=['POST']),
+    # Everything else (identify, group and batch verify, health, metrics, stats) through the Flask app
+    Mount('/', app=WSGIMiddleware(application.app, workers=Config.ASYNC_IO_WORKERS))
+])
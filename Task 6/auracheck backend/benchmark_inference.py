@@ -0,0 +1,67 @@
+"""
+Latency and throughput of the micro-batched inference path for different batch sizes.
+
+Usage:
+    python benchmark_inference.py --model embedding --requests 128 --concurrency 16
+"""
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from embeddings import embed_faces
+from inference_scheduler import MicroBatcher
+from livenesschech import predict_attributes
+
+BATCH_FUNCTIONS = {
+    'embedding': embed_faces,
+    'attributes': predict_attributes
+}
+
+
+def run_benchmark(batch_fn, batch_size, requests, concurrency, max_wait_ms):
+    """Drive one batcher from concurrent client threads and return per-request latencies and wall time"""
+    batcher = MicroBatcher(f"bench-{batch_size}", batch_fn, max_batch_size=batch_size, max_wait_ms=max_wait_ms)
+    face = np.random.rand(224, 224, 3).astype(np.float32)
+    latencies = []
+    lock = threading.Lock()
+
+    def client(count):
+        for _ in range(count):
+            start = time.perf_counter()
+            batcher.run(face, timeout=120)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+
+    per_client = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+    threads = [threading.Thread(target=client, args=(count,)) for count in per_client]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return np.asarray(latencies) * 1000.0, time.perf_counter() - start, batcher.stats()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark micro-batched model inference')
+    parser.add_argument('--model', choices=sorted(BATCH_FUNCTIONS), default='embedding')
+    parser.add_argument('--batch-sizes', default='1,4,8,16', help='Comma separated max batch sizes')
+    parser.add_argument('--requests', type=int, default=128)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--max-wait-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    batch_fn = BATCH_FUNCTIONS[args.model]
+    # Build the models and warm up TensorFlow before timing anything
+    batch_fn([np.zeros((224, 224, 3), dtype=np.float32)])
+
+    print(f"{'batch':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} {'mean batch':>10}")
+    for batch_size in [int(size) for size in args.batch_sizes.split(',')]:
+        latencies, wall_time, stats = run_benchmark(batch_fn, batch_size, args.requests,
+                                                    args.concurrency, args.max_wait_ms)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(f"{batch_size:>5} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f} "
+              f"{len(latencies) / wall_time:>8.1f} {stats['mean_batch_size']:>10.2f}")
@@ -0,0 +1,202 @@
+"""
+Offline benchmark of the register and verify endpoints, driven through Flask's test client
+against in-memory Firestore/Storage fakes. Reports per-stage p50/p95/p99 latency and throughput.
+
+Usage:
+    python benchmark_pipeline.py --iterations 50 --concurrency 1
+    python benchmark_pipeline.py --json results.json   # save for comparison between runs
+"""
+import argparse
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+USER_ID = 'bench-student'
+SESSION_ID = 'bench-session'
+GEOFENCE = {'name': 'Bench hall', 'latitude': 4.1537, 'longitude': 9.2920, 'radius': 100.0, 'isActive': True}
+
+# Configure before the app (and its Config) is imported: no background warm-up (the models are
+# built synchronously below), the pipeline in this process so every stage span is seen here,
+# no replay guard or idempotent replays (every request re-sends the same image) and a throwaway spool
+os.environ.setdefault('PRELOAD_MODELS', 'true')
+os.environ['FACE_PIPELINE_PROCESSES'] = '0'
+os.environ['REPLAY_GUARD'] = 'false'
+os.environ['IDEMPOTENCY'] = 'false'
+os.environ.setdefault('WRITE_SPOOL_FOLDER', tempfile.mkdtemp(prefix='bench-spool-'))
+
+import firebase_admin  # noqa: E402
+from firebase_admin import credentials, firestore, storage  # noqa: E402
+
+from firebase_fakes import FakeBucket, FakeFirestore  # noqa: E402
+
+fake_db = FakeFirestore()
+fake_bucket = FakeBucket()
+firebase_admin.initialize_app = lambda *args, **kwargs: None
+credentials.Certificate = lambda *args, **kwargs: None
+firestore.client = lambda *args, **kwargs: fake_db
+storage.bucket = lambda *args, **kwargs: fake_bucket
+
+import jwt  # noqa: E402
+
+import application  # noqa: E402
+import metrics  # noqa: E402
+from model_registry import warm_up  # noqa: E402
+from livenesschech import Config  # noqa: E402
+
+
+class StageRecorder:
+    """Thread-safe collection of per-stage durations"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.enabled = True
+
+    def record(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+
+def instrument(recorder):
+    """Record every span the app emits (the same stages exported on /metrics)"""
+    metrics.add_span_listener(recorder.record)
+
+
+def seed():
+    """Student, course enrollment, session and geofence the requests refer to"""
+    fake_db.collection('users').document(USER_ID).set({'fullName': 'Bench Student', 'password': 'bench'})
+    fake_db.collection('geofences').document('bench-hall').set(GEOFENCE)
+    fake_db.collection('sessions').document(SESSION_ID).set({'courseId': 'bench-course', 'geofenceId': 'bench-hall'})
+    fake_db.collection('enrollments').document('bench-enrollment').set({
+        'studentId': USER_ID, 'courseId': 'bench-course', 'enrolledAt': datetime.utcnow()
+    })
+
+
+def auth_header():
+    token = jwt.encode({'id': USER_ID, 'name': 'Bench Student', 'exp': datetime.utcnow() + timedelta(hours=1)},
+                       Config.JWT_SECRET, algorithm="HS256")
+    return {'Authorization': f'Bearer {token}'}
+
+
+def post_image(client, url, image_bytes, filename, form=None):
+    data = dict(form or {})
+    # A fresh stream per request; the test client consumes the file object it is given
+    data['image'] = (io.BytesIO(image_bytes), filename)
+    return client.post(url, data=data, headers=auth_header(), content_type='multipart/form-data')
+
+
+def run(recorder, endpoint, iterations, concurrency, register_bytes, verify_bytes):
+    """Send iterations requests to one endpoint from concurrency threads; returns (wall time, status counts)"""
+    lock = threading.Lock()
+    statuses = {}
+
+    def one_request(client):
+        start = time.perf_counter()
+        if endpoint == 'register':
+            response = post_image(client, '/attendance/register', register_bytes, 'register.jpg')
+        else:
+            response = post_image(client, '/attendance/verify', verify_bytes, 'verify.jpg', {
+                'session_id': SESSION_ID,
+                'latitude': GEOFENCE['latitude'],
+                'longitude': GEOFENCE['longitude'],
+                'device_id': 'bench-device'
+            })
+        recorder.record(f'request.{endpoint}', time.perf_counter() - start)
+        with lock:
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    def client_loop(count):
+        client = application.app.test_client()
+        for _ in range(count):
+            one_request(client)
+
+    per_thread = [iterations // concurrency + (1 if i < iterations % concurrency else 0) for i in range(concurrency)]
+    threads = [threading.Thread(target=client_loop, args=(count,)) for count in per_thread]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, statuses
+
+
+def summarize(recorder):
+    rows = {}
+    for stage, samples in sorted(recorder.samples.items()):
+        millis = np.asarray(samples) * 1000.0
+        p50, p95, p99 = np.percentile(millis, [50, 95, 99])
+        rows[stage] = {
+            'count': len(samples),
+            'p50_ms': float(p50),
+            'p95_ms': float(p95),
+            'p99_ms': float(p99),
+            'mean_ms': float(millis.mean()),
+            # Serial capacity of the stage: calls per second one thread could sustain
+            'ops_per_s': float(1000.0 / millis.mean()) if millis.mean() > 0 else None
+        }
+    return rows
+
+
+def print_table(title, rows, wall_time, requests):
+    print(f"\n{title}: {requests} requests in {wall_time:.2f}s ({requests / wall_time:.2f} req/s)")
+    print(f"{'stage':<22} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>9}")
+    for stage, row in rows.items():
+        ops = f"{row['ops_per_s']:.1f}" if row['ops_per_s'] else '-'
+        print(f"{stage:<22} {row['count']:>6} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} "
+              f"{row['p99_ms']:>9.1f} {ops:>9}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark register/verify against in-memory Firebase fakes')
+    parser.add_argument('--register-image', default=os.path.join(BENCH_DIR, 'abia.jpg'))
+    parser.add_argument('--verify-image', default=os.path.join(BENCH_DIR, 'belowe.jpg'))
+    parser.add_argument('--iterations', type=int, default=20, help='Requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed requests per endpoint before measuring')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Write the results to this file')
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    with open(args.register_image, 'rb') as f:
+        register_bytes = f.read()
+    with open(args.verify_image, 'rb') as f:
+        verify_bytes = f.read()
+
+    warm_up()
+    seed()
+    recorder = StageRecorder()
+    instrument(recorder)
+
+    results = {'config': vars(args), 'endpoints': {}}
+    for endpoint in ('register', 'verify'):
+        recorder.enabled = False
+        run(recorder, endpoint, args.warmup, 1, register_bytes, verify_bytes)
+        recorder.enabled = True
+        recorder.samples = {}
+
+        wall_time, statuses = run(recorder, endpoint, args.iterations, args.concurrency,
+                                  register_bytes, verify_bytes)
+        rows = summarize(recorder)
+        print_table(endpoint, rows, wall_time, args.iterations)
+        print(f"status codes: {statuses}")
+        results['endpoints'][endpoint] = {
+            'wall_seconds': wall_time,
+            'requests_per_s': args.iterations / wall_time,
+            'status_codes': statuses,
+            'stages': rows
+        }
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.json}")
@@ -1,16 +1,39 @@
 import hashlib
+import json
 import os
-import uuid
 from functools import wraps
 
 import cv2
 import jwt
 import mediapipe as mp
+import numpy as np
+from deepface import DeepFace
+from firebase_admin import credentials
 from flask import request, jsonify
-from geopy.distance import geodesic
-from werkzeug.utils import secure_filename
 
-from livenesschech import Config, logger
+from geofence_index import haversine_distances
+from inference_scheduler import ThreadLocal
+from livenesschech import Config, detector_backend, logger
+from metrics import traced
+
+
+def firebase_credentials():
+    """Service account credentials, as JSON in FIREBASE_CREDENTIALS_JSON, a path there, or the default file"""
+    cred_json = os.getenv('FIREBASE_CREDENTIALS_JSON')
+    if cred_json:
+        try:
+            # Try to parse as JSON string
+            cred = credentials.Certificate(json.loads(cred_json))
+            logger.info("Using Firebase credentials from environment variable")
+            return cred
+        except json.JSONDecodeError:
+            # If it's not valid JSON, try as a file path
+            logger.warning("Failed to parse FIREBASE_CREDENTIALS_JSON as JSON, trying as file")
+            return credentials.Certificate(cred_json)
+
+    # Fall back to file-based credentials
+    logger.info("Using Firebase credentials from file")
+    return credentials.Certificate(Config.FIREBASE_CRED_PATH)
 
 
 def verify_location(lat, lng, authorized_locations=None):
@@ -21,44 +44,53 @@ def verify_location(lat, lng, authorized_locations=None):
     if not authorized_locations or len(authorized_locations) == 0:
         return False, "No authorized locations provided"
 
-    # Check against all provided authorized locations
-    for loc in authorized_locations:
-        auth_lat = loc.get('latitude')
-        auth_lng = loc.get('longitude')
-        allowed_radius = loc.get('radius', Config.ALLOWED_LOCATION_RADIUS)
-        loc_name = loc.get('name', 'Unnamed location')
-
-        if not auth_lat or not auth_lng:
-            continue  # Skip invalid locations
-
-        # Calculate distance
-        authorized_coords = (auth_lat, auth_lng)
-        current_coords = (lat, lng)
-        distance = geodesic(authorized_coords, current_coords).meters
-
-        if distance <= allowed_radius:
-            return True, f"Within authorized radius of {loc_name} ({distance:.1f}m)"
+    # Drop invalid locations, then compute every distance in one vectorized pass
+    locations = [loc for loc in authorized_locations if loc.get('latitude') and loc.get('longitude')]
+    if not locations:
+        return False, "Not near any authorized location"
+
+    distances = haversine_distances(
+        lat, lng,
+        np.asarray([loc['latitude'] for loc in locations], dtype=np.float64),
+        np.asarray([loc['longitude'] for loc in locations], dtype=np.float64)
+    )
+    radii = np.asarray([loc.get('radius', Config.ALLOWED_LOCATION_RADIUS) for loc in locations], dtype=np.float64)
+    inside = np.flatnonzero(distances <= radii)
+    if len(inside):
+        # Report the first matching location, as the sequential check did
+        i = int(inside[0])
+        loc_name = locations[i].get('name', 'Unnamed location')
+        return True, f"Within authorized radius of {loc_name} ({distances[i]:.1f}m)"
 
     return False, "Not near any authorized location"
 
 
 
 # Security middleware
+def decode_token(authorization):
+    """
+    Validate an 'Authorization: Bearer <jwt>' header value
+    Returns: (user_data, error_message)
+    """
+    if not authorization:
+        logger.warning("Missing authentication token")
+        return None, 'Authentication token is required'
+
+    try:
+        token = authorization.split("Bearer ")[1]
+        return jwt.decode(token, Config.JWT_SECRET, algorithms=["HS256"]), None
+    except Exception as e:
+        logger.warning(f"Invalid token: {e}")
+        return None, 'Invalid or expired token'
+
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = request.headers.get('Authorization')
-        if not token:
-            logger.warning("Missing authentication token")
-            return jsonify({'error': 'Authentication token is required'}), 401
-
-        try:
-            token = token.split("Bearer ")[1]
-            data = jwt.decode(token, Config.JWT_SECRET, algorithms=["HS256"])
-            request.user = data  # Add user data to request
-        except Exception as e:
-            logger.warning(f"Invalid token: {e}")
-            return jsonify({'error': 'Invalid or expired token'}), 401
+        data, error = decode_token(request.headers.get('Authorization'))
+        if error:
+            return jsonify({'error': error}), 401
+        request.user = data  # Add user data to request
 
         return f(*args, **kwargs)
 
@@ -71,55 +103,168 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in Config.ALLOWED_IMAGE_EXTENSIONS
 
 
-def secure_save_file(file):
-    """Securely save uploaded file with sanitized filename"""
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        # Add random component to prevent filename collisions
-        unique_filename = f"{uuid.uuid4().hex}_{filename}"
-        file_path = os.path.join(Config.TEMP_FOLDER, unique_filename)
-        file.save(file_path)
-        return file_path
+# Magic bytes of the accepted image formats
+IMAGE_SIGNATURES = {
+    b'\xff\xd8\xff': 'jpeg',
+    b'\x89PNG\r\n\x1a\n': 'png'
+}
+IMAGE_CONTENT_TYPES = {'jpeg': 'image/jpeg', 'png': 'image/png', 'webp': 'image/webp'}
+IMAGE_EXTENSIONS = {'jpeg': 'jpg', 'png': 'png', 'webp': 'webp'}
+# cv2.imencode extension and quality flag of the formats reference crops can be stored in
+IMAGE_ENCODERS = {'jpeg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY), 'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY)}
+
+
+def sniff_image_format(data):
+    """Identify the image format from its leading magic bytes"""
+    for signature, image_format in IMAGE_SIGNATURES.items():
+        if data.startswith(signature):
+            return image_format
+    return None
+
+
+@traced('upload')
+def read_upload(file):
+    """
+    Read an uploaded image into memory without touching the filesystem
+    Returns: (image_bytes, image_format, error_message)
+    """
+    if not file or not allowed_file(file.filename):
+        return None, None, "Invalid file type"
+
+    # Read one byte past the limit so oversized uploads are detected without buffering them whole
+    data = file.stream.read(Config.MAX_IMAGE_SIZE + 1)
+    if len(data) > Config.MAX_IMAGE_SIZE:
+        return None, None, f"Image exceeds maximum size of {Config.MAX_IMAGE_SIZE // (1024 * 1024)}MB"
+    if not data:
+        return None, None, "Empty image file"
+
+    image_format = sniff_image_format(data)
+    if image_format is None:
+        return None, None, "Unsupported image format"
+    return data, image_format, None
+
+
+def read_clip_upload(file):
+    """
+    Read an uploaded liveness video clip into memory
+    Returns: (clip_bytes, error_message)
+    """
+    if not file or '.' not in file.filename or \
+            file.filename.rsplit('.', 1)[1].lower() not in Config.ALLOWED_CLIP_EXTENSIONS:
+        return None, "Invalid clip file type"
+
+    data = file.stream.read(Config.MAX_CLIP_SIZE + 1)
+    if len(data) > Config.MAX_CLIP_SIZE:
+        return None, f"Clip exceeds maximum size of {Config.MAX_CLIP_SIZE // (1024 * 1024)}MB"
+    if not data:
+        return None, "Empty clip file"
+    return data, None
+
+
+# Start-of-frame markers carrying the image size (every SOFn except DHT, JPG and DAC)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Reduction factor -> OpenCV flag that decodes the JPEG directly at that scale (DCT scaling)
+REDUCED_DECODE_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2
+}
+
+
+def jpeg_dimensions(data):
+    """Read (width, height) from a JPEG's frame header without decoding it; None if not found"""
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:  # markers without a length
+            i += 2
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            height = int.from_bytes(data[i + 5:i + 7], 'big')
+            width = int.from_bytes(data[i + 7:i + 9], 'big')
+            return width, height
+        i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
     return None
 
+
+@traced('decode')
+def decode_image(data, min_side=None):
+    """
+    Decode image bytes into a BGR array using OpenCV.
+    JPEGs are decoded at the largest 1/2, 1/4 or 1/8 reduction that keeps the longer side at
+    least min_side (default Config.INGEST_DECODE_MIN_SIDE), which is much cheaper than a full decode.
+    """
+    if not data:
+        return None
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    min_side = Config.INGEST_DECODE_MIN_SIDE if min_side is None else min_side
+
+    dimensions = jpeg_dimensions(data) if sniff_image_format(data) == 'jpeg' else None
+    if dimensions:
+        for factor, flag in REDUCED_DECODE_FLAGS.items():
+            if max(dimensions) // factor >= min_side:
+                return cv2.imdecode(buffer, flag)
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+
+def cap_resolution(image, max_side):
+    """
+    Downscale an image so its longer side is at most max_side.
+    Returns (image, scale) where scale maps the returned image's coordinates back to the input.
+    """
+    h, w = image.shape[:2]
+    if max(h, w) <= max_side:
+        return image, 1.0
+    scale = max(h, w) / max_side
+    return cv2.resize(image, (int(round(w / scale)), int(round(h / scale))), interpolation=cv2.INTER_AREA), scale
+
+
+def scale_box(face_rect, scale):
+    """Map an (x1, y1, x2, y2) box from a capped copy back to the full image"""
+    return tuple(int(round(v * scale)) for v in face_rect)
+
+
 def generate_attendance_id(user_id, timestamp):
     """Generate a unique attendance ID based on user and time"""
     str_to_hash = f"{user_id}-{timestamp.isoformat()}"
     return hashlib.sha256(str_to_hash.encode()).hexdigest()[:20]
 
 
-def cleanup_files(file_paths):
-    """Remove temporary files after processing"""
-    for path in file_paths:
-        if path and os.path.exists(path):
-            try:
-                os.remove(path)
-                logger.debug(f"Removed temporary file: {path}")
-            except Exception as e:
-                logger.warning(f"Failed to remove temporary file {path}: {e}")
+def idempotent_attendance_id(idempotency_key):
+    """Attendance ID of an idempotent request: every retry, on any worker, writes the same record"""
+    return hashlib.sha256(f"idempotent-{idempotency_key}".encode()).hexdigest()[:20]
 
 
-# Face detection with MediaPipe
-mp_face_detection = mp.solutions.face_detection
-face_detection = mp_face_detection.FaceDetection(
-    model_selection=1,  # 0 for close range, 1 for mid/long range
-    min_detection_confidence=0.5
-)
+def upload_digest(file):
+    """SHA-256 of an upload (up to the size limit), rewinding the stream so it can still be read"""
+    digest = hashlib.sha256()
+    remaining = Config.MAX_IMAGE_SIZE + 1
+    while remaining > 0:
+        chunk = file.stream.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            break
+        digest.update(chunk)
+        remaining -= len(chunk)
+    file.stream.seek(0)
+    return digest.hexdigest()
 
-# For face mesh (used in liveness check)
-mp_face_mesh = mp.solutions.face_mesh
-face_mesh = mp_face_mesh.FaceMesh(
-    static_image_mode=True,
-    max_num_faces=1,
-    min_detection_confidence=0.5
-)
 
+def request_fingerprint(session_id, image_digest):
+    """Identity of a verification request: which session, which image"""
+    return f"{session_id or ''}:{image_digest}"
 
 
-def read_image(file_path):
-    """Read image from file path using OpenCV"""
-    image = cv2.imread(file_path)
-    return image
+# Face detection with MediaPipe, one graph per thread since process() is not thread-safe
+mp_face_detection = mp.solutions.face_detection
+face_detection = ThreadLocal(lambda: mp_face_detection.FaceDetection(
+    model_selection=1,  # 0 for close range, 1 for mid/long range
+    min_detection_confidence=0.5
+))
 
 
 # REPLACED DLIB-BASED FACE DETECTION WITH MEDIAPIPE
@@ -127,7 +272,7 @@ def detect_faces(image):
     """Detect faces in an image using MediaPipe"""
     # Convert to RGB (MediaPipe requires RGB)
     rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    results = face_detection.process(rgb_image)
+    results = face_detection.get().process(rgb_image)
     faces = []
 
     if results.detections:
@@ -145,8 +290,8 @@ def detect_faces(image):
 
 
 # UPDATED TO WORK WITH NEW FACE DETECTION OUTPUT
-def extract_face_features(image, face_rect):
-    """Extract face area and compute features"""
+def extract_face_features(image, face_rect, max_side=None):
+    """Extract face area and compute features, downscaling the crop to max_side if it is larger"""
     x1, y1, x2, y2 = face_rect
     # Add padding to the face region
     h, w, _ = image.shape
@@ -154,4 +299,39 @@ def extract_face_features(image, face_rect):
     padding_y = int((y2 - y1) * 0.3)
     face_img = image[max(0, y1 - padding_y):min(h, y2 + padding_y),
                max(0, x1 - padding_x):min(w, x2 + padding_x)]
-    return face_img
\ No newline at end of file
+    if max_side is not None and face_img.size:
+        face_img, _ = cap_resolution(face_img, max_side)
+    return face_img
+
+
+def encode_image(image, image_format, quality):
+    """Compress a BGR image as JPEG or WebP; returns the bytes, or None if encoding failed"""
+    extension, quality_flag = IMAGE_ENCODERS[image_format]
+    ok, buffer = cv2.imencode(extension, image, [quality_flag, int(quality)])
+    return buffer.tobytes() if ok else None
+
+
+def reference_crop(image, size, margin):
+    """
+    The largest face, rotated so the eyes are level, with margin percent of context around it and
+    letterboxed to size x size. Small enough to download and decode cheaply, with enough context
+    that the face is still found when it is embedded again. Returns a BGR uint8 image or None.
+    """
+    face_objs = DeepFace.extract_faces(image, detector_backend=detector_backend, enforce_detection=False,
+                                       align=True, expand_percentage=margin)
+    # Without a detection DeepFace returns the whole image with zero confidence
+    face_objs = [obj for obj in face_objs if obj.get('confidence', 0) > 0]
+    if not face_objs:
+        return None
+    face_obj = max(face_objs, key=lambda obj: obj['facial_area']['w'] * obj['facial_area']['h'])
+    face = (face_obj['face'][:, :, ::-1] * 255).round().astype(np.uint8)  # RGB [0, 1] to BGR
+    h, w = face.shape[:2]
+    if h == 0 or w == 0:
+        return None
+
+    scale = size / max(h, w)
+    resized = cv2.resize(face, (max(1, round(w * scale)), max(1, round(h * scale))),
+                         interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC)
+    pad_y, pad_x = size - resized.shape[0], size - resized.shape[1]
+    return cv2.copyMakeBorder(resized, pad_y // 2, pad_y - pad_y // 2, pad_x // 2, pad_x - pad_x // 2,
+                              cv2.BORDER_CONSTANT, value=(0, 0, 0))
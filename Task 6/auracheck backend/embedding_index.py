@@ -0,0 +1,213 @@
+import threading
+import time
+
+import numpy as np
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from embeddings import decode_template, select_template
+from livenesschech import logger
+
+
+class EmbeddingIndex:
+    """
+    In-memory 1:N index of reference embeddings. Vectors are L2-normalised and kept
+    in one contiguous float32 matrix, so a search is a single matrix-vector product
+    (cosine distance = 1 - dot product).
+    """
+
+    def __init__(self, initial_capacity=1024):
+        self._lock = threading.RLock()
+        self._initial_capacity = initial_capacity
+        self._matrix = None
+        self._keys = []
+        self._rows = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def add(self, key, embedding):
+        """Insert or replace the embedding stored for key"""
+        vector = self._normalize(embedding)
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = np.empty((self._initial_capacity, vector.shape[0]), dtype=np.float32)
+            elif vector.shape[0] != self._matrix.shape[1]:
+                raise ValueError(f"Embedding has {vector.shape[0]} dimensions, index holds {self._matrix.shape[1]}")
+
+            row = self._rows.get(key)
+            if row is None:
+                row = len(self._keys)
+                if row == self._matrix.shape[0]:
+                    # Grow geometrically so inserts stay amortised O(1)
+                    grown = np.empty((row * 2, self._matrix.shape[1]), dtype=np.float32)
+                    grown[:row] = self._matrix[:row]
+                    self._matrix = grown
+                self._keys.append(key)
+                self._rows[key] = row
+            self._matrix[row] = vector
+
+    def remove(self, key):
+        """Remove key, moving the last row into its slot to keep the matrix contiguous"""
+        with self._lock:
+            row = self._rows.pop(key, None)
+            if row is None:
+                return False
+            last = len(self._keys) - 1
+            if row != last:
+                last_key = self._keys[last]
+                self._matrix[row] = self._matrix[last]
+                self._keys[row] = last_key
+                self._rows[last_key] = row
+            self._keys.pop()
+            return True
+
+    def search(self, embedding, candidates=None, k=1):
+        """
+        Find the k nearest stored embeddings, optionally restricted to the candidate keys.
+        Returns a list of (key, cosine_distance) sorted by distance.
+        """
+        query = self._normalize(embedding)
+        with self._lock:
+            if not self._keys:
+                return []
+            if candidates is None:
+                keys = list(self._keys)
+                distances = 1.0 - self._matrix[:len(keys)] @ query
+            else:
+                rows = [self._rows[key] for key in candidates if key in self._rows]
+                if not rows:
+                    return []
+                keys = [self._keys[row] for row in rows]
+                distances = 1.0 - self._matrix[rows] @ query
+
+        k = min(k, len(keys))
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+        return [(keys[i], float(distances[i])) for i in nearest]
+
+    def distances(self, embeddings, candidates=None):
+        """
+        Cosine distances from many probe embeddings to the stored ones in a single matrix product.
+        Returns (keys, distances) where distances[i, j] is probe i against keys[j].
+        """
+        probes = np.stack([self._normalize(embedding) for embedding in embeddings])
+        with self._lock:
+            if candidates is None:
+                keys = list(self._keys)
+                reference = self._matrix[:len(keys)] if keys else None
+            else:
+                rows = [self._rows[key] for key in candidates if key in self._rows]
+                keys = [self._keys[row] for row in rows]
+                reference = self._matrix[rows] if rows else None
+            if reference is None:
+                return [], np.empty((len(probes), 0), dtype=np.float32)
+            return keys, 1.0 - probes @ reference.T
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._keys),
+                'capacity': 0 if self._matrix is None else self._matrix.shape[0],
+                'dimensions': None if self._matrix is None else self._matrix.shape[1]
+            }
+
+
+def assign_matches(distances, threshold):
+    """
+    One-to-one assignment of probes to keys from a distance matrix: repeatedly take the closest
+    remaining pair within threshold. Returns {probe_index: (key_index, distance)}.
+    """
+    rows, cols = np.nonzero(distances <= threshold)
+    order = np.argsort(distances[rows, cols], kind='stable')
+    assigned, used = {}, set()
+    for i in order:
+        probe, key = int(rows[i]), int(cols[i])
+        if probe in assigned or key in used:
+            continue
+        assigned[probe] = (key, float(distances[probe, key]))
+        used.add(key)
+    return assigned
+
+
+class FirestoreEmbeddingIndex(EmbeddingIndex):
+    """EmbeddingIndex kept in sync with the reference templates stored on users documents"""
+
+    def __init__(self, db, sync_interval, initial_capacity=1024):
+        super().__init__(initial_capacity)
+        self.db = db
+        self.sync_interval = sync_interval
+        self._sync_lock = threading.Lock()
+        self._synced_at = None
+        self._watermark = None
+        self._stale = set()  # keys removed by invalidate(), re-read on the next sync
+
+    def sync(self, force=False):
+        """
+        Pull templates written since the last sync (everything on the first call). The watermark is the
+        server-assigned 'template_updated_at', so a write that commits late is still after it. A user whose
+        document no longer yields a current template (a face re-registered under another model, a
+        FACE_MODEL_NAME switch) is removed.
+        """
+        if not force and self._synced_at is not None and time.monotonic() - self._synced_at < self.sync_interval:
+            return
+        with self._sync_lock:
+            if not force and self._synced_at is not None and time.monotonic() - self._synced_at < self.sync_interval:
+                return
+
+            query = self.db.collection('users').select(['reference_face', 'reference_embeddings',
+                                                        'reference_embedding', 'template_updated_at'])
+            if self._watermark is not None:
+                query = query.where(filter=FieldFilter('template_updated_at', '>=', self._watermark))
+
+            loaded = removed = 0
+            for doc in query.stream():
+                data = doc.to_dict() or {}
+                if self._apply(doc.id, data):
+                    loaded += 1
+                elif self.remove(doc.id):
+                    removed += 1
+                updated = data.get('template_updated_at')
+                if updated is not None and (self._watermark is None or updated > self._watermark):
+                    self._watermark = updated
+
+            # Users invalidated since the last sync are re-read whether or not their template changed
+            with self._lock:
+                stale, self._stale = self._stale, set()
+            while stale:
+                key = stale.pop()
+                try:
+                    doc = self.db.collection('users').document(key).get()
+                except Exception:
+                    with self._lock:
+                        self._stale |= stale | {key}
+                    raise
+                if doc.exists and self._apply(key, doc.to_dict() or {}):
+                    loaded += 1
+
+            self._synced_at = time.monotonic()
+            if loaded or removed:
+                logger.info(f"Embedding index synced {loaded} templates, removed {removed} ({len(self)} total)")
+
+    def _apply(self, key, data):
+        """Index the user's current template; False (and nothing indexed) when there is none"""
+        template = select_template(data)
+        if template is None:
+            return False
+        self.add(key, decode_template(template))
+        return True
+
+    def invalidate(self, key):
+        """Stop matching key until the next sync has re-read its document"""
+        with self._lock:
+            self.remove(key)
+            self._stale.add(key)
+        self._synced_at = None
@@ -0,0 +1,120 @@
+import numpy as np
+from google.cloud.firestore_v1 import SERVER_TIMESTAMP
+
+from inference_backend import inference_backend
+from inference_scheduler import MicroBatcher
+from livenesschech import Config, align_face, detector_backend, logger
+
+
+def embed_faces(faces):
+    """Run one batched forward pass of the recognition model over aligned faces"""
+    batch = np.stack(faces).astype(np.float32)
+    embeddings = inference_backend.get().run(Config.FACE_MODEL_NAME, batch)
+    if Config.FACE_MODEL_NAME == "VGG-Face":
+        # VggFaceClient.forward L2-normalises its output; keep the batched path identical
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings / np.where(norms == 0, 1, norms)
+    return [np.asarray(embedding, dtype=np.float32) for embedding in embeddings]
+
+
+embedding_batcher = MicroBatcher("embedding", embed_faces,
+                                 max_batch_size=Config.INFERENCE_MAX_BATCH_SIZE,
+                                 max_wait_ms=Config.INFERENCE_MAX_WAIT_MS,
+                                 enabled=Config.INFERENCE_BATCHING)
+
+
+def compute_embedding(face_image):
+    """Compute the face embedding of the largest face in an image"""
+    aligned_face = align_face(face_image, inference_backend.get().input_size(Config.FACE_MODEL_NAME))
+    if aligned_face is None:
+        logger.warning("No embedding produced for face image")
+        return None
+    return embedding_batcher.run(aligned_face, timeout=Config.INFERENCE_TIMEOUT)
+
+
+def compute_embeddings(face_images):
+    """
+    Compute embeddings for many face crops with one batched forward pass.
+    Returns one entry per crop, None where no face could be aligned.
+    """
+    input_size = inference_backend.get().input_size(Config.FACE_MODEL_NAME)
+    aligned_faces = [align_face(face_image, input_size) for face_image in face_images]
+    aligned = [face for face in aligned_faces if face is not None]
+    if not aligned:
+        return [None] * len(face_images)
+
+    embeddings = iter(embed_faces(aligned))
+    return [None if face is None else next(embeddings) for face in aligned_faces]
+
+
+def build_reference_template(embedding, timestamp, model_name=None, reference_face=None):
+    """Package an embedding with the metadata needed to validate it later"""
+    embedding = np.asarray(embedding, dtype=np.float32)
+    return {
+        'version': Config.EMBEDDING_VERSION,
+        'model_name': model_name or Config.FACE_MODEL_NAME,
+        'detector_backend': detector_backend,
+        'distance_metric': Config.FACE_DISTANCE_METRIC,
+        'dimensions': int(embedding.shape[0]),
+        'dtype': 'float32',
+        # Stored as raw bytes: a single Firestore value instead of thousands of indexed array entries
+        'vector': embedding.astype('<f4').tobytes(),
+        # Storage path of the image the embedding was computed from
+        'reference_face': reference_face,
+        'created_at': timestamp
+    }
+
+
+def is_template_current(template, model_name=None, reference_face=None):
+    """
+    Check that a stored template was produced by the given (by default the current) model configuration
+    and, when reference_face is given, from that reference image
+    """
+    if not isinstance(template, dict) or not template.get('vector'):
+        return False
+    return (template.get('version') == Config.EMBEDDING_VERSION
+            and template.get('model_name') == (model_name or Config.FACE_MODEL_NAME)
+            and template.get('detector_backend') == detector_backend
+            and template.get('distance_metric') == Config.FACE_DISTANCE_METRIC
+            and (reference_face is None or template.get('reference_face') in (None, reference_face)))
+
+
+def select_template(user_data, model_name=None):
+    """
+    The user's current template for a model: from the per-model 'reference_embeddings' map, or the
+    single 'reference_embedding' field of profiles enrolled before templates were kept per model.
+    None when there is no template for this model and the user's current reference face.
+    """
+    model_name = model_name or Config.FACE_MODEL_NAME
+    reference_face = user_data.get('reference_face')
+    for template in ((user_data.get('reference_embeddings') or {}).get(model_name),
+                     user_data.get('reference_embedding')):
+        if is_template_current(template, model_name, reference_face):
+            return template
+    return None
+
+
+def template_fields(template):
+    """
+    Profile fields storing a template alongside those of other models (for a merge set). The commit
+    time is stamped on 'template_updated_at', which the embedding index syncs incrementally by.
+    """
+    return {'reference_embeddings': {template['model_name']: template}, 'template_updated_at': SERVER_TIMESTAMP}
+
+
+def decode_template(template):
+    """Decode the embedding vector stored in a reference template"""
+    embedding = np.frombuffer(template['vector'], dtype='<f4')
+    if embedding.shape[0] != template.get('dimensions', embedding.shape[0]):
+        raise ValueError("Reference embedding has unexpected dimensions")
+    return embedding
+
+
+def cosine_distance(embedding_a, embedding_b):
+    """Cosine distance between two embeddings (0 is identical)"""
+    a = np.asarray(embedding_a, dtype=np.float32)
+    b = np.asarray(embedding_b, dtype=np.float32)
+    norm = np.linalg.norm(a) * np.linalg.norm(b)
+    if norm == 0:
+        return 1.0
+    return float(1.0 - np.dot(a, b) / norm)
@@ -0,0 +1,145 @@
+"""
+Export the recognition and attribute models to ONNX, optionally quantize them to int8, and check
+that the exported models reproduce the TensorFlow path closely enough to keep stored templates valid.
+
+Needs tf2onnx and onnx at export time only (pip install tf2onnx onnx); serving needs onnxruntime.
+
+Usage:
+    python export_onnx_models.py --quantize          # export to ONNX_MODEL_DIR, fp32 and int8
+    python export_onnx_models.py --check-only --quantize --images abia.jpg belowe.jpg
+"""
+import argparse
+import itertools
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from config import decode_image
+from embeddings import cosine_distance
+from inference_backend import ATTRIBUTE_MODELS, OnnxBackend, TensorFlowBackend, onnx_model_path
+from livenesschech import Config, align_face
+
+SAMPLE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def export_model(model_name, model_dir, opset):
+    """Convert one DeepFace Keras model to ONNX with a dynamic batch dimension"""
+    import tensorflow as tf
+    import tf2onnx
+
+    model = TensorFlowBackend().load(model_name).model
+    signature = [tf.TensorSpec(model.inputs[0].shape, tf.float32, name='input')]
+    path = onnx_model_path(model_dir, model_name)
+    tf2onnx.convert.from_keras(model, input_signature=signature, opset=opset, output_path=path)
+    return path
+
+
+def quantize_model(model_name, model_dir):
+    """Dynamic int8 quantization of the weights; activations stay float and are quantized on the fly"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    path = onnx_model_path(model_dir, model_name, quantized=True)
+    quantize_dynamic(onnx_model_path(model_dir, model_name), path, weight_type=QuantType.QInt8)
+    return path
+
+
+def load_faces(image_paths, input_size, count, seed):
+    """Aligned faces from the sample images, padded with random crops up to count"""
+    faces = []
+    for path in image_paths:
+        with open(path, 'rb') as f:
+            image = decode_image(f.read())
+        face = align_face(image, input_size) if image is not None else None
+        if face is None:
+            print(f"warning: no face found in {path}")
+            continue
+        faces.append(face.astype(np.float32))
+    rng = np.random.default_rng(seed)
+    while len(faces) < count:
+        faces.append(rng.random((input_size[1], input_size[0], 3), dtype=np.float32))
+    return np.stack(faces)
+
+
+def timed_run(backend, model_name, batch, repeats=5):
+    backend.run(model_name, batch)  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        output = backend.run(model_name, batch)
+    return output, (time.perf_counter() - start) / repeats * 1000.0
+
+
+def check_parity(model_dir, quantized, image_paths, count, seed, tolerance):
+    """
+    Compare the ONNX models against TensorFlow on the same aligned faces. For the recognition model the
+    pairwise cosine distances must agree within tolerance and give the same match decisions; attribute
+    models must agree on the predicted class. Returns True when every check passes.
+    """
+    reference = TensorFlowBackend()
+    candidate = OnnxBackend(model_dir, quantized=quantized)
+    label = 'onnx-int8' if quantized else 'onnx'
+    ok = True
+
+    faces = load_faces(image_paths, reference.input_size(Config.FACE_MODEL_NAME), count, seed)
+    expected, tf_ms = timed_run(reference, Config.FACE_MODEL_NAME, faces)
+    actual, onnx_ms = timed_run(candidate, Config.FACE_MODEL_NAME, faces)
+
+    self_distances = [cosine_distance(a, b) for a, b in zip(expected, actual)]
+    pairs = list(itertools.combinations(range(len(faces)), 2))
+    deltas, flips = [], 0
+    for i, j in pairs:
+        tf_distance = cosine_distance(expected[i], expected[j])
+        onnx_distance = cosine_distance(actual[i], actual[j])
+        deltas.append(abs(tf_distance - onnx_distance))
+        flips += (tf_distance <= Config.FACE_MATCH_THRESHOLD) != (onnx_distance <= Config.FACE_MATCH_THRESHOLD)
+    max_delta = max(deltas) if deltas else 0.0
+    passed = max_delta <= tolerance and flips == 0
+    ok &= passed
+    print(f"{Config.FACE_MODEL_NAME}: tf {tf_ms:.1f} ms, {label} {onnx_ms:.1f} ms per batch of {len(faces)}")
+    print(f"  tf-vs-{label} distance of the same face: max {max(self_distances):.5f}")
+    print(f"  pairwise distance delta: max {max_delta:.5f}, mean {np.mean(deltas):.5f}; "
+          f"match decisions flipped: {flips}/{len(pairs)} -> {'PASS' if passed else 'FAIL'}")
+
+    # Attribute models see the same preprocessing as predict_attributes
+    grays = np.stack([cv2.resize(cv2.cvtColor(face, cv2.COLOR_BGR2GRAY), (48, 48)) for face in faces])
+    for model_name in ATTRIBUTE_MODELS:
+        batch = grays if model_name == 'Emotion' else faces
+        expected, tf_ms = timed_run(reference, model_name, batch)
+        actual, onnx_ms = timed_run(candidate, model_name, batch)
+        agreement = float(np.mean(np.argmax(expected, axis=1) == np.argmax(actual, axis=1)))
+        max_error = float(np.max(np.abs(expected - actual)))
+        passed = agreement == 1.0
+        ok &= passed
+        print(f"{model_name}: tf {tf_ms:.1f} ms, {label} {onnx_ms:.1f} ms; argmax agreement {agreement:.0%}, "
+              f"max abs error {max_error:.5f} -> {'PASS' if passed else 'FAIL'}")
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export, quantize and parity-check the ONNX models')
+    parser.add_argument('--model-dir', default=Config.ONNX_MODEL_DIR)
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--quantize', action='store_true', help='Also write and check int8 models')
+    parser.add_argument('--check-only', action='store_true', help='Skip the export, only run the parity check')
+    parser.add_argument('--images', nargs='*', default=[os.path.join(SAMPLE_DIR, 'abia.jpg'),
+                                                         os.path.join(SAMPLE_DIR, 'belowe.jpg')])
+    parser.add_argument('--faces', type=int, default=16, help='Faces in the parity batch')
+    parser.add_argument('--tolerance', type=float, default=0.01, help='Max pairwise cosine distance delta')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if not args.check_only:
+        os.makedirs(args.model_dir, exist_ok=True)
+        for model_name in (Config.FACE_MODEL_NAME,) + ATTRIBUTE_MODELS:
+            path = export_model(model_name, args.model_dir, args.opset)
+            print(f"exported {path} ({os.path.getsize(path) / 1e6:.1f} MB)")
+            if args.quantize:
+                path = quantize_model(model_name, args.model_dir)
+                print(f"quantized {path} ({os.path.getsize(path) / 1e6:.1f} MB)")
+
+    passed = check_parity(args.model_dir, False, args.images, args.faces, args.seed, args.tolerance)
+    if args.quantize:
+        passed &= check_parity(args.model_dir, True, args.images, args.faces, args.seed, args.tolerance)
+    sys.exit(0 if passed else 1)
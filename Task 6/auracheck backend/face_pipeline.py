@@ -0,0 +1,117 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from config import cap_resolution, detect_faces, extract_face_features, scale_box
+from embeddings import compute_embedding, compute_embeddings
+from inference_scheduler import ProcessLocal
+from livenesschech import Config, check_liveness, logger
+from metrics import span
+
+
+def analyze_face(image, check_live=True):
+    """
+    Detect -> crop -> liveness -> embed on a decoded BGR frame.
+    Returns a dict with 'face_count', 'is_live', 'liveness_score' and 'embedding'.
+    Liveness and embedding only run when exactly one face is found, and the
+    embedding only when the face is live. With check_live=False the still-image
+    liveness check is skipped (the caller establishes liveness another way).
+    """
+    result = {'face_count': 0, 'is_live': False, 'liveness_score': 0.0, 'embedding': None}
+
+    # Detect on a capped copy, then crop from the full frame at no more than the size liveness uses
+    with span('detect_faces'):
+        detection_frame, scale = cap_resolution(image, Config.DETECTION_MAX_SIDE)
+        faces, _ = detect_faces(detection_frame)
+    result['face_count'] = len(faces)
+    if len(faces) != 1:
+        return result
+
+    face_img = extract_face_features(image, scale_box(faces[0], scale), max_side=Config.FACE_CROP_MAX_SIDE)
+    if check_live:
+        with span('liveness'):
+            is_live, liveness_score = check_liveness(face_img)
+        # Convert to native Python types
+        result['is_live'] = bool(is_live)
+        result['liveness_score'] = float(liveness_score)
+    else:
+        result['is_live'] = True
+
+    if result['is_live']:
+        with span('embedding'):
+            result['embedding'] = compute_embedding(face_img)
+    return result
+
+
+def analyze_face_without_liveness(image):
+    """analyze_face for requests whose liveness comes from a frame burst or clip"""
+    return analyze_face(image, check_live=False)
+
+
+def analyze_group(image):
+    """
+    Detect every face in a group photo and embed all of them in one batched pass.
+    Returns a dict with 'face_count' and 'faces', a list of {'box', 'embedding'};
+    nothing is embedded when there are more than GROUP_MAX_FACES faces.
+    """
+    with span('detect_faces'):
+        detection_frame, scale = cap_resolution(image, Config.GROUP_DETECTION_MAX_SIDE)
+        faces, _ = detect_faces(detection_frame)
+    if len(faces) > Config.GROUP_MAX_FACES:
+        return {'face_count': len(faces), 'faces': []}
+    faces = [scale_box(face, scale) for face in faces]
+    face_images = [extract_face_features(image, face, max_side=Config.FACE_CROP_MAX_SIDE) for face in faces]
+    with span('embedding'):
+        embeddings = compute_embeddings(face_images) if face_images else []
+    return {
+        'face_count': len(faces),
+        'faces': [{'box': tuple(int(v) for v in face), 'embedding': embedding}
+                  for face, embedding in zip(faces, embeddings)]
+    }
+
+
+def _analyze_shared_frame(name, shape, dtype, analyze=analyze_face):
+    """Process-pool entry point: attach to the parent's shared-memory frame and analyze it"""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        # Copy out of the segment so no view outlives close(); still one memcpy instead of a pickle
+        image = np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+    return analyze(image)
+
+
+# Spawned rather than forked: TensorFlow and MediaPipe are not fork-safe once initialised
+pipeline_pool = ProcessLocal(lambda: ProcessPoolExecutor(
+    max_workers=Config.FACE_PIPELINE_PROCESSES,
+    mp_context=multiprocessing.get_context('spawn')
+))
+
+
+def run_face_pipeline(image, analyze=analyze_face):
+    """
+    Run analyze_face (or analyze_group) on a frame, in this thread or, when FACE_PIPELINE_PROCESSES > 0,
+    in the worker process pool with the frame handed over through shared memory
+    """
+    if Config.FACE_PIPELINE_PROCESSES <= 0:
+        return analyze(image)
+
+    image = np.ascontiguousarray(image)
+    shm = shared_memory.SharedMemory(create=True, size=image.nbytes)
+    try:
+        frame = np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)
+        frame[:] = image
+        del frame
+
+        # Stage spans of the worker process are not visible here; time the whole round trip
+        with span('face_pipeline.process_pool'):
+            future = pipeline_pool.get().submit(_analyze_shared_frame, shm.name, image.shape, image.dtype.str, analyze)
+            return future.result(timeout=Config.FACE_PIPELINE_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Face pipeline worker failed: {e}")
+        raise
+    finally:
+        shm.close()
+        shm.unlink()
@@ -0,0 +1,216 @@
+"""
+In-memory stand-ins for the parts of the Firestore and Cloud Storage clients the backend uses,
+so the API can be exercised offline (see benchmark_pipeline.py).
+"""
+import copy
+import secrets
+import string
+import threading
+from datetime import datetime, timezone
+
+from google.cloud.firestore_v1 import SERVER_TIMESTAMP
+
+AUTO_ID_ALPHABET = string.ascii_letters + string.digits
+
+OPERATORS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a is not None and a < b,
+    '<=': lambda a, b: a is not None and a <= b,
+    '>': lambda a, b: a is not None and a > b,
+    '>=': lambda a, b: a is not None and a >= b,
+    'in': lambda a, b: a in b,
+    'array_contains': lambda a, b: isinstance(a, list) and b in a
+}
+
+
+def _resolve_server_timestamps(data, now):
+    """Replace SERVER_TIMESTAMP sentinels with the commit time, as the server does"""
+    for key, value in data.items():
+        if value is SERVER_TIMESTAMP:
+            data[key] = now
+        elif isinstance(value, dict):
+            _resolve_server_timestamps(value, now)
+    return data
+
+
+def _merge(target, data):
+    """Nested maps are merged key by key, as Firestore does for set(..., merge=True)"""
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class FakeDocumentReference:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def get(self):
+        with self._db.lock:
+            return FakeSnapshot(self, copy.deepcopy(self._db.documents.get(self.path)))
+
+    def set(self, data, merge=False):
+        with self._db.lock:
+            # The sentinel is memoized so the copy keeps it, rather than a new object nothing resolves
+            data = copy.deepcopy(data, {id(SERVER_TIMESTAMP): SERVER_TIMESTAMP})
+            data = _resolve_server_timestamps(data, datetime.now(timezone.utc))
+            if merge and self.path in self._db.documents:
+                _merge(self._db.documents[self.path], data)
+            else:
+                self._db.documents[self.path] = data
+            self._db.writes += 1
+
+    def update(self, data):
+        self.set(data, merge=True)
+
+    def delete(self):
+        with self._db.lock:
+            self._db.documents.pop(self.path, None)
+            self._db.writes += 1
+
+    def collection(self, name):
+        return FakeCollectionReference(self._db, f"{self.path}/{name}")
+
+
+class FakeQuery:
+    def __init__(self, db, path, filters=(), limit=None):
+        self._db = db
+        self._path = path
+        self._filters = tuple(filters)
+        self._limit = limit
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return FakeQuery(self._db, self._path, self._filters + ((field_path, op_string, value),), self._limit)
+
+    def select(self, field_paths):
+        return self
+
+    def limit(self, count):
+        return FakeQuery(self._db, self._path, self._filters, count)
+
+    def stream(self):
+        prefix = f"{self._path}/"
+        with self._db.lock:
+            matches = [(path, copy.deepcopy(data)) for path, data in self._db.documents.items()
+                       if path.startswith(prefix) and '/' not in path[len(prefix):]]
+        results = []
+        for path, data in matches:
+            if all(OPERATORS[op](data.get(field), value) for field, op, value in self._filters):
+                results.append(FakeSnapshot(FakeDocumentReference(self._db, path), data))
+        return iter(results[:self._limit] if self._limit is not None else results)
+
+    def get(self):
+        return list(self.stream())
+
+    def on_snapshot(self, callback):
+        callback(self.get(), [], None)
+        return FakeWatch()
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, db, path):
+        super().__init__(db, path)
+        self.id = path.rsplit('/', 1)[-1]
+
+    def document(self, document_id=None):
+        if document_id is None:
+            document_id = ''.join(secrets.choice(AUTO_ID_ALPHABET) for _ in range(20))
+        return FakeDocumentReference(self._db, f"{self._path}/{document_id}")
+
+    def add(self, data):
+        reference = self.document()
+        reference.set(data)
+        return None, reference
+
+
+class FakeWatch:
+    def unsubscribe(self):
+        pass
+
+
+class FakeWriteBatch:
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append((reference, data, merge))
+
+    def commit(self):
+        with self._db.lock:
+            for reference, data, merge in self._writes:
+                reference.set(data, merge=merge)
+            self._db.commits += 1
+
+
+class FakeFirestore:
+    """Documents kept in one dict keyed by full path"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.documents = {}
+        self.writes = 0
+        self.commits = 0
+
+    def collection(self, name):
+        return FakeCollectionReference(self, name)
+
+    def document(self, path):
+        return FakeDocumentReference(self, path)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self._bucket = bucket
+        self.name = name
+
+    def upload_from_string(self, data, content_type=None):
+        with self._bucket.lock:
+            self._bucket.blobs[self.name] = (bytes(data), content_type)
+
+    def download_as_bytes(self):
+        with self._bucket.lock:
+            return self._bucket.blobs[self.name][0]
+
+    def exists(self):
+        with self._bucket.lock:
+            return self.name in self._bucket.blobs
+
+    def delete(self):
+        with self._bucket.lock:
+            self._bucket.blobs.pop(self.name, None)
+
+
+class FakeBucket:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blobs = {}
+
+    def blob(self, name):
+        return FakeBlob(self, name)
@@ -0,0 +1,165 @@
+import math
+import os
+import threading
+
+import numpy as np
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from livenesschech import Config, logger
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = 111320.0
+
+
+def haversine_distances(lat, lng, lats, lngs):
+    """Great-circle distances in meters from each point to each reference, broadcasting like numpy"""
+    lat1, lng1 = np.radians(lat), np.radians(lng)
+    lat2, lng2 = np.radians(lats), np.radians(lngs)
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+class GeofenceIndex:
+    """
+    Immutable grid index over circular geofences. Each fence is registered in every grid cell
+    its bounding box overlaps, so a lookup only computes distances to fences near the point.
+    """
+
+    def __init__(self, geofences, cell_degrees):
+        self.cell_degrees = cell_degrees
+        self.ids = [fence['id'] for fence in geofences]
+        self.names = [fence.get('name') or 'Unnamed location' for fence in geofences]
+        self.lats = np.asarray([fence['latitude'] for fence in geofences], dtype=np.float64)
+        self.lngs = np.asarray([fence['longitude'] for fence in geofences], dtype=np.float64)
+        self.radii = np.asarray([fence['radius'] for fence in geofences], dtype=np.float64)
+        self.positions = {fence_id: i for i, fence_id in enumerate(self.ids)}
+
+        cells = {}
+        for i in range(len(self.ids)):
+            lat_margin = self.radii[i] / METERS_PER_DEGREE
+            lng_margin = self.radii[i] / (METERS_PER_DEGREE * max(math.cos(math.radians(self.lats[i])), 1e-6))
+            min_row, min_col = self._cell(self.lats[i] - lat_margin, self.lngs[i] - lng_margin)
+            max_row, max_col = self._cell(self.lats[i] + lat_margin, self.lngs[i] + lng_margin)
+            for row in range(min_row, max_row + 1):
+                for col in range(min_col, max_col + 1):
+                    cells.setdefault((row, col), []).append(i)
+        self.cells = {cell: np.asarray(members, dtype=np.int64) for cell, members in cells.items()}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _cell(self, lat, lng):
+        return int(math.floor(lat / self.cell_degrees)), int(math.floor(lng / self.cell_degrees))
+
+    def candidates(self, lat, lng):
+        """Indices of the fences whose bounding box shares a grid cell with the point"""
+        return self.cells.get(self._cell(lat, lng), np.empty(0, dtype=np.int64))
+
+    def check_many(self, points, geofence_ids=None):
+        """
+        Check many (lat, lng) points at once. geofence_ids optionally restricts each point to
+        one fence (None entries search every fence). Returns one
+        (verified, message, geofence_id) tuple per point.
+        """
+        if geofence_ids is None:
+            geofence_ids = [None] * len(points)
+
+        results = [None] * len(points)
+        pending, candidate_sets = [], []
+        for i, ((lat, lng), fence_id) in enumerate(zip(points, geofence_ids)):
+            if lat is None or lng is None:
+                results[i] = (False, "Missing location data", None)
+            elif fence_id is not None:
+                position = self.positions.get(fence_id)
+                if position is None:
+                    results[i] = (False, "Session geofence is not active", None)
+                else:
+                    pending.append(i)
+                    candidate_sets.append(np.asarray([position], dtype=np.int64))
+            else:
+                pending.append(i)
+                candidate_sets.append(self.candidates(lat, lng))
+
+        union = np.unique(np.concatenate(candidate_sets)) if candidate_sets else np.empty(0, dtype=np.int64)
+        if len(union):
+            # One vectorized distance matrix between all pending points and all nearby fences
+            lats = np.asarray([points[i][0] for i in pending], dtype=np.float64)[:, None]
+            lngs = np.asarray([points[i][1] for i in pending], dtype=np.float64)[:, None]
+            distances = haversine_distances(lats, lngs, self.lats[union], self.lngs[union])
+            column = {int(position): j for j, position in enumerate(union)}
+        for row, (i, candidates) in enumerate(zip(pending, candidate_sets)):
+            if not len(candidates):
+                results[i] = (False, "Not near any authorized location", None)
+                continue
+            point_distances = distances[row, [column[int(c)] for c in candidates]]
+            inside = point_distances <= self.radii[candidates]
+            if not inside.any():
+                results[i] = (False, "Not near any authorized location", None)
+                continue
+            best = int(np.argmin(np.where(inside, point_distances, np.inf)))
+            position = int(candidates[best])
+            results[i] = (True, f"Within authorized radius of {self.names[position]} ({point_distances[best]:.1f}m)",
+                          self.ids[position])
+        return results
+
+    def check(self, lat, lng, geofence_id=None):
+        """Check one point; returns (verified, message, geofence_id)"""
+        return self.check_many([(lat, lng)], [geofence_id])[0]
+
+
+class GeofenceRegistry:
+    """
+    Active geofences from Firestore, held as a GeofenceIndex that is rebuilt whenever the
+    geofences collection changes. The listener is started lazily in each process, since
+    its background threads do not survive a gunicorn fork.
+    """
+
+    def __init__(self, db, cell_degrees):
+        self.db = db
+        self.cell_degrees = cell_degrees
+        self.index = GeofenceIndex([], cell_degrees)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._watch = None
+
+    def _query(self):
+        return self.db.collection('geofences').where(filter=FieldFilter('isActive', '==', True))
+
+    def _rebuild(self, docs):
+        geofences = []
+        for doc in docs:
+            data = doc.to_dict() or {}
+            if data.get('latitude') is None or data.get('longitude') is None:
+                continue
+            geofences.append({
+                'id': doc.id,
+                'name': data.get('name'),
+                'latitude': float(data['latitude']),
+                'longitude': float(data['longitude']),
+                'radius': float(data.get('radius') or Config.ALLOWED_LOCATION_RADIUS)
+            })
+        # Swap in a new immutable index; readers never see a partial rebuild
+        self.index = GeofenceIndex(geofences, self.cell_degrees)
+        logger.info(f"Geofence index rebuilt with {len(geofences)} active geofences")
+
+    def _on_snapshot(self, docs, changes, read_time):
+        try:
+            self._rebuild(docs)
+        except Exception as e:
+            logger.error(f"Failed to rebuild geofence index: {e}")
+
+    def ensure_started(self):
+        """Load the geofences and subscribe to changes, once per process"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._rebuild(self._query().stream())
+            self._watch = self._query().on_snapshot(self._on_snapshot)
+            self._pid = os.getpid()
+
+    def get_index(self):
+        self.ensure_started()
+        return self.index
@@ -0,0 +1,49 @@
+# Gunicorn settings. With PRELOAD_MODELS=true the app is imported once in the master, which
+# also reads the model weight files into the page cache. No model is built there: TensorFlow
+# and MediaPipe are not fork-safe once initialised, so every worker builds (and holds) its own.
+import gc
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+workers = int(os.getenv('GUNICORN_WORKERS', 1))
+# More threads than ADMISSION_SLOTS + ADMISSION_QUEUE_SIZE: ML requests wait in the app's admission
+# queue (or are shed), and login and health checks always find a free thread
+threads = int(os.getenv('GUNICORN_THREADS', 16))
+# 'uvicorn.workers.UvicornWorker' with asgi_app:app for the async serving mode
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+preload_app = os.getenv('PRELOAD_MODELS', 'false').lower() == 'true'
+
+
+def on_starting(server):
+    # With PROMETHEUS_MULTIPROC_DIR set, /metrics aggregates every worker's samples from that
+    # directory; clear values left over from a previous run
+    metrics_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+        for name in os.listdir(metrics_dir):
+            os.remove(os.path.join(metrics_dir, name))
+
+
+def pre_fork(server, worker):
+    # Move everything allocated so far out of the collector's reach, so GC passes
+    # in the workers do not touch (and copy) the preloaded pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Each worker builds and warms up its own models; the master never built any
+    from model_registry import start_warm_up
+    start_warm_up()
+
+
+def worker_exit(server, worker):
+    # Commit whatever is still queued in the write-behind spool before the worker goes away
+    from write_behind import flush_all
+    flush_all(timeout=30)
+
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,70 @@
+import threading
+from concurrent.futures import Future
+
+from cache import TTLCache
+
+# Outcomes of IdempotencyCache.claim
+REPLAY = 'replay'      # the result of a completed request with this key
+WAIT = 'wait'          # a Future for the identical request still in flight
+LEAD = 'lead'          # a Future this caller must resolve through complete() or fail()
+CONFLICT = 'conflict'  # the key was already used for a different request
+
+
+def retry_key(key, fingerprint):
+    """
+    What the replay guard recognises a retry by: the same idempotency key for the same request.
+    Kept with the image hash for REPLAY_WINDOW, so a retry after the cache's ttl is still not a replay.
+    """
+    return f"{key}|{fingerprint}"
+
+
+class IdempotencyCache:
+    """
+    Results of completed requests by idempotency key, kept for ttl seconds, plus the requests still
+    in flight, so a duplicate either replays the stored result or waits for the original to finish.
+    Every key carries the fingerprint of the request that first used it; reusing a key for a
+    different request is a conflict rather than a silent replay.
+    """
+
+    def __init__(self, max_size, ttl):
+        self._results = TTLCache(max_size, ttl)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def claim(self, key, fingerprint):
+        """(REPLAY, result), (WAIT, future), (LEAD, future) or (CONFLICT, None) for a request"""
+        with self._lock:
+            entry = self._in_flight.get(key)
+            if entry is not None:
+                if entry[0] != fingerprint:
+                    return CONFLICT, None
+                self.coalesced += 1
+                return WAIT, entry[1]
+            entry = self._results.get(key)
+            if entry is not None:
+                return (REPLAY, entry[1]) if entry[0] == fingerprint else (CONFLICT, None)
+            future = Future()
+            self._in_flight[key] = (fingerprint, future)
+            return LEAD, future
+
+    def complete(self, key, future, result, store=True):
+        """Hand the leader's result to the waiting duplicates and, with store, to later retries"""
+        with self._lock:
+            fingerprint, _ = self._in_flight.pop(key)
+            if store:
+                self._results.put(key, (fingerprint, result))
+        future.set_result(result)
+
+    def fail(self, key, future, exc):
+        """The leader raised: waiting duplicates raise too and the key is free to be retried"""
+        with self._lock:
+            self._in_flight.pop(key, None)
+        future.set_exception(exc)
+
+    def stats(self):
+        stats = self._results.stats()
+        with self._lock:
+            stats['in_flight'] = len(self._in_flight)
+            stats['coalesced'] = self.coalesced
+        return stats
@@ -0,0 +1,108 @@
+import logging
+import os
+import threading
+
+import numpy as np
+from deepface import DeepFace
+
+from inference_scheduler import ProcessLocal
+
+logger = logging.getLogger(__name__)
+
+ATTRIBUTE_MODELS = ('Emotion', 'Age', 'Gender')
+
+
+def model_task(model_name):
+    return "facial_attribute" if model_name in ATTRIBUTE_MODELS else "facial_recognition"
+
+
+def onnx_model_path(model_dir, model_name, quantized=False):
+    """File an exported model is stored in, e.g. models/onnx/VGG-Face.int8.onnx"""
+    return os.path.join(model_dir, f"{model_name}{'.int8' if quantized else ''}.onnx")
+
+
+class TensorFlowBackend:
+    """The DeepFace Keras models, run in graph mode on a whole batch"""
+
+    name = 'tensorflow'
+
+    def load(self, model_name):
+        return DeepFace.build_model(model_name, task=model_task(model_name))
+
+    def input_size(self, model_name):
+        """(width, height) the model expects its aligned faces in"""
+        input_shape = self.load(model_name).input_shape
+        return input_shape[1], input_shape[0]
+
+    def run(self, model_name, batch):
+        """One forward pass over a float32 batch; returns the model's output as an array"""
+        client = self.load(model_name)
+        if not hasattr(client.model, 'predict_on_batch'):
+            # Non-Keras models (SFace, Dlib) only expose a single-image forward
+            return np.asarray([client.forward(batch[i:i + 1]) for i in range(len(batch))])
+        return client.model(batch, training=False).numpy()
+
+
+class OnnxBackend:
+    """
+    Models exported by export_onnx_models.py, run with ONNX Runtime on the CPU.
+    With quantized=True the int8 (dynamically quantized) exports are used.
+    """
+
+    name = 'onnx'
+
+    def __init__(self, model_dir, quantized=False, threads=0):
+        import onnxruntime
+
+        self._onnxruntime = onnxruntime
+        self.model_dir = model_dir
+        self.quantized = quantized
+        self.threads = threads
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def load(self, model_name):
+        session = self._sessions.get(model_name)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(model_name)
+                if session is None:
+                    path = onnx_model_path(self.model_dir, model_name, self.quantized)
+                    if not os.path.exists(path):
+                        raise FileNotFoundError(f"No exported model at {path}; run export_onnx_models.py")
+                    options = self._onnxruntime.SessionOptions()
+                    options.intra_op_num_threads = self.threads  # 0 lets ONNX Runtime decide
+                    options.graph_optimization_level = self._onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+                    session = self._onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+                    self._sessions[model_name] = session
+                    logger.info(f"Loaded ONNX model {path}")
+        return session
+
+    def input_size(self, model_name):
+        _, height, width = self.load(model_name).get_inputs()[0].shape[:3]
+        return width, height
+
+    def run(self, model_name, batch):
+        session = self.load(model_name)
+        model_input = session.get_inputs()[0]
+        batch = np.asarray(batch, dtype=np.float32)
+        if batch.ndim == len(model_input.shape) - 1:
+            batch = batch[..., np.newaxis]  # grayscale inputs carry an explicit channel axis
+        return session.run(None, {model_input.name: batch})[0]
+
+
+def create_backend(name=None):
+    """Backend by name ('tensorflow' or 'onnx'), Config.INFERENCE_BACKEND by default"""
+    # Imported here: livenesschech itself runs its attribute models on the backend
+    from livenesschech import Config
+
+    name = name or Config.INFERENCE_BACKEND
+    if name == 'onnx':
+        return OnnxBackend(Config.ONNX_MODEL_DIR, quantized=Config.ONNX_QUANTIZED, threads=Config.ONNX_THREADS)
+    if name == 'tensorflow':
+        return TensorFlowBackend()
+    raise ValueError(f"Unknown inference backend: {name}")
+
+
+# The backend the verify and liveness paths run their models on (sessions are rebuilt after fork)
+inference_backend = ProcessLocal(create_backend)
@@ -0,0 +1,145 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    Collects inputs submitted by concurrent request threads into small batches
+    and runs each batch through batch_fn on a single worker thread.
+    batch_fn takes a list of inputs and returns a list of results in the same order.
+    When disabled, run() calls batch_fn with a batch of one on the caller's thread.
+    """
+
+    def __init__(self, name, batch_fn, max_batch_size=8, max_wait_ms=5, enabled=True):
+        self.name = name
+        self.batch_fn = batch_fn
+        self.enabled = enabled
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms) / 1000.0)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.batches = 0
+        self.items = 0
+        self.failures = 0
+
+    def submit(self, item):
+        """Queue an input and return a Future for its result"""
+        future = Future()
+        self._ensure_worker()
+        self._queue.put((item, future))
+        return future
+
+    def run(self, item, timeout=None):
+        """Queue an input and block until its batch has been processed"""
+        if not self.enabled:
+            return self.batch_fn([item])[0]
+        return self.submit(item).result(timeout=timeout)
+
+    def _ensure_worker(self):
+        # Started lazily so a preforked parent never hands a dead thread to its workers
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._worker, name=f"{self.name}-batcher", daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        """Block for the first item, then gather more until the batch is full or max_wait elapses"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = [(item, future) for item, future in self._collect()
+                     if future.set_running_or_notify_cancel()]
+            if batch:
+                self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = self.batch_fn(items)
+            if len(results) != len(items):
+                raise RuntimeError(f"{self.name} batch returned {len(results)} results for {len(items)} inputs")
+        except Exception as e:
+            logger.error(f"{self.name} batch of {len(items)} failed: {e}")
+            self.failures += 1
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.items += len(items)
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000.0,
+            'batches': self.batches,
+            'items': self.items,
+            'failures': self.failures,
+            'mean_batch_size': self.items / self.batches if self.batches else 0.0,
+            'queue_depth': self._queue.qsize()
+        }
+
+
+class ProcessLocal:
+    """
+    Builds an object lazily, once per process. Native graphs such as MediaPipe's
+    own threads that do not survive fork(), so a preforked worker must never reuse
+    the instance created in its parent.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._pid = None
+        self._instance = None
+
+    def get(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._instance = self.factory()
+                    self._pid = pid
+        return self._instance
+
+
+class ThreadLocal:
+    """
+    Builds an object lazily, once per thread and per process. For graphs such as
+    MediaPipe's FaceMesh/FaceDetection whose process() is not safe to call concurrently.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._local = threading.local()
+
+    def get(self):
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            self._local.instance = self.factory()
+            self._local.pid = pid
+        return self._local.instance
@@ -0,0 +1,177 @@
+import tempfile
+
+import cv2
+import numpy as np
+
+from config import cap_resolution, decode_image
+from livenesschech import Config, burst_face_mesh, eye_aspect_ratio, logger
+
+# Eyes close when the EAR falls below this fraction of the open-eye baseline, and count as
+# reopened (one blink) once it is back above BLINK_REOPEN_RATIO of it
+BLINK_CLOSE_RATIO = 0.7
+BLINK_REOPEN_RATIO = 0.9
+# Non-rigid landmark motion between frames, after removing translation, scale and rotation.
+# A printed photo or a still on a screen moves rigidly and stays near the noise floor.
+MOTION_NOISE_FLOOR = 0.002
+MOTION_TARGET = 0.01
+# Forehead, brows, eye corners and lids, nose, mouth corners and lips, chin, face edges
+MOTION_LANDMARKS = (10, 70, 300, 33, 133, 362, 263, 159, 145, 386, 374, 1, 4, 61, 291, 13, 14, 152, 234, 454)
+BLINK_WEIGHT = 0.6
+MOTION_WEIGHT = 0.4
+
+
+def iter_burst_frames(images):
+    """Decode a burst of still images one at a time, as they are consumed"""
+    for data in images:
+        yield decode_image(data, min_side=Config.BURST_FRAME_MAX_SIDE)
+
+
+def iter_clip_frames(data, stride):
+    """
+    Decode every stride-th frame of a video clip lazily. Skipped frames are only grabbed,
+    not decoded to pixels. OpenCV reads video from a path, so the clip is spooled to a temp file.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.clip') as clip_file:
+        clip_file.write(data)
+        clip_file.flush()
+        capture = cv2.VideoCapture(clip_file.name)
+        try:
+            index = 0
+            while True:
+                if index % stride:
+                    if not capture.grab():
+                        break
+                else:
+                    ok, frame = capture.read()
+                    if not ok:
+                        break
+                    yield frame
+                index += 1
+        finally:
+            capture.release()
+
+
+def _normalized_shape(landmarks):
+    """Motion landmarks centred and scaled to unit norm, so only their relative layout remains"""
+    points = np.asarray([(landmarks[i].x, landmarks[i].y) for i in MOTION_LANDMARKS], dtype=np.float64)
+    points -= points.mean(axis=0)
+    norm = np.linalg.norm(points)
+    return points / norm if norm > 0 else points
+
+
+def _nonrigid_motion(previous, current):
+    """RMS landmark displacement left after the best rotation of previous onto current (Procrustes)"""
+    u, _, vt = np.linalg.svd(previous.T @ current)
+    rotation = u @ vt
+    return float(np.sqrt(((previous @ rotation - current) ** 2).sum(axis=1).mean()))
+
+
+class BurstLivenessScorer:
+    """Incremental blink and micro-motion evidence over the frames of a burst or clip"""
+
+    def __init__(self):
+        self.frames = 0
+        self.face_frames = 0
+        self.blinks = 0
+        self._open_ear = None
+        self._eyes_closed = False
+        self._previous_shape = None
+        self._motion = []
+
+    def update(self, landmarks):
+        """Add one frame's FaceMesh landmarks (None when no face was found)"""
+        self.frames += 1
+        if landmarks is None:
+            self._previous_shape = None
+            return
+        self.face_frames += 1
+
+        ear = eye_aspect_ratio(landmarks)
+        if self._open_ear is None:
+            self._open_ear = ear
+        elif not self._eyes_closed and ear < self._open_ear * BLINK_CLOSE_RATIO:
+            self._eyes_closed = True
+        elif self._eyes_closed and ear > self._open_ear * BLINK_REOPEN_RATIO:
+            self._eyes_closed = False
+            self.blinks += 1
+        if not self._eyes_closed:
+            # Track the open-eye baseline slowly so a half-closed frame does not drag it down
+            self._open_ear = 0.8 * self._open_ear + 0.2 * max(ear, self._open_ear * BLINK_CLOSE_RATIO)
+
+        shape = _normalized_shape(landmarks)
+        if self._previous_shape is not None:
+            self._motion.append(_nonrigid_motion(self._previous_shape, shape))
+        self._previous_shape = shape
+
+    @property
+    def motion(self):
+        return float(np.median(self._motion)) if self._motion else 0.0
+
+    def score(self):
+        blink_score = 1.0 if self.blinks else 0.0
+        motion_score = min(1.0, max(0.0, (self.motion - MOTION_NOISE_FLOOR) / (MOTION_TARGET - MOTION_NOISE_FLOOR)))
+        return BLINK_WEIGHT * blink_score + MOTION_WEIGHT * motion_score
+
+    def decided(self):
+        """True once more frames cannot change the outcome enough to matter"""
+        if self.frames < Config.BURST_MIN_FRAMES:
+            return False
+        if self.face_frames < self.frames / 2:
+            return True  # the face keeps disappearing; fail without reading the rest
+        return self.blinks > 0 and len(self._motion) >= Config.BURST_MIN_FRAMES - 1 \
+            and self.score() >= Config.LIVENESS_THRESHOLD
+
+    def details(self):
+        return {
+            'frames': self.frames,
+            'face_frames': self.face_frames,
+            'blinks': self.blinks,
+            'micro_motion': self.motion
+        }
+
+
+def check_burst_liveness(frames):
+    """
+    Liveness over a short burst of frames (any iterable of BGR images, consumed lazily).
+    Only FaceMesh landmarks, tracked across frames, run per frame; stops as soon as the decision is confident.
+    Returns: (is_live, confidence_score, details, face_frames) where face_frames are the first and last
+    frames a face was found in, for the caller to check they show the person being verified.
+    """
+    scorer = BurstLivenessScorer()
+    early_exit = False
+    face_frames = []
+    try:
+        mesh = burst_face_mesh.get()
+        mesh.reset()
+        for frame in frames:
+            if frame is None or frame.size == 0:
+                scorer.update(None)
+            else:
+                frame, _ = cap_resolution(frame, Config.BURST_FRAME_MAX_SIDE)
+                result = mesh.process(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                landmarks = result.multi_face_landmarks[0].landmark if result.multi_face_landmarks else None
+                scorer.update(landmarks)
+                if landmarks is not None:
+                    face_frames = face_frames[:1] + [frame]
+
+            if scorer.decided():
+                early_exit = True
+                break
+            if scorer.frames >= Config.BURST_MAX_FRAMES:
+                break
+    except Exception as e:
+        logger.error(f"Burst liveness check error: {str(e)}")
+        return False, 0.0, scorer.details(), []
+    finally:
+        # Release the clip's capture and temp file even when stopping early
+        close = getattr(frames, 'close', None)
+        if close:
+            close()
+
+    final_score = scorer.score() if scorer.face_frames >= scorer.frames / 2 else 0.0
+    is_live = scorer.frames >= Config.BURST_MIN_FRAMES and final_score >= Config.LIVENESS_THRESHOLD
+    details = scorer.details()
+    details['early_exit'] = early_exit
+    logger.info(f"Burst liveness completed: Score={final_score:.4f}, Frames={scorer.frames}, "
+                f"Blinks={scorer.blinks}, Result={'PASS' if is_live else 'FAIL'}")
+    return is_live, final_score, details, face_frames
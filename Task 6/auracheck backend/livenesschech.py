@@ -1,13 +1,21 @@
 import concurrent.futures
 import logging
+import threading
+import time
 
 import mediapipe as mp
 import cv2
 from deepface import DeepFace
+from deepface.models.demography import Age, Emotion, Gender
+from deepface.modules import preprocessing
 import numpy as np
 import os
 from dotenv import load_dotenv
 
+from inference_backend import inference_backend
+from inference_scheduler import MicroBatcher, ProcessLocal, ThreadLocal
+from metrics import LIVENESS_STAGE_SKIPS, submit_in_context, timed
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -34,27 +42,266 @@ detector_backend = "retinaface"  # Can be: opencv, ssd, mtcnn, dlib, retinaface,
 class Config:
     ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg'}
     MAX_IMAGE_SIZE = 10 * 1024 * 1024  # 10MB
-    FACE_MATCH_THRESHOLD = 0.2  # Lower is stricter
+    # Recognition model, and the cosine distance threshold tuned for each supported one (lower is stricter).
+    # Users hold a template per model, so switching models only needs reenroll_templates.py beforehand.
+    FACE_MODEL_NAME = os.getenv('FACE_MODEL_NAME', "VGG-Face")
+    FACE_MATCH_THRESHOLDS = {'VGG-Face': 0.2, 'Facenet512': 0.3, 'ArcFace': 0.68, 'SFace': 0.593}
+    FACE_MATCH_THRESHOLD = float(os.getenv('FACE_MATCH_THRESHOLD', FACE_MATCH_THRESHOLDS.get(FACE_MODEL_NAME, 0.2)))
+    FACE_DISTANCE_METRIC = "cosine"
+    EMBEDDING_VERSION = 1  # Bump to invalidate stored reference embeddings
     LIVENESS_THRESHOLD = 0.65  # Higher is stricter
     ALLOWED_LOCATION_RADIUS = 100  # meters
-    TEMP_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app_temp')
     MODELS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
     JWT_SECRET = os.getenv('JWT_SECRET', '@PowerUB.org')
     JWT_EXPIRATION = 3600  # 1 hour
+    # In-process caches for user profiles and decoded reference templates
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 2048))
+    USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 60))  # seconds
+    TEMPLATE_CACHE_TTL = int(os.getenv('TEMPLATE_CACHE_TTL', 3600))  # seconds
+    # Cross-request micro-batching of model inference. The batch size and wait defaults are untuned
+    # starting points, not measured optima: tune them per host with benchmark_inference.py
+    INFERENCE_BATCHING = os.getenv('INFERENCE_BATCHING', 'true').lower() == 'true'
+    INFERENCE_MAX_BATCH_SIZE = int(os.getenv('INFERENCE_MAX_BATCH_SIZE', 8))
+    INFERENCE_MAX_WAIT_MS = float(os.getenv('INFERENCE_MAX_WAIT_MS', 5))
+    INFERENCE_TIMEOUT = 30  # seconds
+    # Import the app in the gunicorn master (--preload) and prefetch the weight files there; every
+    # worker still builds its own models after fork, since TensorFlow/MediaPipe graphs are not fork-safe
+    PRELOAD_MODELS = os.getenv('PRELOAD_MODELS', 'false').lower() == 'true'
+    # Shared liveness analysis pool and per-stage deadlines (seconds from submission)
+    LIVENESS_WORKERS = int(os.getenv('LIVENESS_WORKERS', 4))
+    LIVENESS_STAGE_TIMEOUTS = {
+        'attributes': float(os.getenv('LIVENESS_ATTRIBUTES_TIMEOUT', 20)),
+        'landmarks': float(os.getenv('LIVENESS_LANDMARKS_TIMEOUT', 5)),
+        'texture': float(os.getenv('LIVENESS_TEXTURE_TIMEOUT', 2))
+    }
+    # Run the cheap liveness stages first and skip the CNN stages when the outcome is already decided
+    LIVENESS_CASCADE = os.getenv('LIVENESS_CASCADE', 'true').lower() == 'true'
+    # Model runtime: 'tensorflow' (DeepFace/Keras) or 'onnx' (exports from export_onnx_models.py,
+    # optionally int8-quantized)
+    INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'tensorflow')
+    ONNX_MODEL_DIR = os.getenv('ONNX_MODEL_DIR', os.path.join(os.environ["DEEPFACE_HOME"], 'onnx'))
+    ONNX_QUANTIZED = os.getenv('ONNX_QUANTIZED', 'false').lower() == 'true'
+    ONNX_THREADS = int(os.getenv('ONNX_THREADS', 0))
+    # Run detect -> liveness -> embed in a pool of worker processes (0 runs it in the request thread)
+    FACE_PIPELINE_PROCESSES = int(os.getenv('FACE_PIPELINE_PROCESSES', 0))
+    FACE_PIPELINE_TIMEOUT = 60  # seconds
+    # Ingest: JPEGs are decoded at reduced scale down to this longer side, faces are detected on a
+    # copy capped at DETECTION_MAX_SIDE and crops are kept no larger than FACE_CROP_MAX_SIDE
+    INGEST_DECODE_MIN_SIDE = int(os.getenv('INGEST_DECODE_MIN_SIDE', 1280))
+    DETECTION_MAX_SIDE = int(os.getenv('DETECTION_MAX_SIDE', 640))
+    FACE_CROP_MAX_SIDE = 640  # check_liveness works at 640px at most
+    # Group photos keep full resolution: faces across a room are small
+    GROUP_DECODE_MIN_SIDE = 100000
+    GROUP_DETECTION_MAX_SIDE = int(os.getenv('GROUP_DETECTION_MAX_SIDE', 1920))
+    # Multi-frame liveness from a burst of stills or a short clip
+    ALLOWED_CLIP_EXTENSIONS = {'mp4', 'webm', 'mov'}
+    MAX_CLIP_SIZE = 20 * 1024 * 1024  # 20MB
+    BURST_MIN_FRAMES = int(os.getenv('BURST_MIN_FRAMES', 8))
+    BURST_MAX_FRAMES = int(os.getenv('BURST_MAX_FRAMES', 60))
+    BURST_FRAME_MAX_SIDE = 480
+    BURST_CLIP_STRIDE = int(os.getenv('BURST_CLIP_STRIDE', 2))  # analyze every n-th clip frame
+    # 1:N identification: how often to pull new templates into the in-memory index, and roster caching
+    EMBEDDING_INDEX_SYNC_INTERVAL = int(os.getenv('EMBEDDING_INDEX_SYNC_INTERVAL', 60))  # seconds
+    ROSTER_CACHE_TTL = int(os.getenv('ROSTER_CACHE_TTL', 300))  # seconds
+    IDENTIFY_ROLES = ('kiosk', 'instructor', 'admin')  # roles allowed to call /attendance/identify
+    GROUP_MAX_FACES = 50  # Keeps a group check-in within one Firestore batch (500 writes)
+    # Grid cell size of the server-side geofence index (0.01 degrees is about 1.1 km)
+    GEOFENCE_CELL_DEGREES = float(os.getenv('GEOFENCE_CELL_DEGREES', 0.01))
+    # Bulk verification: items per request and how many run through the face pipeline at once
+    VERIFY_BATCH_MAX_ITEMS = int(os.getenv('VERIFY_BATCH_MAX_ITEMS', 20))
+    VERIFY_BATCH_WORKERS = int(os.getenv('VERIFY_BATCH_WORKERS', 4))
+    # Write-behind for attendance, history and security-event writes: durably spooled, committed in batches
+    WRITE_BEHIND = os.getenv('WRITE_BEHIND', 'true').lower() == 'true'
+    WRITE_SPOOL_FOLDER = os.getenv('WRITE_SPOOL_FOLDER',
+                                   os.path.join(os.path.dirname(os.path.abspath(__file__)), 'write_spool'))
+    WRITE_BEHIND_MAX_WAIT_MS = float(os.getenv('WRITE_BEHIND_MAX_WAIT_MS', 20))
+    WRITE_BEHIND_MAX_BATCH = 400  # writes per commit (Firestore allows 500)
+    WRITE_BEHIND_FSYNC = os.getenv('WRITE_BEHIND_FSYNC', 'true').lower() == 'true'
+    # ASGI serving mode (asgi_app.py): threads for CPU/ML stages and for blocking Storage/spool I/O
+    ASYNC_ML_WORKERS = int(os.getenv('ASYNC_ML_WORKERS', 2))
+    ASYNC_IO_WORKERS = int(os.getenv('ASYNC_IO_WORKERS', 32))
+    # Add a per-request Server-Timing header with the stage breakdown
+    SERVER_TIMING = os.getenv('SERVER_TIMING', 'false').lower() == 'true'
+    # Registration stores a small aligned face crop as the reference; the original upload can be
+    # kept in a cold-storage archive
+    REFERENCE_CROP_SIZE = int(os.getenv('REFERENCE_CROP_SIZE', 224))
+    REFERENCE_CROP_MARGIN = 40  # percent of the face box kept around it
+    REFERENCE_CROP_FORMAT = os.getenv('REFERENCE_CROP_FORMAT', 'jpeg')  # jpeg or webp
+    REFERENCE_CROP_QUALITY = int(os.getenv('REFERENCE_CROP_QUALITY', 90))
+    REFERENCE_ARCHIVE_ORIGINALS = os.getenv('REFERENCE_ARCHIVE_ORIGINALS', 'false').lower() == 'true'
+    REFERENCE_ARCHIVE_PREFIX = 'reference_originals'
+    REFERENCE_ARCHIVE_STORAGE_CLASS = os.getenv('REFERENCE_ARCHIVE_STORAGE_CLASS', 'ARCHIVE')
+    # Replay pre-filter: before any model runs, reject an image whose perceptual hash is within
+    # REPLAY_MAX_DISTANCE bits of one the same user or device submitted in the last REPLAY_WINDOW seconds
+    REPLAY_GUARD = os.getenv('REPLAY_GUARD', 'true').lower() == 'true'
+    REPLAY_HASH = os.getenv('REPLAY_HASH', 'dhash')  # dhash or phash (slower, more robust to edits)
+    REPLAY_MAX_DISTANCE = int(os.getenv('REPLAY_MAX_DISTANCE', 3))  # of 64 bits
+    REPLAY_WINDOW = int(os.getenv('REPLAY_WINDOW', 12 * 3600))  # seconds
+    REPLAY_HASHES_PER_KEY = 16
+    REPLAY_MAX_KEYS = int(os.getenv('REPLAY_MAX_KEYS', 20000))
+    # Admission control in front of the ML endpoints: requests running at once, how many may queue,
+    # and the projected wait beyond which a request is shed with 503 + Retry-After. Lower priority
+    # values are served first; login and health checks are never queued.
+    ADMISSION_CONTROL = os.getenv('ADMISSION_CONTROL', 'true').lower() == 'true'
+    ADMISSION_SLOTS = int(os.getenv('ADMISSION_SLOTS', 2))
+    ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', 8))
+    ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', 10))  # seconds
+    ADMISSION_PRIORITIES = {'verify': 0, 'identify': 0, 'register': 1, 'group': 1, 'batch': 2}
+    ADMISSION_INITIAL_SERVICE_TIME = 3.0  # seconds per request until one has been observed
+    # Idempotent verify: responses by Idempotency-Key header, or by (user, session_id, image digest),
+    # replayed to retries for IDEMPOTENCY_TTL seconds; a duplicate of a request still running waits
+    # up to IDEMPOTENCY_WAIT seconds for its result
+    IDEMPOTENCY = os.getenv('IDEMPOTENCY', 'true').lower() == 'true'
+    IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 900))  # seconds
+    IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 4096))
+    IDEMPOTENCY_WAIT = float(os.getenv('IDEMPOTENCY_WAIT', 90))  # seconds
+    IDEMPOTENCY_KEY_MAX_LENGTH = 255
     # Firebase configuration
     FIREBASE_CRED_PATH = os.getenv('FIREBASE_CREDENTIALS_JSON', 'firebase.json')
+    FIREBASE_STORAGE_BUCKET = "powerub-795a1.appspot.com"
 
 mp_face_mesh = mp.solutions.face_mesh
-face_mesh = mp_face_mesh.FaceMesh(
+# One graph per thread: FaceMesh.process() is not safe to call concurrently
+face_mesh = ThreadLocal(lambda: mp_face_mesh.FaceMesh(
     static_image_mode=True,
     max_num_faces=1,
     min_detection_confidence=0.5
-)
+))
+# Video mode for bursts and clips: landmarks are tracked from frame to frame instead of re-detected,
+# which is faster and steadier; reset before each burst so no track carries over from the last one
+burst_face_mesh = ThreadLocal(lambda: mp_face_mesh.FaceMesh(
+    static_image_mode=False,
+    max_num_faces=1,
+    min_detection_confidence=0.5,
+    min_tracking_confidence=0.5
+))
+
+# Long-lived, bounded pool for the liveness sub-analyses (rebuilt after fork)
+liveness_executor = ProcessLocal(lambda: concurrent.futures.ThreadPoolExecutor(
+    max_workers=Config.LIVENESS_WORKERS,
+    thread_name_prefix="liveness"
+))
+
+
+# Weight of each score in the final liveness average
+LIVENESS_WEIGHTS = {'emotion': 0.25, 'ear': 0.2, 'symmetry': 0.2, 'age': 0.15, 'texture': 0.2}
+# Lowest and highest value each attribute-stage score can take. The dominant of seven emotion
+# probabilities is at least 1/7; analyze_emotion caps it at 0.95 and analyze_demographics returns 0.6 or 0.8.
+ATTRIBUTE_SCORE_BOUNDS = {'emotion': (1 / 7, 0.95), 'age': (0.6, 0.8)}
+
+
+class CascadeStats:
+    """How often the liveness cascade decided early and skipped the attribute stage"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checks = 0
+        self.skipped = {'pass': 0, 'fail': 0}
+
+    def record(self, skipped_outcome=None):
+        with self._lock:
+            self.checks += 1
+            if skipped_outcome:
+                self.skipped[skipped_outcome] += 1
+        if skipped_outcome:
+            LIVENESS_STAGE_SKIPS.labels('attributes', skipped_outcome).inc()
+
+    def stats(self):
+        with self._lock:
+            skipped = sum(self.skipped.values())
+            return {
+                'checks': self.checks,
+                'attributes_skipped_pass': self.skipped['pass'],
+                'attributes_skipped_fail': self.skipped['fail'],
+                'attributes_skip_rate': skipped / self.checks if self.checks else 0.0
+            }
+
+
+cascade_stats = CascadeStats()
+
+
+def score_bounds(partial_scores):
+    """Lowest and highest final liveness score reachable given the scores computed so far"""
+    low = high = sum(LIVENESS_WEIGHTS[name] * score for name, score in partial_scores.items())
+    for name, (lower, upper) in ATTRIBUTE_SCORE_BOUNDS.items():
+        if name not in partial_scores:
+            low += LIVENESS_WEIGHTS[name] * lower
+            high += LIVENESS_WEIGHTS[name] * upper
+    total = sum(LIVENESS_WEIGHTS.values())
+    return low / total, high / total
+
+
+# FaceMesh indices of the six contour points of each eye used for the eye aspect ratio
+LEFT_EYE_LANDMARKS = (362, 385, 387, 263, 373, 380)
+RIGHT_EYE_LANDMARKS = (33, 160, 158, 133, 153, 144)
+
+
+def euclidean_dist(p1, p2):
+    return ((p1.x - p2.x) ** 2 + (p1.y - p2.y) ** 2) ** 0.5
+
+
+def eye_aspect_ratio(landmarks):
+    """Mean Eye Aspect Ratio of both eyes from FaceMesh landmarks; drops towards 0 as the eyes close"""
+    def calculate_ear(indices):
+        eye_pts = [landmarks[i] for i in indices]
+        v1 = euclidean_dist(eye_pts[1], eye_pts[5])
+        v2 = euclidean_dist(eye_pts[2], eye_pts[4])
+        h = euclidean_dist(eye_pts[0], eye_pts[3])
+        return (v1 + v2) / (2.0 * h)
+
+    return (calculate_ear(LEFT_EYE_LANDMARKS) + calculate_ear(RIGHT_EYE_LANDMARKS)) / 2.0
+
+
+def align_face(image, target_size):
+    """
+    Detect and align the largest face in an image and resize it to a model input size.
+    Returns a float32 BGR array in [0, 1], the same preprocessing DeepFace applies internally.
+    """
+    face_objs = DeepFace.extract_faces(image, detector_backend=detector_backend,
+                                       enforce_detection=False, align=True)
+    if not face_objs:
+        return None
+    face_obj = max(face_objs, key=lambda obj: obj['facial_area']['w'] * obj['facial_area']['h'])
+    face = face_obj['face'][:, :, ::-1]  # RGB to BGR
+    if face.shape[0] == 0 or face.shape[1] == 0:
+        return None
+    return preprocessing.resize_image(img=face, target_size=target_size)[0]
+
+
+def predict_attributes(faces):
+    """Run one batched forward pass of the emotion, age and gender models over aligned faces"""
+    batch = np.stack(faces).astype(np.float32)
+    backend = inference_backend.get()
+
+    grays = np.stack([cv2.resize(cv2.cvtColor(face, cv2.COLOR_BGR2GRAY), (48, 48)) for face in batch])
+    emotion_predictions = backend.run("Emotion", grays.astype(np.float32))
+    age_predictions = backend.run("Age", batch)
+    gender_predictions = backend.run("Gender", batch)
+
+    # Same output shape as DeepFace.analyze
+    results = []
+    for emotions, ages, genders in zip(emotion_predictions, age_predictions, gender_predictions):
+        results.append({
+            'emotion': {label: 100 * p / emotions.sum() for label, p in zip(Emotion.labels, emotions)},
+            'dominant_emotion': Emotion.labels[int(np.argmax(emotions))],
+            'age': int(Age.find_apparent_age(ages)),
+            'gender': {label: 100 * p for label, p in zip(Gender.labels, genders)},
+            'dominant_gender': Gender.labels[int(np.argmax(genders))]
+        })
+    return results
+
+
+attribute_batcher = MicroBatcher("attributes", predict_attributes,
+                                 max_batch_size=Config.INFERENCE_MAX_BATCH_SIZE,
+                                 max_wait_ms=Config.INFERENCE_MAX_WAIT_MS,
+                                 enabled=Config.INFERENCE_BATCHING)
 
 
 def check_liveness(face_image):
     """
-    Multi-factor liveness detection and anti-spoofing check
+    Multi-factor liveness detection and anti-spoofing check.
+    With Config.LIVENESS_CASCADE the landmark and texture scores come first; when they already
+    settle the outcome the attribute models are skipped and the score is the bound that decided it.
     Returns: (is_live, confidence_score)
     """
     try:
@@ -65,11 +312,6 @@ def check_liveness(face_image):
             logger.error("Invalid input: face_image is None or empty")
             return False, 0.0
 
-        # Check if required dependencies are available
-        if 'face_mesh' not in globals():
-            logger.error("Required dependency 'face_mesh' not initialized")
-            return False, 0.0
-
         # Resize image for better performance if it's too large
         max_dimension = 640
         h, w = face_image.shape[:2]
@@ -82,13 +324,22 @@ def check_liveness(face_image):
         rgb_image = cv2.cvtColor(face_image, cv2.COLOR_BGR2RGB)
 
         # Define individual analysis functions to run in parallel
-        def analyze_emotion():
+        def analyze_attributes():
+            # One detection/alignment pass shared by the emotion, age and gender models,
+            # batched with concurrent requests
+            try:
+                aligned_face = align_face(face_image, (224, 224))
+                if aligned_face is None:
+                    return None
+                return attribute_batcher.run(aligned_face, timeout=Config.INFERENCE_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"Facial attribute analysis failed: {e}")
+                return None
+
+        def analyze_emotion(attributes):
             try:
-                emotion_analysis = DeepFace.analyze(face_image, actions=['emotion'],
-                                                    enforce_detection=False,
-                                                    detector_backend=detector_backend)
-                dominant_emotion = emotion_analysis[0]['dominant_emotion']
-                emotion_score = emotion_analysis[0]['emotion'][dominant_emotion] / 100
+                dominant_emotion = attributes['dominant_emotion']
+                emotion_score = attributes['emotion'][dominant_emotion] / 100
                 normalized_score = min(emotion_score, 0.95)
                 logger.debug(f"Emotion analysis score: {normalized_score:.4f}")
                 return normalized_score
@@ -98,7 +349,7 @@ def check_liveness(face_image):
 
         def analyze_landmarks():
             try:
-                result = face_mesh.process(rgb_image)
+                result = face_mesh.get().process(rgb_image)
 
                 if not result.multi_face_landmarks:
                     logger.debug("No face landmarks detected")
@@ -107,24 +358,7 @@ def check_liveness(face_image):
                 landmarks = result.multi_face_landmarks[0].landmark
 
                 # Calculate Eye Aspect Ratio (EAR)
-                def euclidean_dist(p1, p2):
-                    return ((p1.x - p2.x) ** 2 + (p1.y - p2.y) ** 2) ** 0.5
-
-                def calculate_ear(eye_pts):
-                    v1 = euclidean_dist(eye_pts[1], eye_pts[5])
-                    v2 = euclidean_dist(eye_pts[2], eye_pts[4])
-                    h = euclidean_dist(eye_pts[0], eye_pts[3])
-                    return (v1 + v2) / (2.0 * h)
-
-                # Eye landmark indices
-                left_eye_pts = [landmarks[362], landmarks[385], landmarks[387],
-                                landmarks[263], landmarks[373], landmarks[380]]
-                right_eye_pts = [landmarks[33], landmarks[160], landmarks[158],
-                                 landmarks[133], landmarks[153], landmarks[144]]
-
-                left_ear = calculate_ear(left_eye_pts)
-                right_ear = calculate_ear(right_eye_pts)
-                avg_ear = (left_ear + right_ear) / 2.0
+                avg_ear = eye_aspect_ratio(landmarks)
 
                 ear_score = min(1.0, max(0.0, (avg_ear - 0.15) / 0.15))
                 logger.debug(f"Eye aspect ratio score: {ear_score:.4f}")
@@ -151,14 +385,11 @@ def check_liveness(face_image):
                 logger.warning(f"Landmark analysis failed: {e}")
                 return 0.5, 0.5
 
-        def analyze_demographics():
+        def analyze_demographics(attributes):
             try:
-                demographics = DeepFace.analyze(face_image, actions=['age', 'gender'],
-                                                enforce_detection=False,
-                                                detector_backend=detector_backend)
-                if demographics and len(demographics) > 0:
+                if attributes:
                     # Non-integer age values are more natural for real faces
-                    age = demographics[0]['age']
+                    age = attributes['age']
                     age_confidence = 0.8 if (age % 1 != 0) else 0.6
                     logger.debug(f"Age analysis confidence: {age_confidence:.4f}")
                     return age_confidence
@@ -188,26 +419,60 @@ def check_liveness(face_image):
                 logger.warning(f"Texture analysis failed: {e}")
                 return 0.6
 
-        # Execute analyses in parallel
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            # Start all tasks
-            emotion_future = executor.submit(analyze_emotion)
-            landmarks_future = executor.submit(analyze_landmarks)
-            demographics_future = executor.submit(analyze_demographics)
-            texture_future = executor.submit(analyze_texture)
-
-            # Get results with timeout to prevent hanging
-            emotion_score = emotion_future.result(timeout=3000)
-            ear_score, symmetry_score = landmarks_future.result(timeout=3000)
-            age_confidence = demographics_future.result(timeout=3000)
-            texture_score = texture_future.result(timeout=3000)
-
-        # Compile scores
-        scores = [emotion_score, ear_score, symmetry_score, age_confidence, texture_score]
-
-        # Calculate final liveness score as weighted average
-        weights = [0.25, 0.2, 0.2, 0.15, 0.2]  # Adjust weights based on reliability of each factor
-        final_score = sum(s * w for s, w in zip(scores, weights)) / sum(weights)
+        executor = liveness_executor.get()
+
+        def collect(futures):
+            # Each stage gets its own deadline, counted from submission so pool queueing is included
+            submitted_at = time.monotonic()
+            results = {}
+            for stage, future in futures.items():
+                remaining = submitted_at + Config.LIVENESS_STAGE_TIMEOUTS[stage] - time.monotonic()
+                try:
+                    results[stage] = future.result(timeout=max(0.0, remaining))
+                except concurrent.futures.TimeoutError:
+                    for pending in futures.values():
+                        pending.cancel()
+                    raise concurrent.futures.TimeoutError(
+                        f"{stage} analysis exceeded {Config.LIVENESS_STAGE_TIMEOUTS[stage]}s deadline")
+            return results
+
+        cheap_stages = {
+            'landmarks': submit_in_context(executor, timed('liveness.landmarks', analyze_landmarks)),
+            'texture': submit_in_context(executor, timed('liveness.texture', analyze_texture))
+        }
+        if not Config.LIVENESS_CASCADE:
+            # Everything in parallel on the shared pool
+            cheap_stages['attributes'] = submit_in_context(executor, timed('liveness.attributes', analyze_attributes))
+        results = collect(cheap_stages)
+
+        ear_score, symmetry_score = results['landmarks']
+        scores = {'ear': ear_score, 'symmetry': symmetry_score, 'texture': results['texture']}
+
+        # Cascade: the CNN attribute stage only runs if its scores could still change the outcome
+        skipped_outcome = None
+        if 'attributes' not in results:
+            low, high = score_bounds(scores)
+            if low >= Config.LIVENESS_THRESHOLD:
+                skipped_outcome, final_score = 'pass', low
+            elif high < Config.LIVENESS_THRESHOLD:
+                skipped_outcome, final_score = 'fail', high
+            else:
+                results.update(collect({
+                    'attributes': submit_in_context(executor, timed('liveness.attributes', analyze_attributes))
+                }))
+        cascade_stats.record(skipped_outcome)
+
+        if skipped_outcome:
+            logger.debug(f"Liveness decided without attribute analysis: {skipped_outcome} "
+                         f"(bounds {low:.4f}-{high:.4f})")
+        else:
+            attributes = results['attributes']
+            scores['emotion'] = analyze_emotion(attributes)
+            scores['age'] = analyze_demographics(attributes)
+
+            # Calculate final liveness score as weighted average
+            final_score = sum(LIVENESS_WEIGHTS[name] * score for name, score in scores.items()) / \
+                sum(LIVENESS_WEIGHTS.values())
 
         # Decision threshold - adjustable based on security requirements
         is_live = final_score >= Config.LIVENESS_THRESHOLD
@@ -0,0 +1,116 @@
+import contextvars
+import functools
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import REGISTRY, multiprocess
+
+# Seconds; covers a ~1ms geofence check up to a slow cold-start liveness pass
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_LATENCY = Histogram('auracheck_stage_seconds', 'Latency of one pipeline stage',
+                          ['stage'], buckets=LATENCY_BUCKETS)
+REQUEST_LATENCY = Histogram('auracheck_request_seconds', 'End-to-end latency of an API request',
+                            ['endpoint', 'status'], buckets=LATENCY_BUCKETS)
+IN_FLIGHT = Gauge('auracheck_requests_in_flight', 'Requests currently being handled',
+                  ['endpoint'], multiprocess_mode='livesum')
+LIVENESS_STAGE_SKIPS = Counter('auracheck_liveness_stage_skipped_total',
+                               'Liveness stages skipped because the outcome was already decided',
+                               ['stage', 'outcome'])
+REPLAYS_REJECTED = Counter('auracheck_replays_rejected_total',
+                           'Submissions rejected as near-duplicates of a recent image',
+                           ['endpoint', 'key'])
+REQUESTS_SHED = Counter('auracheck_requests_shed_total', 'Requests rejected by admission control',
+                        ['request_class', 'reason'])
+QUEUE_DEPTH = Gauge('auracheck_queue_depth', 'Items waiting in an internal queue',
+                    ['queue'], multiprocess_mode='livesum')
+
+# Stage timings of the request being handled, for the Server-Timing header
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+_queues = {}
+_span_listeners = []
+
+
+@contextmanager
+def span(stage):
+    """Time a block, record it in the stage histogram and in the current request's timings"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_LATENCY.labels(stage).observe(elapsed)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+        for listener in _span_listeners:
+            listener(stage, elapsed)
+
+
+def add_span_listener(listener):
+    """Call listener(stage, seconds) for every finished span (used by the offline benchmark)"""
+    _span_listeners.append(listener)
+
+
+def timed(stage, fn):
+    """Wrap fn so every call is recorded as a span"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with span(stage):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def traced(stage):
+    """Decorator form of timed"""
+    return lambda fn: timed(stage, fn)
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """executor.submit that carries the caller's request timings into the worker thread"""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def start_request_timings():
+    """Begin collecting spans for the current request"""
+    _request_timings.set([])
+
+
+def request_timings():
+    """Spans recorded so far for the current request"""
+    return list(_request_timings.get() or [])
+
+
+def end_request_timings():
+    _request_timings.set(None)
+
+
+def server_timing_header(timings):
+    """Format spans as a Server-Timing header value (durations in milliseconds)"""
+    return ', '.join(f"{stage};dur={elapsed * 1000.0:.1f}" for stage, elapsed in timings)
+
+
+def track_queue(name, depth_fn):
+    """Register a callable reporting a queue's current depth, sampled by update_queue_depths"""
+    _queues[name] = depth_fn
+
+
+def update_queue_depths():
+    for name, depth_fn in _queues.items():
+        try:
+            QUEUE_DEPTH.labels(name).set(depth_fn())
+        except Exception:
+            pass
+
+
+def render_metrics():
+    """Exposition text for /metrics; aggregates every worker when PROMETHEUS_MULTIPROC_DIR is set"""
+    update_queue_depths()
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,133 @@
+"""
+Replace existing full-resolution reference faces with the compact aligned crops registration now
+stores. With REFERENCE_ARCHIVE_ORIGINALS=true each original is first copied to the cold archive.
+
+A user is skipped once their reference is a crop, so the command can be re-run (or resumed with
+--start-after) at any time. The profile update is conditional on the document not having changed
+since it was read, so a concurrent re-registration is never overwritten.
+
+Usage:
+    REFERENCE_ARCHIVE_ORIGINALS=true python migrate_reference_faces.py --workers 8
+    python migrate_reference_faces.py --dry-run --limit 100     # report the savings only
+"""
+import argparse
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import firebase_admin
+from firebase_admin import firestore, storage
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from config import decode_image, firebase_credentials, sniff_image_format
+from livenesschech import Config, logger
+from reenroll_templates import stream_users
+from reference_faces import ALIGNED_CROP, prepare_reference_face, store_reference_face
+
+
+class MigrationStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {'migrated': 0, 'already_cropped': 0, 'no_face': 0, 'changed': 0, 'failed': 0}
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+    def add(self, outcome, bytes_before=0, bytes_after=0):
+        with self._lock:
+            self.counts[outcome] += 1
+            self.bytes_before += bytes_before
+            self.bytes_after += bytes_after
+
+
+def migrate_user(db, bucket, snapshot, delete_originals, dry_run, stats):
+    user_id = snapshot.id
+    data = snapshot.to_dict() or {}
+    if data.get('reference_face_format') == ALIGNED_CROP:
+        stats.add('already_cropped')
+        return
+    old_path = data['reference_face']
+
+    try:
+        original = bucket.blob(old_path).download_as_bytes()
+        image_format = sniff_image_format(original) or 'jpeg'
+        image = decode_image(original)
+        crop_bytes = prepare_reference_face(image) if image is not None else None
+        if crop_bytes is None:
+            logger.warning(f"No face could be cropped from {old_path}; keeping it")
+            stats.add('no_face')
+            return
+        if dry_run:
+            stats.add('migrated', len(original), len(crop_bytes))
+            return
+
+        stem = f"{os.path.splitext(old_path[len('reference_faces/'):])[0]}_aligned" \
+            if old_path.startswith('reference_faces/') else f"{user_id}/{os.path.basename(old_path)}_aligned"
+        fields = store_reference_face(bucket, stem, original, image_format, crop_bytes)
+
+        # Templates computed from the original stay valid for the crop: repoint their source, including
+        # the single 'reference_embedding' of profiles enrolled before templates were kept per model
+        updates = dict(fields)
+        templates = [(('reference_embeddings', model_name), template)
+                     for model_name, template in (data.get('reference_embeddings') or {}).items()]
+        templates.append((('reference_embedding',), data.get('reference_embedding')))
+        for field, template in templates:
+            if isinstance(template, dict) and template.get('reference_face') == old_path:
+                updates[FieldPath(*field, 'reference_face').to_api_repr()] = fields['reference_face']
+                updates['template_updated_at'] = firestore.SERVER_TIMESTAMP
+        try:
+            snapshot.reference.update(updates, option=db.write_option(last_update_time=snapshot.update_time))
+        except Exception as e:
+            # The profile changed underneath us (e.g. the user registered again); drop the new blobs
+            logger.warning(f"Profile of {user_id} changed during migration, skipped: {e}")
+            for path in (fields['reference_face'], fields['reference_face_original']):
+                if path:
+                    bucket.blob(path).delete()
+            stats.add('changed')
+            return
+
+        if delete_originals and old_path != fields['reference_face']:
+            bucket.blob(old_path).delete()
+        stats.add('migrated', len(original), len(crop_bytes))
+    except Exception as e:
+        logger.error(f"Migrating reference face of {user_id} failed: {e}")
+        stats.add('failed')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replace reference faces with compact aligned crops')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--start-after', help='Resume after this user id')
+    parser.add_argument('--limit', type=int, help='Stop after this many users with a reference face')
+    parser.add_argument('--delete-originals', action='store_true',
+                        help='Delete each original from reference_faces/ once migrated')
+    parser.add_argument('--dry-run', action='store_true', help='Only crop and report the size reduction')
+    args = parser.parse_args()
+
+    if args.delete_originals and not Config.REFERENCE_ARCHIVE_ORIGINALS:
+        logger.warning("Deleting originals without REFERENCE_ARCHIVE_ORIGINALS: they will not be kept anywhere")
+
+    firebase_admin.initialize_app(firebase_credentials(), {'storageBucket': Config.FIREBASE_STORAGE_BUCKET})
+    db, bucket = firestore.client(), storage.bucket()
+    stats = MigrationStats()
+
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="migrate") as executor:
+        window, seen, last_user_id = deque(), 0, args.start_after
+        for snapshot in stream_users(db, ['reference_face', 'reference_face_format', 'reference_embeddings'],
+                                     args.start_after):
+            if not (snapshot.to_dict() or {}).get('reference_face'):
+                continue
+            if args.limit and seen >= args.limit:
+                break
+            seen += 1
+            window.append((snapshot.id, executor.submit(migrate_user, db, bucket, snapshot,
+                                                        args.delete_originals, args.dry_run, stats)))
+            if len(window) >= args.workers * 4:
+                last_user_id, future = window.popleft()
+                future.result()
+        for last_user_id, future in window:
+            future.result()
+
+    reduction = stats.bytes_before / stats.bytes_after if stats.bytes_after else 0.0
+    print(f"{stats.counts}; {stats.bytes_before / 1e6:.1f} MB -> {stats.bytes_after / 1e6:.1f} MB "
+          f"({reduction:.1f}x smaller); resume with --start-after {last_user_id}")
@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+
+import numpy as np
+from deepface import DeepFace
+
+from config import detect_faces
+from embeddings import compute_embedding
+from inference_backend import ATTRIBUTE_MODELS, inference_backend
+from livenesschech import Config, check_liveness, detector_backend, logger
+
+# Files the DeepFace and exported ONNX models are built from
+WEIGHT_EXTENSIONS = ('.h5', '.keras', '.onnx', '.pb', '.tflite', '.dat')
+
+_status_lock = threading.Lock()
+_status = {
+    'pid': None,
+    'state': 'cold',  # cold -> warming -> ready | failed
+    'warmup_seconds': None,
+    'error': None
+}
+
+
+def prefetch_model_files():
+    """
+    Read every weight file once, so each worker's load_models() finds them in the page cache instead
+    of on disk. Only bytes are touched: TensorFlow, ONNX Runtime and MediaPipe are not fork-safe once
+    their graphs are built, so the gunicorn master must not build any. Workers build their own after fork.
+    """
+    start = time.monotonic()
+    total = 0
+    for folder in {os.environ['DEEPFACE_HOME'], Config.ONNX_MODEL_DIR}:
+        for root, _, files in os.walk(folder):
+            for name in files:
+                if name.endswith(WEIGHT_EXTENSIONS):
+                    with open(os.path.join(root, name), 'rb') as weights:
+                        while chunk := weights.read(16 * 1024 * 1024):
+                            total += len(chunk)
+    logger.info(f"Prefetched {total / 1e6:.0f} MB of model weights in {time.monotonic() - start:.1f}s")
+
+
+def load_models():
+    """Build every model used by the verify and liveness paths, in this process (never the gunicorn master)"""
+    start = time.monotonic()
+    backend = inference_backend.get()
+    for model_name in (Config.FACE_MODEL_NAME,) + ATTRIBUTE_MODELS:
+        backend.load(model_name)
+    DeepFace.build_model(detector_backend, task="face_detector")
+    logger.info(f"Models loaded on the {backend.name} backend in {time.monotonic() - start:.1f}s")
+
+
+def warm_up():
+    """Run one inference through every stage so the first real request does not pay for lazy setup"""
+    load_models()
+
+    dummy_image = np.random.randint(0, 255, (224, 224, 3), dtype=np.uint8)
+    detect_faces(dummy_image)
+    compute_embedding(dummy_image)
+    check_liveness(dummy_image)
+
+
+def _warm_up_worker():
+    start = time.monotonic()
+    try:
+        warm_up()
+    except Exception as e:
+        logger.error(f"Model warm-up failed: {e}")
+        with _status_lock:
+            _status.update(state='failed', error=str(e))
+        return
+
+    elapsed = time.monotonic() - start
+    with _status_lock:
+        _status.update(state='ready', warmup_seconds=elapsed, error=None)
+    logger.info(f"Models warm in process {os.getpid()} after {elapsed:.1f}s")
+
+
+def start_warm_up():
+    """Warm the models up on a background thread of the current process (once per process)"""
+    pid = os.getpid()
+    with _status_lock:
+        if _status['pid'] == pid and _status['state'] in ('warming', 'ready'):
+            return
+        _status.update(pid=pid, state='warming', warmup_seconds=None, error=None)
+    threading.Thread(target=_warm_up_worker, name="model-warmup", daemon=True).start()
+
+
+def is_ready():
+    """True once this process has finished warming its models"""
+    with _status_lock:
+        return _status['pid'] == os.getpid() and _status['state'] == 'ready'
+
+
+def readiness():
+    with _status_lock:
+        status = dict(_status)
+    if status['pid'] != os.getpid():
+        # Status inherited from a parent process does not describe this worker
+        status.update(state='cold', warmup_seconds=None, error=None)
+    status['pid'] = os.getpid()
+    status['ready'] = status['state'] == 'ready'
+    return status
@@ -0,0 +1,190 @@
+"""
+Offline re-enrollment: compute reference templates for another recognition model from every user's
+stored reference face, so FACE_MODEL_NAME can be switched without anyone registering again.
+
+Users are paged in document-id order; reference images are downloaded on a thread pool and embedded
+on a process pool running the target model; the new templates are merged into each user's
+'reference_embeddings' map in Firestore batches. Progress is checkpointed after every batch, so an
+interrupted run resumes where it stopped.
+
+Usage:
+    python reenroll_templates.py --model Facenet512 --workers 4
+    python reenroll_templates.py --model Facenet512 --restart     # ignore an existing checkpoint
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+import firebase_admin
+from firebase_admin import firestore, storage
+
+from config import decode_image, firebase_credentials
+from embeddings import build_reference_template, compute_embeddings, select_template, template_fields
+from livenesschech import Config, logger
+from write_behind import MAX_BATCH_WRITES
+
+
+def _init_worker(model_name):
+    # Config is read from the environment the pool was started with
+    if Config.FACE_MODEL_NAME != model_name:
+        raise RuntimeError(f"Worker runs {Config.FACE_MODEL_NAME}, expected {model_name}")
+
+
+def embed_references(images):
+    """Embed a chunk of reference images with the worker's model; None where no face was found"""
+    decoded = [decode_image(data) if data is not None else None for data in images]
+    present = [image for image in decoded if image is not None]
+    embeddings = iter(compute_embeddings(present) if present else [])
+    return [None if image is None else next(embeddings) for image in decoded]
+
+
+def load_checkpoint(path, model_name):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get('model_name') != model_name:
+        raise SystemExit(f"{path} belongs to a {checkpoint.get('model_name')} run; use --restart or another --checkpoint")
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    """Write atomically, so a crash never leaves a torn checkpoint"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def stream_users(db, fields, start_after_id=None, page_size=300):
+    """Users in document-id order, a page at a time (no single long-lived stream), resuming after an id"""
+    query = db.collection('users').order_by('__name__').select(fields).limit(page_size)
+    cursor = db.collection('users').document(start_after_id).get() if start_after_id else None
+    while True:
+        page = list((query.start_after(cursor) if cursor is not None else query).stream())
+        yield from page
+        if len(page) < page_size:
+            return
+        cursor = page[-1]
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def download(bucket, path):
+    try:
+        return bucket.blob(path).download_as_bytes()
+    except Exception as e:
+        logger.warning(f"Could not download {path}: {e}")
+        return None
+
+
+def reenroll(db, bucket, model_name, workers, chunk_size, batch_writes, checkpoint_path, force, limit):
+    checkpoint = load_checkpoint(checkpoint_path, model_name) or {
+        'model_name': model_name, 'last_user_id': None, 'written': 0, 'failed': []
+    }
+    # Users read ahead of the checkpoint are read again on resume, so these only count this run
+    scanned = up_to_date = 0
+    if checkpoint['last_user_id']:
+        logger.info(f"Resuming {model_name} re-enrollment after user {checkpoint['last_user_id']}")
+
+    pending_writes = []
+
+    def commit(last_user_id):
+        batch = db.batch()
+        for user_id, template in pending_writes:
+            batch.set(db.collection('users').document(user_id), template_fields(template), merge=True)
+        if pending_writes:
+            batch.commit()
+        checkpoint['written'] += len(pending_writes)
+        checkpoint['last_user_id'] = last_user_id
+        save_checkpoint(checkpoint_path, checkpoint)
+        pending_writes.clear()
+
+    def handle(chunk, future):
+        for (user_id, reference_face), embedding in zip(chunk, future.result()):
+            if embedding is None:
+                if user_id not in checkpoint['failed']:
+                    checkpoint['failed'].append(user_id)
+                continue
+            pending_writes.append((user_id, build_reference_template(
+                embedding, datetime.utcnow(), model_name=model_name, reference_face=reference_face)))
+        if len(pending_writes) + chunk_size > batch_writes:
+            commit(chunk[-1][0])
+        return chunk[-1][0]
+
+    def candidates():
+        nonlocal scanned, up_to_date
+        for doc in stream_users(db, ['reference_face', 'reference_embeddings', 'reference_embedding'],
+                                checkpoint['last_user_id']):
+            if limit and scanned >= limit:
+                return
+            data = doc.to_dict() or {}
+            scanned += 1
+            if not data.get('reference_face'):
+                continue
+            if not force and select_template(data, model_name) is not None:
+                up_to_date += 1
+                continue
+            yield doc.id, data['reference_face']
+
+    # Workers are spawned (not forked) with the target model configured in their environment
+    os.environ['FACE_MODEL_NAME'] = model_name
+    os.environ['INFERENCE_BATCHING'] = 'false'
+    context = multiprocessing.get_context('spawn')
+    start = time.monotonic()
+    last_user_id = checkpoint['last_user_id']
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(model_name,)) as pool, \
+            ThreadPoolExecutor(max_workers=chunk_size, thread_name_prefix="reenroll-download") as downloads:
+        # Bounded window of chunks in flight; results are handled in stream order so the
+        # checkpoint always marks a prefix of users that is fully written
+        window = deque()
+        for chunk in chunked(candidates(), chunk_size):
+            images = list(downloads.map(lambda user: download(bucket, user[1]), chunk))
+            window.append((chunk, pool.submit(embed_references, images)))
+            if len(window) >= workers * 2:
+                last_user_id = handle(*window.popleft())
+        while window:
+            last_user_id = handle(*window.popleft())
+    commit(last_user_id)
+
+    elapsed = time.monotonic() - start
+    logger.info(f"Re-enrollment for {model_name}: {checkpoint['written']} templates written, "
+                f"{len(checkpoint['failed'])} failed (this run: {scanned} users scanned, "
+                f"{up_to_date} already current, {elapsed:.0f}s)")
+    return checkpoint
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute reference templates for another recognition model')
+    parser.add_argument('--model', required=True, choices=sorted(Config.FACE_MATCH_THRESHOLDS))
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--chunk-size', type=int, default=16, help='Images per process-pool task')
+    parser.add_argument('--batch-writes', type=int, default=400, help='Templates per Firestore batch')
+    parser.add_argument('--checkpoint', help='Progress file (default reenroll-<model>.json)')
+    parser.add_argument('--restart', action='store_true', help='Discard the checkpoint and start over')
+    parser.add_argument('--force', action='store_true', help='Recompute templates that are already current')
+    parser.add_argument('--limit', type=int, help='Stop after scanning this many users')
+    args = parser.parse_args()
+
+    checkpoint_path = args.checkpoint or f"reenroll-{args.model}.json"
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    firebase_admin.initialize_app(firebase_credentials(), {'storageBucket': Config.FIREBASE_STORAGE_BUCKET})
+    reenroll(firestore.client(), storage.bucket(), args.model, args.workers, args.chunk_size,
+             max(args.chunk_size, min(args.batch_writes, MAX_BATCH_WRITES)), checkpoint_path, args.force, args.limit)
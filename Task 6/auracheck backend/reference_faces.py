@@ -0,0 +1,44 @@
+from config import IMAGE_CONTENT_TYPES, IMAGE_EXTENSIONS, encode_image, reference_crop
+from livenesschech import Config, logger
+
+# reference_face_format of a profile: what the reference_face blob holds
+ALIGNED_CROP = 'aligned_crop'
+ORIGINAL = 'original'
+
+
+def prepare_reference_face(image):
+    """The compact aligned crop stored as a reference face, encoded; None when no face could be cropped"""
+    crop = reference_crop(image, Config.REFERENCE_CROP_SIZE, Config.REFERENCE_CROP_MARGIN)
+    if crop is None:
+        return None
+    return encode_image(crop, Config.REFERENCE_CROP_FORMAT, Config.REFERENCE_CROP_QUALITY)
+
+
+def archive_original(bucket, path, data, content_type):
+    """Upload an original image straight into the cold storage class"""
+    blob = bucket.blob(path)
+    blob.storage_class = Config.REFERENCE_ARCHIVE_STORAGE_CLASS
+    blob.upload_from_string(data, content_type=content_type)
+
+
+def store_reference_face(bucket, stem, image_bytes, image_format, crop_bytes):
+    """
+    Upload a reference face under reference_faces/{stem}: the compact crop, or the original upload
+    when no crop could be made. With REFERENCE_ARCHIVE_ORIGINALS the original also goes to the archive.
+    Returns the profile fields pointing at the stored images.
+    """
+    if crop_bytes is None:
+        logger.warning(f"No aligned crop for reference face {stem}; storing the original")
+        image_path = f"reference_faces/{stem}.{IMAGE_EXTENSIONS[image_format]}"
+        bucket.blob(image_path).upload_from_string(image_bytes, content_type=IMAGE_CONTENT_TYPES[image_format])
+        return {'reference_face': image_path, 'reference_face_format': ORIGINAL, 'reference_face_original': None}
+
+    crop_format = Config.REFERENCE_CROP_FORMAT
+    image_path = f"reference_faces/{stem}.{IMAGE_EXTENSIONS[crop_format]}"
+    bucket.blob(image_path).upload_from_string(crop_bytes, content_type=IMAGE_CONTENT_TYPES[crop_format])
+
+    original_path = None
+    if Config.REFERENCE_ARCHIVE_ORIGINALS:
+        original_path = f"{Config.REFERENCE_ARCHIVE_PREFIX}/{stem}.{IMAGE_EXTENSIONS[image_format]}"
+        archive_original(bucket, original_path, image_bytes, IMAGE_CONTENT_TYPES[image_format])
+    return {'reference_face': image_path, 'reference_face_format': ALIGNED_CROP, 'reference_face_original': original_path}
@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+import cv2
+import numpy as np
+
+HASH_BITS = 64
+
+
+def _thumbnail(image, size):
+    """Grayscale float32 thumbnail of a BGR (or gray) image, area-averaged so resampling noise cancels out"""
+    small = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return small.astype(np.float32)
+
+
+def _pack(bits):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+
+def dhash(image):
+    """64-bit difference hash: whether each pixel of a 9x8 thumbnail is brighter than its left neighbour"""
+    thumbnail = _thumbnail(image, (9, 8))
+    return _pack(thumbnail[:, 1:] > thumbnail[:, :-1])
+
+
+def phash(image):
+    """64-bit DCT hash: the lowest 8x8 frequencies of a 32x32 thumbnail against their median"""
+    low = cv2.dct(_thumbnail(image, (32, 32)))[:8, :8]
+    return _pack(low > np.median(low.ravel()[1:]))
+
+
+HASHES = {'dhash': dhash, 'phash': phash}
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class ReplayIndex:
+    """
+    Perceptual hashes of recent submissions, keyed by who sent them (('user', id) or ('device', id)).
+    Entries older than window seconds are dropped, each key keeps its newest per_key hashes and the
+    least recently used keys are evicted beyond max_keys, so memory stays bounded.
+    A submission may carry a retry_key (its idempotency key and request fingerprint): a later request
+    with the same retry_key is a retry of it, not a replay, even after the idempotency cache forgot it.
+    """
+
+    def __init__(self, window, per_key, max_keys):
+        self.window = window
+        self.per_key = per_key
+        self.max_keys = max_keys
+        self._entries = OrderedDict()  # key -> deque of (submitted_at, hash, user_id, endpoint, retry_key)
+        self._lock = threading.Lock()
+        self.checks = 0
+        self.matches = 0
+
+    def _recent(self, key, now):
+        entries = self._entries.get(key)
+        if entries is None:
+            return ()
+        while entries and entries[0][0] <= now - self.window:
+            entries.popleft()
+        if not entries:
+            del self._entries[key]
+        return entries
+
+    def check(self, keys, image_hash, max_distance, retry_key=None):
+        """
+        Closest earlier submission within max_distance bits under any of keys, as a dict, or None.
+        Submissions recorded with the same retry_key are not matched.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.checks += 1
+            best = None
+            for key in keys:
+                for submitted_at, earlier_hash, earlier_user_id, earlier_endpoint, earlier_retry_key \
+                        in self._recent(key, now):
+                    if retry_key is not None and earlier_retry_key == retry_key:
+                        continue
+                    distance = hamming(image_hash, earlier_hash)
+                    if distance <= max_distance and (best is None or distance < best['distance']):
+                        best = {'key': key[0], 'distance': distance, 'age': now - submitted_at,
+                                'user_id': earlier_user_id, 'endpoint': earlier_endpoint}
+            if best is not None:
+                self.matches += 1
+            return best
+
+    def add(self, keys, image_hash, user_id, endpoint, retry_key=None):
+        """
+        Record a submission under every key. Only done once a submission has been processed, so a
+        request that failed can be retried with the same image, and a replay never refreshes itself.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                entries = self._entries.get(key)
+                if entries is None:
+                    entries = self._entries[key] = deque(maxlen=self.per_key)
+                entries.append((now, image_hash, user_id, endpoint, retry_key))
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'keys': len(self._entries),
+                'hashes': sum(len(entries) for entries in self._entries.values()),
+                'checks': self.checks,
+                'matches': self.matches,
+                'window': self.window
+            }
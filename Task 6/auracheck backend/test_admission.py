@@ -0,0 +1,115 @@
+"""
+Queueing, shedding and preemption of the admission controller, driven through enter()/settle()
+without threads: a waiter's notify callback records when it is granted or pushed out.
+
+    python -m pytest test_admission.py
+"""
+import pytest
+
+from admission import AdmissionController, Overloaded
+
+PRIORITIES = {'verify': 0, 'register': 1, 'batch': 2}
+
+
+def controller(slots=1, queue_size=4, max_wait=60.0, service_time=1.0):
+    return AdmissionController(slots, queue_size, max_wait, PRIORITIES, service_time)
+
+
+def enter(admission, request_class, notified, slots=1):
+    return admission.enter(request_class, lambda: notified.append(request_class), slots)
+
+
+def test_free_slots_admit_at_once_then_requests_queue():
+    admission, notified = controller(slots=2), []
+    assert enter(admission, 'verify', notified) is None
+    assert enter(admission, 'verify', notified) is None
+    waiter = enter(admission, 'verify', notified)
+    assert waiter is not None and waiter.state == 'waiting'
+
+    admission.release('verify', 1.0)
+    assert notified == ['verify'] and waiter.state == 'granted'
+    admission.settle(waiter)
+
+
+def test_queued_requests_are_granted_by_priority():
+    admission, notified = controller(), []
+    enter(admission, 'verify', notified)
+    enter(admission, 'batch', notified)
+    enter(admission, 'register', notified)
+    enter(admission, 'verify', notified)
+
+    # One slot: each release grants the most important waiter, which is the next to finish
+    running = 'verify'
+    for _ in range(3):
+        admission.release(running, 1.0)
+        running = notified[-1]
+    assert notified == ['verify', 'register', 'batch']
+
+
+def test_full_queue_preempts_a_less_important_request():
+    admission, notified = controller(queue_size=1), []
+    enter(admission, 'verify', notified)
+    batch = enter(admission, 'batch', notified)
+    verify = enter(admission, 'verify', notified)
+
+    assert batch.state == 'shed' and notified == ['batch']
+    with pytest.raises(Overloaded) as shed:
+        admission.settle(batch)
+    assert shed.value.reason == 'preempted'
+    assert verify.state == 'waiting'
+    assert admission.stats()['shed'] == {'batch:preempted': 1}
+
+
+def test_full_queue_sheds_a_request_no_more_important():
+    admission, notified = controller(queue_size=1), []
+    enter(admission, 'verify', notified)
+    enter(admission, 'verify', notified)
+    with pytest.raises(Overloaded) as shed:
+        enter(admission, 'verify', notified)
+    assert shed.value.reason == 'queue_full'
+    assert shed.value.retry_after >= 1
+
+
+def test_projected_wait_beyond_max_wait_is_shed_up_front():
+    admission, notified = controller(max_wait=2.5, service_time=1.0), []
+    enter(admission, 'verify', notified)
+    enter(admission, 'verify', notified)
+    enter(admission, 'verify', notified)
+    # Two queued ahead at 1s each plus its own second is more than 2.5s
+    with pytest.raises(Overloaded) as shed:
+        enter(admission, 'verify', notified)
+    assert shed.value.reason == 'deadline'
+
+
+def test_batch_waits_until_all_its_slots_are_free():
+    admission, notified = controller(slots=2), []
+    enter(admission, 'verify', notified)
+    batch = enter(admission, 'batch', notified, slots=2)
+    assert batch.state == 'waiting'
+
+    admission.release('verify', 1.0)
+    assert batch.state == 'granted'
+    assert admission.stats()['running'] == {'verify': 0, 'register': 0, 'batch': 2}
+    admission.release('batch', 1.0, slots=2)
+    assert admission.stats()['running']['batch'] == 0
+
+
+def test_service_time_is_tracked_per_class():
+    admission, notified = controller(service_time=1.0), []
+    enter(admission, 'batch', notified)
+    admission.release('batch', 11.0)
+    assert admission.service_time['batch'] == pytest.approx(3.0)
+    assert admission.service_time['verify'] == 1.0
+
+
+def test_abandoned_grant_frees_its_slot_for_the_next_waiter():
+    admission, notified = controller(), []
+    enter(admission, 'verify', notified)
+    first = enter(admission, 'verify', notified)
+    second = enter(admission, 'verify', notified)
+    admission.release('verify', 1.0)
+    assert first.state == 'granted'
+
+    # The client of the granted request went away before it ran
+    admission.abandon(first)
+    assert second.state == 'granted'
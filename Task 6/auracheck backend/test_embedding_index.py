@@ -0,0 +1,110 @@
+"""
+The in-memory 1:N embedding index, and its sync with the templates stored in Firestore
+(the in-memory stand-in).
+
+    python -m pytest test_embedding_index.py
+"""
+from datetime import datetime
+
+import numpy as np
+
+from embedding_index import EmbeddingIndex, FirestoreEmbeddingIndex, assign_matches
+from embeddings import build_reference_template, template_fields
+from firebase_fakes import FakeFirestore
+
+DIMENSIONS = 16
+
+
+def embeddings(count, seed=0):
+    return np.random.default_rng(seed).normal(size=(count, DIMENSIONS)).astype(np.float32)
+
+
+def brute_force(vectors, query):
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return 1.0 - vectors @ (query / np.linalg.norm(query))
+
+
+def test_search_agrees_with_brute_force_across_growth():
+    vectors = embeddings(50)
+    index = EmbeddingIndex(initial_capacity=4)
+    for i, vector in enumerate(vectors):
+        index.add(f"user-{i}", vector)
+    assert index.stats()['capacity'] >= 50
+
+    query = embeddings(1, seed=1)[0]
+    distances = brute_force(vectors, query)
+    nearest = np.argsort(distances)[:3]
+    matches = index.search(query, k=3)
+    assert [key for key, _ in matches] == [f"user-{i}" for i in nearest]
+    assert np.allclose([distance for _, distance in matches], distances[nearest], atol=1e-5)
+
+
+def test_search_is_restricted_to_candidates():
+    vectors = embeddings(10)
+    index = EmbeddingIndex()
+    for i, vector in enumerate(vectors):
+        index.add(f"user-{i}", vector)
+    assert index.search(vectors[3], ['user-5', 'user-6', 'unknown'])[0][0] in ('user-5', 'user-6')
+    assert index.search(vectors[3], ['unknown']) == []
+
+
+def test_remove_keeps_the_other_rows_searchable():
+    vectors = embeddings(5)
+    index = EmbeddingIndex()
+    for i, vector in enumerate(vectors):
+        index.add(f"user-{i}", vector)
+
+    # The last row moves into the removed one's slot
+    assert index.remove('user-1')
+    assert not index.remove('user-1')
+    assert len(index) == 4 and 'user-1' not in index
+    for i in (0, 2, 3, 4):
+        key, distance = index.search(vectors[i])[0]
+        assert key == f"user-{i}" and distance < 1e-5
+
+
+def test_assign_matches_is_one_to_one():
+    distances = np.array([
+        [0.10, 0.20, 0.90],
+        [0.15, 0.90, 0.90],
+        [0.90, 0.90, 0.25]
+    ])
+    # Probes 0 and 1 are both closest to key 0: the closer pair takes it and key 0 is not given twice
+    assert assign_matches(distances, threshold=0.3) == {0: (0, 0.10), 2: (2, 0.25)}
+
+
+def enroll(db, user_id, embedding, reference_face, model_name=None):
+    """Profile fields registration merges into a user document"""
+    db.collection('users').document(user_id).set({
+        'reference_face': reference_face,
+        **template_fields(build_reference_template(embedding, datetime.utcnow(), model_name=model_name,
+                                                   reference_face=reference_face))
+    }, merge=True)
+
+
+def test_sync_drops_users_without_a_current_template():
+    db, vectors = FakeFirestore(), embeddings(2)
+    enroll(db, 'user-0', vectors[0], 'user-0/a.jpg')
+    enroll(db, 'user-1', vectors[1], 'user-1/a.jpg')
+    index = FirestoreEmbeddingIndex(db, sync_interval=60)
+    index.sync()
+    assert len(index) == 2
+
+    # user-1 registers a new face on an instance running another model: the template indexed here
+    # was computed from the old face and no longer counts
+    enroll(db, 'user-1', vectors[0], 'user-1/b.jpg', model_name='Facenet512')
+    index.sync(force=True)
+    assert 'user-1' not in index and 'user-0' in index
+
+
+def test_invalidated_user_is_reread_on_the_next_sync():
+    db, vectors = FakeFirestore(), embeddings(1)
+    enroll(db, 'user-0', vectors[0], 'user-0/a.jpg')
+    index = FirestoreEmbeddingIndex(db, sync_interval=60)
+    index.sync()
+
+    index.invalidate('user-0')
+    assert 'user-0' not in index
+    # Within sync_interval, yet the invalidated document is read again
+    index.sync()
+    assert 'user-0' in index
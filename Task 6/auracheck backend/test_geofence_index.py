@@ -0,0 +1,70 @@
+"""
+The geofence grid index against a brute-force haversine check of every fence.
+
+    python -m pytest test_geofence_index.py
+"""
+import numpy as np
+
+from geofence_index import GeofenceIndex, haversine_distances
+
+CELL_DEGREES = 0.01  # about 1.1 km
+
+
+def random_fences(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return [{
+        'id': f"fence-{i}",
+        'name': f"Hall {i}",
+        'latitude': 4.15 + rng.uniform(-0.05, 0.05),
+        'longitude': 9.29 + rng.uniform(-0.05, 0.05),
+        # Most fences fit in one cell, some span several
+        'radius': rng.choice([50.0, 150.0, 2500.0])
+    } for i in range(count)]
+
+
+def brute_force(fences, lat, lng):
+    """Ids of every fence containing the point"""
+    lats = np.asarray([fence['latitude'] for fence in fences])
+    lngs = np.asarray([fence['longitude'] for fence in fences])
+    distances = haversine_distances(lat, lng, lats, lngs)
+    return {fence['id'] for fence, distance in zip(fences, distances) if distance <= fence['radius']}
+
+
+def test_grid_lookup_agrees_with_brute_force():
+    fences = random_fences(200)
+    index = GeofenceIndex(fences, CELL_DEGREES)
+    rng = np.random.default_rng(1)
+    points = [(4.15 + rng.uniform(-0.06, 0.06), 9.29 + rng.uniform(-0.06, 0.06)) for _ in range(500)]
+
+    for (lat, lng), (verified, _, fence_id) in zip(points, index.check_many(points)):
+        inside = brute_force(fences, lat, lng)
+        assert verified == bool(inside)
+        if verified:
+            assert fence_id in inside
+
+
+def test_fence_spanning_cells_is_found_from_a_neighbouring_cell():
+    fence = {'id': 'campus', 'name': 'Campus', 'latitude': 4.155, 'longitude': 9.295, 'radius': 2000.0}
+    index = GeofenceIndex([fence], CELL_DEGREES)
+    # About 1.3 km north of the centre, two cells up
+    lat, lng = 4.155 + 1300.0 / 111320.0, 9.295
+    assert index._cell(lat, lng) != index._cell(fence['latitude'], fence['longitude'])
+    verified, message, fence_id = index.check(lat, lng)
+    assert verified and fence_id == 'campus'
+    assert message.startswith('Within authorized radius of Campus')
+
+
+def test_session_geofence_restricts_the_check():
+    fences = [
+        {'id': 'hall-a', 'name': 'Hall A', 'latitude': 4.1537, 'longitude': 9.2920, 'radius': 100.0},
+        {'id': 'hall-b', 'name': 'Hall B', 'latitude': 4.1637, 'longitude': 9.3020, 'radius': 100.0}
+    ]
+    index = GeofenceIndex(fences, CELL_DEGREES)
+    assert index.check(4.1537, 9.2920, 'hall-a')[0]
+    assert index.check(4.1537, 9.2920, 'hall-b') == (False, "Not near any authorized location", None)
+    assert index.check(4.1537, 9.2920, 'hall-c') == (False, "Session geofence is not active", None)
+
+
+def test_missing_location_is_not_verified():
+    index = GeofenceIndex(random_fences(10), CELL_DEGREES)
+    assert index.check_many([(None, 9.29), (4.15, None)]) == [(False, "Missing location data", None)] * 2
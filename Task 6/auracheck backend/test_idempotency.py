@@ -0,0 +1,194 @@
+"""
+Retries of /attendance/verify through Flask's test client, against the in-memory Firestore and
+Storage stand-ins. The model steps (analyze_verification, load_reference) are replaced by a pipeline
+the tests control; the idempotency cache, replay guard and attendance records are the app's own.
+
+    python -m pytest test_idempotency.py
+"""
+import io
+import threading
+import time
+from datetime import datetime, timedelta
+
+import cv2
+import firebase_admin
+import jwt
+import numpy as np
+import pytest
+from firebase_admin import credentials, firestore, storage
+
+from firebase_fakes import FakeBucket, FakeFirestore
+from idempotency import IdempotencyCache
+from livenesschech import Config
+from replay_guard import ReplayIndex
+
+# Before the app is imported: no background model warm-up, and the fakes instead of Firebase
+Config.PRELOAD_MODELS = True
+fake_db = FakeFirestore()
+fake_bucket = FakeBucket()
+firebase_admin.initialize_app = lambda *args, **kwargs: None
+credentials.Certificate = lambda *args, **kwargs: None
+firestore.client = lambda *args, **kwargs: fake_db
+storage.bucket = lambda *args, **kwargs: fake_bucket
+
+import application  # noqa: E402
+
+USER_ID = 'student-1'
+SESSION_ID = 'session-1'
+GEOFENCE = {'name': 'Hall A', 'latitude': 4.1537, 'longitude': 9.2920, 'radius': 100.0, 'isActive': True}
+REFERENCE = np.random.default_rng(0).random(128, dtype=np.float32)
+
+
+class Pipeline:
+    """Stand-in for the model steps of a verification: counts runs, and can fail or hold a run"""
+
+    def __init__(self):
+        self.runs = 0
+        self.error = None
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def analyze(self, user_id, image, burst_frames, fields):
+        self.runs += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        face_result = {'face_count': 1, 'embedding': REFERENCE, 'is_live': True, 'liveness_score': 0.9}
+        return face_result, 0.9, None
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    pipeline = Pipeline()
+    monkeypatch.setattr(application, 'analyze_verification', pipeline.analyze)
+    monkeypatch.setattr(application, 'load_reference', lambda user_id, user_data: REFERENCE)
+    monkeypatch.setattr(application, 'idempotency_cache', IdempotencyCache(16, Config.IDEMPOTENCY_TTL))
+    monkeypatch.setattr(application, 'replay_index', ReplayIndex(3600, 16, 100))
+    # Records are committed synchronously and nothing is queued by admission control
+    for name, value in (('IDEMPOTENCY', True), ('REPLAY_GUARD', True), ('WRITE_BEHIND', False),
+                        ('ADMISSION_CONTROL', False)):
+        monkeypatch.setattr(Config, name, value)
+
+    fake_db.documents.clear()
+    fake_db.collection('users').document(USER_ID).set({'fullName': 'Test Student', 'reference_face': 'ref.jpg'})
+    fake_db.collection('geofences').document('hall-a').set(GEOFENCE)
+    fake_db.collection('sessions').document(SESSION_ID).set({'courseId': 'course-1', 'geofenceId': 'hall-a'})
+    application.user_cache.invalidate(USER_ID)
+    return pipeline
+
+
+def photo(seed):
+    """A JPEG the replay guard tells apart from the photos of other seeds"""
+    pixels = np.random.default_rng(seed).integers(0, 256, (240, 240, 3), dtype=np.uint8)
+    return cv2.imencode('.jpg', pixels)[1].tobytes()
+
+
+def verify(image, session_id=SESSION_ID, key=None):
+    token = jwt.encode({'id': USER_ID, 'exp': datetime.utcnow() + timedelta(hours=1)},
+                       Config.JWT_SECRET, algorithm="HS256")
+    headers = {'Authorization': f'Bearer {token}'}
+    if key is not None:
+        headers['Idempotency-Key'] = key
+    return application.app.test_client().post('/attendance/verify', headers=headers,
+                                              content_type='multipart/form-data', data={
+        'image': (io.BytesIO(image), 'verify.jpg'),
+        'session_id': session_id,
+        'latitude': GEOFENCE['latitude'],
+        'longitude': GEOFENCE['longitude'],
+        'device_id': 'phone-1'
+    })
+
+
+def verify_in_background(image):
+    responses = []
+    thread = threading.Thread(target=lambda: responses.append(verify(image)))
+    thread.start()
+    return thread, responses
+
+
+def attendance_records():
+    return [path for path in fake_db.documents if path.startswith('attendance_record/')]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_duplicate_waits_for_the_original(pipeline):
+    pipeline.release.clear()
+    thread, responses = verify_in_background(photo(1))
+    assert pipeline.started.wait(5)
+
+    duplicate_thread, duplicates = verify_in_background(photo(1))
+    wait_for(lambda: application.idempotency_cache.stats()['coalesced'] == 1)
+    pipeline.release.set()
+    thread.join()
+    duplicate_thread.join()
+
+    assert responses[0].status_code == duplicates[0].status_code == 200
+    assert duplicates[0].headers['Idempotent-Replayed'] == 'true'
+    assert duplicates[0].get_json()['attendance_id'] == responses[0].get_json()['attendance_id']
+    assert pipeline.runs == 1
+
+
+def test_duplicate_gets_409_while_the_original_is_still_running(pipeline, monkeypatch):
+    monkeypatch.setattr(Config, 'IDEMPOTENCY_WAIT', 0.05)
+    pipeline.release.clear()
+    thread, responses = verify_in_background(photo(1))
+    assert pipeline.started.wait(5)
+
+    assert verify(photo(1)).status_code == 409
+    pipeline.release.set()
+    thread.join()
+    assert responses[0].status_code == 200
+    assert pipeline.runs == 1
+
+
+def test_key_reused_for_another_request_is_422(pipeline):
+    assert verify(photo(1), key='check-in-1').status_code == 200
+    assert verify(photo(2), key='check-in-1').status_code == 422
+    assert pipeline.runs == 1
+
+
+def test_only_successful_responses_are_stored(pipeline):
+    pipeline.error = RuntimeError('model crashed')
+    assert verify(photo(1)).status_code == 500
+
+    # Neither the failed response nor the image was kept: the retry runs the pipeline again
+    pipeline.error = None
+    first = verify(photo(1))
+    assert first.status_code == 200
+    assert 'Idempotent-Replayed' not in first.headers
+
+    retry = verify(photo(1))
+    assert retry.status_code == 200
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert pipeline.runs == 2
+
+
+def test_retry_after_the_cache_forgot_it_passes_the_replay_guard(pipeline, monkeypatch):
+    first = verify(photo(1))
+    assert first.status_code == 200
+
+    # As after IDEMPOTENCY_TTL: the stored response is gone, but the replay guard still knows the request
+    monkeypatch.setattr(application, 'idempotency_cache', IdempotencyCache(16, Config.IDEMPOTENCY_TTL))
+    retry = verify(photo(1))
+    assert retry.status_code == 200
+    assert retry.get_json()['attendance_id'] == first.get_json()['attendance_id']
+    assert pipeline.runs == 2
+    assert len(attendance_records()) == 1
+
+
+def test_same_image_for_another_session_is_a_replay(pipeline):
+    assert verify(photo(1)).status_code == 200
+    response = verify(photo(1), session_id='session-2')
+    assert response.status_code == 400
+    assert 'already submitted' in response.get_json()['error']
+    assert pipeline.runs == 1
+    assert any(data.get('event_type') == 'replayed_image' for path, data in fake_db.documents.items()
+               if path.startswith('security_events/'))
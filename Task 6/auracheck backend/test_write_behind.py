@@ -0,0 +1,106 @@
+"""
+Batching and crash recovery of the write-behind queue against the in-memory Firestore stand-in.
+
+    python -m pytest test_write_behind.py
+"""
+import json
+import os
+import threading
+
+from firebase_fakes import FakeFirestore
+from write_behind import WriteBehindQueue
+
+
+class RecordingFirestore(FakeFirestore):
+    """FakeFirestore that keeps the number of writes in every committed batch, and can hold or reject commits"""
+
+    def __init__(self, reject=None):
+        super().__init__()
+        self.batch_sizes = []
+        self.reject = reject  # document paths Firestore refuses
+        self.release = threading.Event()
+        self.release.set()
+
+    def batch(self):
+        batch = super().batch()
+        commit = batch.commit
+
+        def recorded_commit():
+            self.release.wait(5)
+            if self.reject and any(reference.path in self.reject for reference, _, _ in batch._writes):
+                raise ValueError('Invalid document')
+            self.batch_sizes.append(len(batch._writes))
+            commit()
+        batch.commit = recorded_commit
+        return batch
+
+
+def group(name, size):
+    return [(f"attendance_record/{name}-{i}", {'n': i}) for i in range(size)]
+
+
+def test_groups_fill_batches_up_to_the_limit(tmp_path):
+    db = RecordingFirestore()
+    queue = WriteBehindQueue(db, str(tmp_path), max_batch_writes=4, max_wait_ms=200, fsync=False)
+    for name, size in (('a', 3), ('b', 1), ('c', 2)):
+        queue.enqueue(group(name, size))
+    assert queue.flush(timeout=5)
+    # 3 + 1 is exactly the limit; the group of 2 would exceed it and starts the next batch
+    assert db.batch_sizes == [4, 2]
+    assert len(db.documents) == 6
+
+
+def test_oversized_group_is_split_into_batches(tmp_path):
+    db = RecordingFirestore()
+    queue = WriteBehindQueue(db, str(tmp_path), max_batch_writes=4, max_wait_ms=200, fsync=False)
+    queue.enqueue(group('big', 9))
+    assert queue.flush(timeout=5)
+    assert db.batch_sizes == [4, 4, 1]
+    assert len(db.documents) == 9
+
+
+def test_orphaned_spool_is_replayed(tmp_path):
+    # What a worker that died after one of its two groups was committed leaves behind, torn last line included
+    with open(tmp_path / 'spool-7-dead.log', 'w', encoding='utf-8') as spool:
+        spool.write(json.dumps({'seq': 1, 'writes': group('committed', 1)}) + '\n')
+        spool.write(json.dumps({'seq': 2, 'writes': group('lost', 2)}) + '\n')
+        spool.write(json.dumps({'ack': 1}) + '\n')
+        spool.write('{"seq": 3, "wri')
+
+    db = RecordingFirestore()
+    queue = WriteBehindQueue(db, str(tmp_path), max_wait_ms=0, fsync=False)
+    assert queue.flush(timeout=5)
+    assert sorted(db.documents) == ['attendance_record/lost-0', 'attendance_record/lost-1']
+    assert not os.path.exists(tmp_path / 'spool-7-dead.log')
+
+
+def test_spool_of_a_live_queue_is_left_alone(tmp_path):
+    busy_db = RecordingFirestore()
+    busy_db.release.clear()
+    busy = WriteBehindQueue(busy_db, str(tmp_path), max_wait_ms=0, fsync=False)
+    busy.enqueue(group('busy', 1))
+
+    # The second queue cannot lock the first one's spool, so it does not replay its uncommitted writes
+    db = RecordingFirestore()
+    queue = WriteBehindQueue(db, str(tmp_path), max_wait_ms=0, fsync=False)
+    assert queue.flush(timeout=5)
+    assert db.documents == {}
+    assert os.path.exists(busy.spool_path)
+
+    busy_db.release.set()
+    assert busy.flush(timeout=5)
+    assert list(busy_db.documents) == ['attendance_record/busy-0']
+
+
+def test_rejected_group_is_dead_lettered(tmp_path):
+    db = RecordingFirestore(reject={'attendance_record/bad-0'})
+    queue = WriteBehindQueue(db, str(tmp_path), max_wait_ms=200, fsync=False)
+    for name in ('good', 'bad', 'also-good'):
+        queue.enqueue(group(name, 1))
+    assert queue.flush(timeout=5)
+
+    # The batch is bisected down to the rejected group; the others still reach Firestore
+    assert sorted(db.documents) == ['attendance_record/also-good-0', 'attendance_record/good-0']
+    with open(queue.dead_letter_path, encoding='utf-8') as dead_letters:
+        assert [json.loads(line)['seq'] for line in dead_letters] == [2]
+    assert queue.stats()['dead_lettered'] == 1
@@ -0,0 +1,277 @@
+import atexit
+import base64
+import fcntl
+import glob
+import json
+import os
+import secrets
+import string
+import threading
+import time
+from datetime import datetime
+
+from google.api_core import exceptions as api_exceptions
+
+from livenesschech import logger
+
+AUTO_ID_ALPHABET = string.ascii_letters + string.digits
+MAX_BATCH_WRITES = 500  # Firestore limit per WriteBatch
+
+# Commit errors worth retrying as they are; any other error means Firestore rejected some write
+TRANSIENT_ERRORS = (api_exceptions.ServiceUnavailable, api_exceptions.DeadlineExceeded,
+                    api_exceptions.InternalServerError, api_exceptions.TooManyRequests,
+                    api_exceptions.Aborted, api_exceptions.Unknown, ConnectionError, TimeoutError)
+
+_queues = []
+
+
+def new_document_path(collection_path):
+    """Path of a new document with a Firestore-style auto ID, generated locally so a replay is idempotent"""
+    return f"{collection_path}/{''.join(secrets.choice(AUTO_ID_ALPHABET) for _ in range(20))}"
+
+
+def commit_writes(db, writes):
+    """Commit a group of (document_path, data) sets in one WriteBatch, synchronously"""
+    batch = db.batch()
+    for path, data in writes:
+        batch.set(db.document(path), data)
+    batch.commit()
+
+
+def flush_all(timeout=None):
+    """Flush every write-behind queue in this process (shutdown hook)"""
+    for write_queue in list(_queues):
+        if write_queue.pid == os.getpid() and not write_queue.flush(timeout):
+            logger.error(f"Write-behind flush timed out; unflushed writes stay in {write_queue.spool_path}")
+
+
+atexit.register(flush_all, 30)
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, bytes):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    raise TypeError(f"Cannot spool value of type {type(value).__name__}")
+
+
+def _decode(obj):
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    if '__bytes__' in obj:
+        return base64.b64decode(obj['__bytes__'])
+    return obj
+
+
+def _read_unacked(spool):
+    """(unacknowledged write groups in spool order, highest seq) of an open spool file"""
+    spool.seek(0)
+    entries, acked = {}, set()
+    for line in spool:
+        try:
+            record = json.loads(line, object_hook=_decode)
+        except json.JSONDecodeError:
+            continue  # torn final line from a crash mid-write
+        if 'ack' in record:
+            acked.add(record['ack'])
+        else:
+            entries[record['seq']] = record['writes']
+    unacked = [writes for seq, writes in sorted(entries.items()) if seq not in acked]
+    return unacked, max(entries, default=0)
+
+
+class WriteBehindQueue:
+    """
+    Durable write-behind queue for Firestore document writes.
+
+    enqueue() appends the writes to an append-only spool file (fsynced) and returns;
+    a background thread coalesces everything queued within max_wait_ms into WriteBatch
+    commits and appends an ack line once a batch is committed. Each queue holds an flock on
+    its own uniquely named spool for as long as its process lives; on start-up, spools nobody
+    holds a lock on are claimed and their unacknowledged writes replayed. Writes are
+    whole-document sets with explicit paths, so replaying one twice is harmless.
+
+    A batch Firestore rejects is split until the offending group is isolated; that group goes
+    to a dead-letter file next to the spool instead of blocking every later write.
+    """
+
+    def __init__(self, db, spool_folder, max_batch_writes=400, max_wait_ms=20, fsync=True):
+        self.db = db
+        self.spool_folder = spool_folder
+        self.max_batch_writes = max(1, min(int(max_batch_writes), MAX_BATCH_WRITES))
+        self.max_wait = max(0.0, float(max_wait_ms) / 1000.0)
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        self._pending = []  # (seq, writes) in spool order
+        self._in_flight = 0
+        self._seq = 0
+        self.commits = 0
+        self.writes = 0
+        self.failures = 0
+        self.dead_lettered = 0
+
+        self.pid = os.getpid()
+        os.makedirs(spool_folder, exist_ok=True)
+        # PIDs are reused (every container's first worker may be pid 7): qualify them with a random token
+        name = f"{self.pid}-{secrets.token_hex(4)}"
+        self.spool_path = os.path.join(spool_folder, f"spool-{name}.log")
+        self.dead_letter_path = os.path.join(spool_folder, f"dead-letter-{name}.log")
+        self._spool = open(self.spool_path, 'a+', encoding='utf-8')
+        fcntl.flock(self._spool.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)  # released only when the process exits
+        # Whatever is already in the spool is replayed first; new entries continue its sequence
+        leftover, self._seq = _read_unacked(self._spool)
+        for writes in leftover:
+            self.enqueue(writes)
+        self._replay_orphans()
+        self._thread = threading.Thread(target=self._worker, name="write-behind", daemon=True)
+        self._thread.start()
+        _queues.append(self)
+
+    def _append(self, record):
+        self._spool.write(json.dumps(record, default=_encode) + '\n')
+        self._spool.flush()
+        if self.fsync:
+            os.fsync(self._spool.fileno())
+
+    def enqueue(self, writes):
+        """
+        Durably queue a group of (document_path, data) sets that should be committed together.
+        A group larger than max_batch_writes cannot be, and is queued as several groups of at most that.
+        Returns the sequence number of its (last) group once the writes are on disk, before they reach Firestore.
+        """
+        writes = [(path, data) for path, data in writes]
+        with self._lock:
+            for start in range(0, max(len(writes), 1), self.max_batch_writes):
+                self._seq += 1
+                chunk = writes[start:start + self.max_batch_writes]
+                self._append({'seq': self._seq, 'writes': chunk})
+                self._pending.append((self._seq, chunk))
+            self._not_empty.notify()
+        return self._seq
+
+    def _replay_orphans(self):
+        """Claim spools whose owner is gone (nobody holds their lock) and re-queue what they never committed"""
+        for path in glob.glob(os.path.join(self.spool_folder, 'spool-*.log')):
+            if path == self.spool_path:
+                continue
+            try:
+                spool = open(path, encoding='utf-8')
+            except OSError:
+                continue
+            with spool:
+                try:
+                    fcntl.flock(spool.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # its process is alive, or another worker is replaying it
+                try:
+                    if os.stat(path).st_ino != os.fstat(spool.fileno()).st_ino:
+                        continue  # replayed and removed by another worker since we opened it
+                except FileNotFoundError:
+                    continue
+                replayed, _ = _read_unacked(spool)
+                for writes in replayed:
+                    self.enqueue(writes)
+                os.remove(path)  # still under the lock, so no other worker replays it again
+            if replayed:
+                logger.info(f"Replayed {len(replayed)} spooled write groups from {os.path.basename(path)}")
+
+    def _collect(self):
+        """Wait for queued writes, then gather everything that arrives within max_wait up to one batch"""
+        with self._lock:
+            while not self._pending:
+                self._not_empty.wait()
+        time.sleep(self.max_wait)
+        with self._lock:
+            groups, count = [], 0
+            while self._pending:
+                seq, writes = self._pending[0]
+                if count + len(writes) > self.max_batch_writes:
+                    break  # enqueue() keeps every group within max_batch_writes, so the first always fits
+                groups.append(self._pending.pop(0))
+                count += len(writes)
+            self._in_flight = len(groups)
+            return groups
+
+    def _commit(self, groups):
+        """
+        Commit groups in one batch; if Firestore rejects it, bisect to isolate the rejected groups.
+        Returns [(group, error)] to dead-letter and raises on a transient error, after which the
+        caller retries every group (re-committing the halves that did succeed is harmless).
+        """
+        try:
+            commit_writes(self.db, [write for _, writes in groups for write in writes])
+            return []
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            if len(groups) == 1:
+                return [(groups[0], e)]
+            middle = len(groups) // 2
+            return self._commit(groups[:middle]) + self._commit(groups[middle:])
+
+    def _dead_letter(self, rejected):
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as dead_letters:
+            for (seq, writes), error in rejected:
+                logger.error(f"Write-behind group {seq} rejected, moved to {self.dead_letter_path}: {error}")
+                dead_letters.write(json.dumps({'seq': seq, 'error': str(error), 'writes': writes},
+                                              default=_encode) + '\n')
+            dead_letters.flush()
+            os.fsync(dead_letters.fileno())
+
+    def _worker(self):
+        backoff = 0.5
+        while True:
+            groups = self._collect()
+            try:
+                rejected = self._commit(groups)
+            except Exception as e:
+                logger.error(f"Write-behind commit of {len(groups)} groups failed, retrying: {e}")
+                with self._lock:
+                    self.failures += 1
+                    self._pending[:0] = groups
+                    self._in_flight = 0
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+
+            backoff = 0.5
+            if rejected:
+                self._dead_letter(rejected)
+            with self._lock:
+                self.dead_lettered += len(rejected)
+                for seq, _ in groups:
+                    self._append({'ack': seq})
+                self.commits += 1
+                self.writes += sum(len(writes) for _, writes in groups) - \
+                    sum(len(writes) for (_, writes), _ in rejected)
+                self._in_flight = 0
+                if not self._pending:
+                    # Everything is committed: start the spool over so it never grows unbounded
+                    self._spool.truncate(0)
+                    self._idle.notify_all()
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far is committed; returns False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._pending or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending_groups': len(self._pending),
+                'in_flight_groups': self._in_flight,
+                'commits': self.commits,
+                'writes': self.writes,
+                'failures': self.failures,
+                'dead_lettered': self.dead_lettered,
+                'mean_batch_writes': self.writes / self.commits if self.commits else 0.0
+            }